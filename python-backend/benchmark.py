@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import shutil
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Callable, Dict, List
+
+import websockets
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("benchmark")
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+MiB = 1024 ** 2
+SEARCH_FILE_SIZE = 4096
+STARTUP_TIMEOUT = 30.0
+STOP_TIMEOUT = 10.0
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper()
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def free_port(kind: int = socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples: List[float], fraction: float) -> float | None:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def latency_summary(samples: List[float]) -> Dict:
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3) if samples else None,
+        'p90_ms': round(percentile(samples, 0.90) * 1000, 3) if samples else None,
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3) if samples else None,
+        'max_ms': round(max(samples) * 1000, 3) if samples else None,
+    }
+
+
+def cpu_seconds(pid: int) -> float | None:
+    # utime + stime from /proc; None where procfs is unavailable.
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes(pid: int) -> int | None:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchNode:
+    def __init__(self, index: int, root: str):
+        self.index = index
+        self.directory = os.path.join(root, f"node-{index}")
+        self.share_directory = os.path.join(self.directory, "publicFiles")
+        os.makedirs(self.share_directory)
+        self.port = free_port(socket.SOCK_DGRAM)
+        self.ws_port = free_port()
+        self.process: subprocess.Popen | None = None
+        self.connection = None
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    def add_file(self, name: str, size: int) -> str:
+        with open(os.path.join(self.share_directory, name), "wb") as f:
+            remaining = size
+            while remaining:
+                block = os.urandom(min(remaining, 4 * MiB))
+                f.write(block)
+                remaining -= len(block)
+        return name
+
+    def start(self, seeds: List[str]):
+        command = [sys.executable, os.path.join(BACKEND_DIR, "main.py"), "--port", str(self.port),
+                   "--ws-port", str(self.ws_port), "--http-port", "0", "--share", self.share_directory, "--no-broadcast"]
+        for seed in seeds:
+            command += ["--seed", seed]
+        # Each node runs in its own directory so manifest caches and chunk stores are not shared.
+        log = open(os.path.join(self.directory, "node.log"), "wb")
+        self.process = subprocess.Popen(command, cwd=self.directory, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+
+    async def connect(self, deadline: float):
+        while True:
+            try:
+                self.connection = await websockets.connect(f"ws://127.0.0.1:{self.ws_port}", max_size=None)
+                return
+            except OSError:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"Node {self.index} exited with {self.process.returncode}, see {self.directory}/node.log")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Node {self.index} did not open ws://127.0.0.1:{self.ws_port}")
+                await asyncio.sleep(0.05)
+
+    async def request(self, command: str, payload: str, done: Callable[[Dict], bool]) -> Dict:
+        await self.connection.send(f"{command}:{payload}")
+        return await self.receive(done)
+
+    async def receive(self, done: Callable[[Dict], bool]) -> Dict:
+        # Skips unrelated messages such as download events for other jobs.
+        while True:
+            message = json.loads(await self.connection.recv())
+            if 'error' in message:
+                raise RuntimeError(f"Node {self.index} reported an error: {message}")
+            if done(message):
+                return message
+
+    def cpu_seconds(self) -> float | None:
+        return cpu_seconds(self.process.pid)
+
+    def peak_rss_bytes(self) -> int | None:
+        return peak_rss_bytes(self.process.pid)
+
+    async def stop(self):
+        if self.connection is not None:
+            await self.connection.close()
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGINT if os.name != "nt" else signal.SIGTERM)
+        try:
+            await asyncio.to_thread(self.process.wait, STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+async def measure_convergence(nodes: List[BenchNode], started: float, timeout: float) -> Dict:
+    expected = len(nodes) - 1
+    converged_at: Dict[int, float] = {}
+    deadline = time.monotonic() + timeout
+    while len(converged_at) < len(nodes) and time.monotonic() < deadline:
+        for node in nodes:
+            if node.index in converged_at:
+                continue
+            peers = await node.request("discover_peers", "", lambda m: m.get('type') == 'peer_list')
+            if len(peers['peers']) >= expected:
+                converged_at[node.index] = time.monotonic() - started
+        await asyncio.sleep(0.05)
+    return {
+        'converged': len(converged_at) == len(nodes),
+        'seconds': round(max(converged_at.values()), 3) if len(converged_at) == len(nodes) else None,
+        'per_node_seconds': {str(index): round(seconds, 3) for index, seconds in sorted(converged_at.items())},
+    }
+
+
+async def measure_search(nodes: List[BenchNode], names_by_node: Dict[int, List[str]], queries: int) -> Dict:
+    samples = []
+    misses = 0
+    for query in range(queries):
+        searcher = nodes[query % len(nodes)]
+        owner = nodes[(query + 1) % len(nodes)]
+        names = names_by_node[owner.index]
+        name = names[query % len(names)]
+        started = time.perf_counter()
+        response = await searcher.request("find_files", json.dumps([name]), lambda m: m.get('type') == 'file_sources')
+        samples.append(time.perf_counter() - started)
+        if name not in response['sources']:
+            misses += 1
+    return {**latency_summary(samples), 'misses': misses}
+
+
+async def measure_transfer(sender: BenchNode, receiver: BenchNode, name: str, size: int, timeout: float) -> Dict:
+    await receiver.request("subscribe_downloads", "", lambda m: m.get('status') == 'subscribed')
+    cpu_before = (sender.cpu_seconds(), receiver.cpu_seconds())
+    started = time.perf_counter()
+    initiated = await receiver.request("receive_file", name, lambda m: m.get('status') == 'download_initiated')
+    job_id = initiated['job_id']
+
+    def finished(message: Dict) -> bool:
+        job = message.get('job') or {}
+        return message.get('type') == 'download_event' and job.get('job_id') == job_id and \
+            job.get('state') in ('completed', 'failed', 'cancelled')
+
+    event = await asyncio.wait_for(receiver.receive(finished), timeout)
+    elapsed = time.perf_counter() - started
+    cpu_after = (sender.cpu_seconds(), receiver.cpu_seconds())
+    megabytes = size / MiB
+    cpu = {role: round((after - before) / megabytes, 4) if before is not None and after is not None else None
+           for role, before, after in zip(('sender', 'receiver'), cpu_before, cpu_after)}
+    return {
+        'size': size,
+        'state': event['job']['state'],
+        'seconds': round(elapsed, 3),
+        'throughput_mb_s': round(megabytes / elapsed, 2),
+        'cpu_seconds_per_mb': cpu,
+    }
+
+
+async def run(args) -> Dict:
+    if args.nodes < 2:
+        raise ValueError("At least two nodes are needed")
+    sizes = [parse_size(size) for size in args.sizes.split(',') if size.strip()]
+    root = tempfile.mkdtemp(prefix="p2p-bench-", dir=args.workdir)
+    nodes = [BenchNode(index, root) for index in range(args.nodes)]
+    try:
+        names_by_node = {node.index: [node.add_file(f"node{node.index}-{k}.bin", SEARCH_FILE_SIZE)
+                                      for k in range(args.files_per_node)] for node in nodes}
+        transfer_names = {size: nodes[0].add_file(f"transfer-{size}.bin", size) for size in sizes}
+
+        started = time.monotonic()
+        for node in nodes:
+            node.start([other.address for other in nodes if other is not node])
+        await asyncio.gather(*(node.connect(started + STARTUP_TIMEOUT) for node in nodes))
+        startup = time.monotonic() - started
+        logger.info(f"{len(nodes)} nodes up in {startup:.2f}s under {root}")
+
+        results = {'startup_seconds': round(startup, 3)}
+        results['convergence'] = await measure_convergence(nodes, started, args.timeout)
+        logger.info(f"Convergence: {results['convergence']}")
+        results['search'] = await measure_search(nodes, names_by_node, args.queries)
+        logger.info(f"Search: {results['search']}")
+        results['transfers'] = []
+        for size in sizes:
+            transfer = await measure_transfer(nodes[0], nodes[1], transfer_names[size], size, args.timeout)
+            logger.info(f"Transfer: {transfer}")
+            results['transfers'].append(transfer)
+        results['peak_rss_bytes'] = {str(node.index): node.peak_rss_bytes() for node in nodes}
+        return results
+    finally:
+        await asyncio.gather(*(node.stop() for node in nodes), return_exceptions=True)
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark discovery, search and transfer across local nodes.")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--sizes", default="1M,16M,64M", help="Comma-separated transfer sizes, e.g. 512K,8M,1G")
+    parser.add_argument("--queries", type=int, default=100, help="Number of search round trips")
+    parser.add_argument("--files-per-node", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=120.0, help="Limit for convergence and each transfer")
+    parser.add_argument("--workdir", default=None, help="Where node directories are created")
+    parser.add_argument("--keep", action="store_true", help="Keep node directories and logs")
+    parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'nodes': args.nodes, 'sizes': args.sizes, 'queries': args.queries, 'files_per_node': args.files_per_node},
+        'results': asyncio.run(run(args)),
+    }
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+        logger.info(f"Report written to {args.output}")
+    else:
+        print(encoded)
+
+
+if __name__ == "__main__":
+    main()
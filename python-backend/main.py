@@ -1,14 +1,63 @@
 from utils.P2PNode import P2PNode
+from utils.RateLimiter import parse_rate, rate_limiter
+from utils.Tracer import tracer
+import argparse
 import time
-import os
+
+
+def parse_peer(value: str):
+    host, _, port = value.rpartition(':')
+    return host or "127.0.0.1", int(port)
+
+
+def parse_codecs(value: str):
+    return [] if value == "none" else [codec.strip() for codec in value.split(',') if codec.strip()]
+
+
+def parse_trace_levels(value: str):
+    levels = {}
+    for item in value.split(','):
+        subsystem, _, level = item.partition('=')
+        if not level:
+            raise argparse.ArgumentTypeError(f"expected SUBSYSTEM=LEVEL, got {item!r}")
+        levels[subsystem.strip()] = level.strip()
+    return levels
+
 
 if __name__ == "__main__":
-    node = P2PNode()
-    if not os.path.exists("publicFiles"):
-        os.mkdir("publicFiles")
+    parser = argparse.ArgumentParser(description="Run a P2P file sharing node.")
+    parser.add_argument("--port", type=int, default=5003, help="UDP discovery and control port")
+    parser.add_argument("--ws-port", type=int, default=8765, help="WebSocket port for the frontend")
+    parser.add_argument("--http-port", type=int, default=5001, help="HTTP file server port (0 picks a free one)")
+    parser.add_argument("--client-port", type=int, default=5002, help="Port the HTTP file client connects to")
+    parser.add_argument("--share", default="publicFiles", help="Directory shared with the network")
+    parser.add_argument("--seed", action="append", type=parse_peer, default=[], metavar="HOST:PORT",
+                        help="Peer to announce to directly, in addition to broadcasts (repeatable)")
+    parser.add_argument("--no-broadcast", action="store_true", help="Only reach the --seed peers")
+    parser.add_argument("--compression", type=parse_codecs, default=None, metavar="CODECS",
+                        help="Comma-separated codecs to accept for downloads (zstd, zlib, lzma), or 'none'; "
+                             "defaults to every one available")
+    parser.add_argument("--upload-limit", type=parse_rate, default=None, metavar="RATE",
+                        help="Total upload cap in bytes per second, e.g. 5M (also settable at runtime over the websocket)")
+    parser.add_argument("--download-limit", type=parse_rate, default=None, metavar="RATE",
+                        help="Total download cap in bytes per second")
+    parser.add_argument("--trace", type=parse_trace_levels, default={}, metavar="LEVELS",
+                        help="Trace levels per subsystem, e.g. discovery=debug,udp=debug or *=off; "
+                             "SIGUSR1 writes the trace buffer to trace-<pid>-<time>.log")
+    args = parser.parse_args()
+    rate_limiter.configure(upload=args.upload_limit, download=args.download_limit)
+    try:
+        tracer.configure(levels=args.trace)
+    except ValueError as e:
+        parser.error(str(e))
+    tracer.install_signal_handler()
+
+    node = P2PNode(port=args.port, web_socket_port=args.ws_port, file_server_port=args.http_port,
+                   file_client_port=args.client_port, share_directory=args.share, seed_peers=args.seed,
+                   broadcast=not args.no_broadcast, compression=args.compression)
     try:
         while True:
             time.sleep(5)
     except KeyboardInterrupt:
         print("\nStopping P2P node...")
-        node.stop()
\ No newline at end of file
+        node.stop()
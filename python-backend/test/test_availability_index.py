@@ -0,0 +1,65 @@
+import hashlib
+import json
+import time
+
+from utils.AvailabilityIndex import AvailabilityIndex, BloomFilter, build_summary, MAX_BLOOM_BYTES
+from utils.DiscoverPeers import CAPABILITIES, DiscoverPeers
+from utils.ShareIndex import ShareIndex
+
+
+def start_peer(directory, files):
+    directory.mkdir()
+    for name, data in files.items():
+        (directory / name).write_bytes(data)
+    peer = DiscoverPeers(0, ShareIndex(str(directory)))
+    peer.start_listening()
+    return peer
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    names = [f"file-{i}.bin" for i in range(2000)]
+    hashes = [hashlib.sha256(name.encode()).hexdigest() for name in names]
+    bloom = build_summary(names, hashes)
+    assert all(f"n:{name}" in bloom for name in names) and all(f"h:{h}" in bloom for h in hashes)
+    false_positives = sum(f"n:other-{i}.bin" in bloom for i in range(10000))
+    assert false_positives < 300
+
+    copy = BloomFilter.from_bytes(bloom.to_bytes(), bloom.bit_count, bloom.hash_count)
+    assert "n:file-7.bin" in copy
+    assert len(build_summary([f"{i}" for i in range(200000)], []).bits) <= MAX_BLOOM_BYTES
+
+
+def test_lookup_reports_candidates_and_coverage():
+    index = AvailabilityIndex()
+    index.update(("10.0.0.1", 1), "a", 3, build_summary(["movie.mkv"], []))
+    index.update(("10.0.0.2", 1), "b", 1, build_summary(["notes.txt"], []))
+    assert index.lookup_name("movie.mkv", [("10.0.0.1", 1), ("10.0.0.2", 1)]) == ([("10.0.0.1", 1)], True)
+    assert index.lookup_name("movie.mkv", [("10.0.0.3", 1)]) == ([], False)
+    assert index.is_current(("10.0.0.1", 1), "a", 3) and not index.is_current(("10.0.0.1", 1), "a", 4)
+
+
+def test_search_uses_gossiped_summaries(tmp_path):
+    holder = start_peer(tmp_path / "a", {"wanted.bin": b"data"})
+    other = start_peer(tmp_path / "b", {"unrelated.bin": b"other"})
+    client = start_peer(tmp_path / "client", {})
+    for peer in (holder, other):
+        announce = {'type': 'peer_info', 'port': peer.port, 'node_id': peer.node_id, 'capabilities': CAPABILITIES,
+                    'index_version': peer.share_index.version}
+        peer.discovery_socket.sendto(json.dumps(announce).encode(), ("127.0.0.1", client.port))
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and len(client.availability.peers()) < 2:
+        time.sleep(0.01)
+    assert len(client.availability.peers()) == 2
+
+    sent = []
+    send = client.engine.send
+    client.engine.send = lambda message, addr, binary=False: (sent.append(addr), send(message, addr, binary))
+    holders = client.find_file_holders("wanted.bin", timeout_duration=2.0)
+    assert [(ip, port) for ip, port, _, _ in holders] == [("127.0.0.1", holder.port)]
+    assert sent == [("127.0.0.1", holder.port)]
+
+    started = time.monotonic()
+    assert client.find_file_holders("missing.bin") == []
+    assert client.find_file_sources(["missing.bin"]) == {"missing.bin": []}
+    assert time.monotonic() - started < 0.05
@@ -0,0 +1,117 @@
+import hashlib
+import os
+
+import utils.ChunkStore
+from utils.ChunkStore import ChunkStore
+from utils.DiscoverPeers import DiscoverPeers
+from utils.DownloadState import DownloadState
+from utils.ManifestManager import CHUNK_SIZE, ManifestCache, ManifestManager
+from utils.ShareIndex import ShareIndex
+from utils.SwarmDownloader import SwarmDownload
+
+
+def manifest_for(tmp_path, path):
+    return ManifestManager.generate_file_manifest(str(path), cache=ManifestCache(str(tmp_path / "cache")))
+
+
+def test_identical_files_are_stored_once(tmp_path):
+    share = tmp_path / "share"
+    share.mkdir()
+    data = os.urandom(2 * CHUNK_SIZE + 5)
+    (share / "a.bin").write_bytes(data)
+    store = ChunkStore.for_share(str(share))
+    manifest = manifest_for(tmp_path, share / "a.bin")
+    assert store.add_file(str(share / "a.bin"), manifest)
+
+    assert store.link_file(manifest["sha256"], str(share / "copy" / "b.bin"))
+    assert not store.link_file(manifest["sha256"], str(share / "copy" / "b.bin"))
+    # Every name is its own file: editing one must not change the other or the stored object.
+    with open(share / "copy" / "b.bin", "r+b") as f:
+        f.write(b"EDITED")
+    assert (share / "a.bin").read_bytes() == data
+    assert store.has_file(manifest["sha256"])
+    assert store.read_chunk(manifest["chunks"][2]) == data[2 * CHUNK_SIZE:]
+
+    reopened = ChunkStore.for_share(str(share))
+    assert reopened.has_chunk(manifest["chunks"][1]) and reopened.manifest(manifest["sha256"]) == manifest
+    assert not store.put_chunk(manifest["chunks"][0], b"not the chunk")
+
+
+def test_download_skips_chunks_already_in_the_store(tmp_path):
+    shared = tmp_path / "seed"
+    shared.mkdir()
+    repeated = os.urandom(CHUNK_SIZE)
+    known = os.urandom(CHUNK_SIZE)
+    data = repeated + known + repeated + os.urandom(CHUNK_SIZE) + repeated
+    (shared / "file.bin").write_bytes(data)
+    seeder = DiscoverPeers(0, ShareIndex(str(shared)))
+    seeder.start_listening()
+    downloads = tmp_path / "downloads"
+    downloader = DiscoverPeers(0, ShareIndex(str(downloads)))
+    store = ChunkStore.for_share(str(downloads))
+    store.put_chunk(hashlib.sha256(known).hexdigest(), known)
+
+    file_hash = hashlib.sha256(data).hexdigest()
+    state = DownloadState.create(str(downloads / "file.bin"), downloader.fetch_manifest("127.0.0.1", seeder.port, file_hash))
+    swarm = SwarmDownload(downloader, file_hash, len(data), [("127.0.0.1", seeder.port)], str(downloads / "file.bin"),
+                          state=state, chunk_store=store)
+    assert swarm.run()
+    assert (downloads / "file.bin").read_bytes() == data
+    # Only the first copy of the repeated chunk and the one unknown chunk crossed the network.
+    assert swarm.stats[("127.0.0.1", seeder.port)].bytes == 2 * CHUNK_SIZE
+    assert swarm.bytes_done == len(data)
+
+
+def test_without_reflinks_the_store_references_share_files_in_place(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.ChunkStore, "fcntl", None)
+    share = tmp_path / "share"
+    share.mkdir()
+    data = os.urandom(CHUNK_SIZE + 7)
+    (share / "a.bin").write_bytes(data)
+    store = ChunkStore.for_share(str(share))
+    manifest = manifest_for(tmp_path, share / "a.bin")
+    assert store.add_file(str(share / "a.bin"), manifest)
+
+    # Only the manifest record is written; no byte of the file is copied into the store.
+    stored = [os.path.join(d, name) for d, _, names in os.walk(store.root) for name in names]
+    assert all(path.startswith(store.manifests_dir) for path in stored)
+    assert sum(os.stat(path).st_blocks for path in stored) * 512 < CHUNK_SIZE
+    assert store.has_file(manifest["sha256"]) and not store.has_object(manifest["sha256"])
+    assert store.read_chunk(manifest["chunks"][1]) == data[CHUNK_SIZE:]
+
+    # A new name is the one copy it has to be, read from the share file.
+    assert store.link_file(manifest["sha256"], str(share / "b.bin"))
+    assert (share / "b.bin").read_bytes() == data
+
+    # Once the share file is edited the reference no longer holds those bytes.
+    with open(share / "a.bin", "r+b") as f:
+        f.write(b"EDITED")
+    assert not store.has_file(manifest["sha256"]) and store.read_chunk(manifest["chunks"][0]) is None
+    assert not store.link_file(manifest["sha256"], str(share / "c.bin"))
+    assert store.gc({manifest["sha256"]}) == (1, 0)
+    assert (share / "a.bin").exists() and ChunkStore.for_share(str(share)).manifest(manifest["sha256"]) is None
+
+
+def test_gc_removes_unreferenced_objects(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.ChunkStore, "fcntl", None)
+    share = tmp_path / "share"
+    share.mkdir()
+    (share / "kept.bin").write_bytes(b"k" * 100)
+    (share / "deleted.bin").write_bytes(b"d" * 100)
+    store = ChunkStore.for_share(str(share))
+    kept = manifest_for(tmp_path, share / "kept.bin")
+    deleted = manifest_for(tmp_path, share / "deleted.bin")
+    store.add_file(str(share / "kept.bin"), kept)
+    store.add_file(str(share / "deleted.bin"), deleted)
+    os.remove(share / "deleted.bin")
+    pinned, loose = b"p" * 10, b"l" * 10
+    store.put_chunk(hashlib.sha256(pinned).hexdigest(), pinned)
+    store.put_chunk(hashlib.sha256(loose).hexdigest(), loose)
+    # Already held by a stored file, so the loose copy is redundant.
+    store.put_chunk(kept["chunks"][0], b"k" * 100)
+
+    # The deleted file was only referenced, so dropping it frees nothing in the store.
+    assert store.gc({kept["sha256"]}, pinned={hashlib.sha256(pinned).hexdigest()}) == (3, 110)
+    assert store.has_file(kept["sha256"]) and not store.has_file(deleted["sha256"])
+    assert store.has_chunk(hashlib.sha256(pinned).hexdigest())
+    assert not store.has_chunk(hashlib.sha256(loose).hexdigest()) and not store.has_chunk(deleted["chunks"][0])
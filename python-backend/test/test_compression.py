@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+import json
+import os
+import socket
+
+import pytest
+import websockets
+
+from utils import websocket as websocket_module
+from utils.Compression import CODECS, available_codecs, choose_codec
+from utils.FileTransfer import FileReceiver, FileSender, tune_socket_buffers
+from utils.ManifestManager import CHUNK_SIZE
+
+TEXT = b"".join(f"2024-05-{i % 28 + 1:02d} INFO request {i} served in {i % 97} ms\n".encode() for i in range(40000))
+
+
+def mixed_content():
+    # A compressible chunk, an incompressible one, then compressible text again.
+    return TEXT[:CHUNK_SIZE] + os.urandom(CHUNK_SIZE) + TEXT[:CHUNK_SIZE // 2]
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_codecs_round_trip_within_bounds(name):
+    codec = CODECS[name]
+    compressed = codec.compress(TEXT)
+    assert len(compressed) < len(TEXT) // 5 and codec.decompress(compressed, len(TEXT)) == TEXT
+    with pytest.raises(ValueError):
+        codec.decompress(compressed, len(TEXT) - 1)
+    with pytest.raises(ValueError):
+        codec.decompress(b"not compressed at all", 100)
+    assert codec.worth_compressing(TEXT[:4096]) and not codec.worth_compressing(os.urandom(4096))
+
+
+def test_codec_negotiation():
+    assert choose_codec(None) is None and choose_codec(["brotli"]) is None
+    assert choose_codec(["lzma", "zlib"]).name == "zlib"
+    assert choose_codec(["lzma"]).name == "lzma"
+    assert available_codecs()[-2:] == ["zlib", "lzma"]
+
+
+@pytest.mark.parametrize("compression", [None, ["zlib"], ["lzma"]])
+def test_transfer_compresses_only_what_shrinks(tmp_path, compression):
+    data = mixed_content()
+    source = tmp_path / "server.log"
+    source.write_bytes(data)
+    file_hash = hashlib.sha256(data).hexdigest()
+    destination = tmp_path / "downloads" / "server.log"
+
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tune_socket_buffers(receiver_socket)
+    receiver_socket.bind(("127.0.0.1", 0))
+    try:
+        sender = FileSender(str(source), file_hash, receiver_socket.getsockname(), compression=compression)
+        sender.start()
+        receiver = FileReceiver(receiver_socket, "127.0.0.1", file_hash, str(destination), idle_timeout=10)
+        assert receiver.receive()
+    finally:
+        receiver_socket.close()
+
+    assert destination.read_bytes() == data and receiver.bytes_received == len(data)
+    if compression is None:
+        assert receiver.codec is None and receiver.wire_bytes == len(data)
+    else:
+        assert receiver.codec.name == compression[0]
+        # The random chunk goes raw after its sample; the text shrinks many times over.
+        assert CHUNK_SIZE < receiver.wire_bytes < CHUNK_SIZE * 1.3
+        assert sender._compressible == {0: True, 1: False, 2: True}
+
+
+def test_serve_file_streams_flagged_chunks(tmp_path):
+    data = mixed_content()
+    path = tmp_path / "server.log"
+    path.write_bytes(data)
+    file_hash = hashlib.sha256(data).hexdigest()
+    node = type("Node", (), {})()
+    node.peer_discovery = type("Discovery", (), {"local_files": {file_hash: str(path)}, "peers": []})()
+
+    async def stream():
+        websocket_module.shared_p2p_node_instance = node
+        async with websockets.serve(websocket_module.handle_message, "127.0.0.1", 0, max_size=None) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}", max_size=None) as client:
+                await client.send("serve_file:" + json.dumps({"filename": "server.log", "compression": ["zlib"]}))
+                start = json.loads(await client.recv())
+                chunks = []
+                while isinstance(message := await client.recv(), bytes):
+                    chunks.append(message)
+                return start, chunks, json.loads(message)
+
+    start, chunks, end = asyncio.run(stream())
+    assert start["compression"] == "zlib" and [chunk[0] for chunk in chunks] == [1, 0, 1]
+    decoded = [CODECS["zlib"].decompress(chunk[1:], CHUNK_SIZE if i < 2 else CHUNK_SIZE // 2) if chunk[0] else chunk[1:]
+               for i, chunk in enumerate(chunks)]
+    assert b"".join(decoded) == data
+    assert end["bytes_sent"] == len(data) and end["wire_bytes"] == sum(len(chunk) for chunk in chunks) < len(data) * 0.6
@@ -0,0 +1,159 @@
+import json
+import os
+import socket
+import time
+
+from utils.DiscoverPeers import CAPABILITIES, DiscoverPeers, DiscoveryScheduler, QUERY_DATAGRAM_LIMIT, split_batches
+from utils.PeerTable import PeerTable, SEARCH_MAX_WINDOW, SEARCH_MIN_WINDOW
+from utils.ShareIndex import ShareIndex
+from utils.WireFormat import encode_message
+
+
+def start_peer(directory, files):
+    directory.mkdir()
+    for name, data in files.items():
+        (directory / name).write_bytes(data)
+    peer = DiscoverPeers(0, ShareIndex(str(directory)))
+    peer.start_listening()
+    return peer
+
+
+def test_split_batches_respects_limit_in_both_formats():
+    names = [f"file-{i:04d}-with-a-fairly-long-name.bin" for i in range(200)]
+    base = {'type': 'query_files', 'request_id': 7, 'reply_port': 1, 'part': 0, 'hashes': []}
+    as_json = split_batches(base, 'names', names, QUERY_DATAGRAM_LIMIT)
+    as_binary = split_batches(base, 'names', names, QUERY_DATAGRAM_LIMIT, binary=True)
+    assert len(as_json) > len(as_binary) > 1
+    assert all(len(json.dumps(m)) <= QUERY_DATAGRAM_LIMIT for m in as_json)
+    assert all(len(encode_message(m)) <= QUERY_DATAGRAM_LIMIT for m in as_binary)
+    assert [n for m in as_binary for n in m['names']] == names
+
+
+def test_find_file_sources_resolves_a_list_in_one_window(tmp_path):
+    shared = {f"doc-{i:03d}-{'x' * 40}.txt": os.urandom(64) for i in range(150)}
+    first = start_peer(tmp_path / "a", dict(list(shared.items())[:100]))
+    second = start_peer(tmp_path / "b", dict(list(shared.items())[50:]))
+    client = DiscoverPeers(0, ShareIndex(str(tmp_path / "client")))
+    targets = [("127.0.0.1", first.port), ("127.0.0.1", second.port)]
+    some_hash = first.share_index.hash_for_name("doc-000-" + "x" * 40 + ".txt")
+
+    started = time.monotonic()
+    sources = client.find_file_sources(list(shared) + ["missing.txt"], [some_hash], timeout_duration=1.0, targets=targets)
+    assert time.monotonic() - started < 2.0
+
+    assert sources["missing.txt"] == []
+    assert {port for _, port, _, _ in sources["doc-000-" + "x" * 40 + ".txt"]} == {first.port}
+    assert {port for _, port, _, _ in sources["doc-075-" + "x" * 40 + ".txt"]} == {first.port, second.port}
+    assert all(holders for name, holders in sources.items() if name != "missing.txt")
+    assert sources[some_hash] == [("127.0.0.1", first.port, some_hash, 64)]
+
+
+def test_peer_table_smooths_rtt_and_bounds_search_window():
+    table = PeerTable()
+    table.observe_rtt(("10.0.0.1", 1), 0.010)
+    table.observe_rtt(("10.0.0.1", 1), 0.030)
+    record = table.get(("10.0.0.1", 1))
+    assert 0.010 < record.srtt < 0.030 and record.rto > record.srtt
+    assert table.search_window([("10.0.0.1", 1)]) == SEARCH_MIN_WINDOW
+    table.observe_rtt(("10.0.0.2", 1), 60.0)
+    assert table.search_window(table.live_peers()) == SEARCH_MAX_WINDOW
+
+
+def test_search_returns_early_and_ranks_by_throughput(tmp_path):
+    data = os.urandom(128)
+    first = start_peer(tmp_path / "a", {"shared.bin": data})
+    second = start_peer(tmp_path / "b", {"shared.bin": data})
+    empty = start_peer(tmp_path / "c", {})
+    client = DiscoverPeers(0, ShareIndex(str(tmp_path / "client")))
+    targets = [("127.0.0.1", peer.port) for peer in (first, second, empty)]
+    client.peer_table.observe_throughput(("127.0.0.1", second.port), 500e6)
+    client.peer_table.observe_throughput(("127.0.0.1", first.port), 1e6)
+
+    started = time.monotonic()
+    holders = client.find_file_holders("shared.bin", timeout_duration=3.0, targets=targets)
+    assert time.monotonic() - started < 1.0
+    assert [port for _, port, _, _ in holders] == [second.port, first.port]
+
+    started = time.monotonic()
+    assert client.find_file_holders("nowhere.bin", timeout_duration=3.0, targets=targets) == []
+    assert client.find_file_sources(["nowhere.bin"], timeout_duration=3.0, targets=targets) == {"nowhere.bin": []}
+    assert time.monotonic() - started < 1.0
+    assert all(client.peer_table.get(target).srtt is not None for target in targets)
+
+
+def test_discovery_fills_peer_table_and_expires_silent_peers(tmp_path):
+    first = start_peer(tmp_path / "a", {"x.bin": b"x"})
+    second = start_peer(tmp_path / "b", {})
+    # Replies advertise the version of the last refresh; the listener never rescans the share itself.
+    first.share_index.refresh(force=True)
+    announce = {'type': 'discover', 'port': second.port, 'node_id': second.node_id, 'capabilities': CAPABILITIES,
+                'index_version': 7, 'ts': time.monotonic()}
+    second.discovery_socket.sendto(json.dumps(announce).encode(), ("127.0.0.1", first.port))
+    # The node's own broadcast must not make it list itself.
+    first.discovery_socket.sendto(json.dumps({**announce, 'port': first.port, 'node_id': first.node_id}).encode(), ("127.0.0.1", first.port))
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and not (first.peers and second.peers):
+        time.sleep(0.01)
+    assert first.peers == [f"127.0.0.1:{second.port}"]
+    assert second.peers == [f"127.0.0.1:{first.port}"]
+    [details] = second.peer_table.snapshot()
+    assert details["rtt"] is not None and details["capabilities"] == sorted(CAPABILITIES)
+    assert details["index_version"] == first.share_index.version
+    assert first.peer_table.get(("127.0.0.1", second.port)).index_version == 7
+    assert second.peer_table.with_capability("nack") == {("127.0.0.1", first.port)}
+
+    table = PeerTable(live_window=0.0, expiry=0.0)
+    table.seen(("10.0.0.9", 1))
+    time.sleep(0.01)
+    assert table.live_peers() == set() and table.snapshot() == []
+    assert table.expire() == [("10.0.0.9", 1)] and len(table) == 0
+
+
+def test_discovery_scheduler_backs_off_with_jitter():
+    scheduler = DiscoveryScheduler(min_interval=1.0, max_interval=8.0, jitter=0.25)
+    delays = [scheduler.next_delay(changed=False) for _ in range(5)]
+    assert 1.5 <= delays[0] <= 2.5 and scheduler.interval == 8.0
+    assert all(6.0 <= delay <= 10.0 for delay in delays[2:])
+    assert 0.75 <= scheduler.next_delay(changed=True) <= 1.25
+
+
+def test_replies_are_suppressed_for_peers_that_heard_us(tmp_path):
+    peer = start_peer(tmp_path / "a", {})
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.settimeout(0.3)
+    port = listener.getsockname()[1]
+
+    def discover(**extra):
+        listener.sendto(json.dumps({'type': 'discover', 'port': port, 'node_id': 'other', 'ts': 1.0, **extra}).encode(),
+                        ("127.0.0.1", peer.port))
+        try:
+            return json.loads(listener.recv(65535))
+        except socket.timeout:
+            return None
+
+    assert discover()["type"] == "peer_info"
+    peer.last_announcement = time.monotonic()
+    assert discover() is None
+    assert discover(hello=True)["type"] == "peer_info"
+    listener.close()
+
+    # A peer that announced a long interval stays live for several of its intervals.
+    table = PeerTable(live_window=0.0, expiry=0.0)
+    table.update(("10.0.0.3", 1), {'interval': 100.0})
+    assert table.live_peers() == {("10.0.0.3", 1)} and table.expire() == []
+
+
+def test_seed_peers_are_reached_without_broadcast(tmp_path):
+    seed = start_peer(tmp_path / "seed", {"seeded.bin": b"s" * 10})
+    (tmp_path / "joiner").mkdir()
+    joiner = DiscoverPeers(0, ShareIndex(str(tmp_path / "joiner")), seed_peers=[("127.0.0.1", seed.port)], broadcast=False)
+    assert joiner._broadcast_destinations() == [("127.0.0.1", seed.port)]
+    joiner.start_discovery()
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and not (joiner.peers and seed.peers):
+        time.sleep(0.01)
+    assert joiner.peers == [f"127.0.0.1:{seed.port}"] and seed.peers == [f"127.0.0.1:{joiner.port}"]
+    assert [holder[:2] for holder in joiner.find_file_holders("seeded.bin", timeout_duration=1.0)] == [("127.0.0.1", seed.port)]
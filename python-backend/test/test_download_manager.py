@@ -0,0 +1,114 @@
+import asyncio
+import json
+import threading
+import time
+
+import websockets
+
+from utils import websocket as websocket_module
+from utils.DownloadManager import DownloadManager, CANCELLED, COMPLETED, PAUSED, QUEUED
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class FakeDownloads:
+    def __init__(self):
+        self.started = []
+        self.release = threading.Event()
+
+    def __call__(self, filename, cancelled=None, on_progress=None, destination=None):
+        self.started.append(filename)
+        for done in range(0, 101, 10):
+            on_progress(done, 100)
+            if cancelled.wait(0.01 if self.release.is_set() else 0.2):
+                return False
+        return True
+
+
+def test_jobs_run_by_priority_within_the_concurrency_limit():
+    downloads = FakeDownloads()
+    manager = DownloadManager(downloads, max_concurrent=1)
+    first = manager.submit("first.bin")
+    assert wait_for(lambda: downloads.started == ["first.bin"])
+    manager.submit("low.bin", priority=0)
+    high = manager.submit("high.bin", priority=5)
+    assert manager.submit("high.bin") is high
+    downloads.release.set()
+    assert wait_for(lambda: all(job["state"] == COMPLETED for job in manager.list_jobs()))
+    assert downloads.started == ["first.bin", "high.bin", "low.bin"]
+    assert first.bytes_done == first.total_bytes == 100
+    manager.stop()
+
+
+def test_pause_resume_and_cancel_running_job():
+    downloads = FakeDownloads()
+    discarded = []
+    events = []
+    manager = DownloadManager(downloads, max_concurrent=1, discard=discarded.append)
+    manager.subscribe(lambda event, job: events.append((event, job["state"])))
+
+    job = manager.submit("movie.mkv")
+    assert wait_for(lambda: downloads.started)
+    assert manager.pause(job.job_id)
+    assert wait_for(lambda: job.state == PAUSED)
+    assert manager.resume(job.job_id) and job.state in (QUEUED, "running")
+    assert wait_for(lambda: len(downloads.started) == 2)
+    assert manager.cancel(job.job_id)
+    assert wait_for(lambda: job.state == CANCELLED)
+    assert discarded == ["movie.mkv"]
+    assert ("progress", "running") in events and (PAUSED, PAUSED) in events and events[-1] == (CANCELLED, CANCELLED)
+    manager.stop()
+
+
+def test_cancel_racing_with_completion_keeps_the_completed_file():
+    finishing = threading.Event()
+    cancelled_sent = threading.Event()
+    discarded = []
+
+    def download(filename, cancelled=None, on_progress=None, destination=None):
+        # The file is complete and in the share by the time the cancel lands.
+        on_progress(100, 100)
+        finishing.set()
+        cancelled_sent.wait(5.0)
+        return True
+
+    manager = DownloadManager(download, max_concurrent=1, discard=discarded.append)
+    job = manager.submit("done.bin")
+    assert finishing.wait(5.0)
+    assert manager.cancel(job.job_id)
+    cancelled_sent.set()
+    assert wait_for(lambda: job.state == COMPLETED)
+    assert discarded == [] and not manager.resume(job.job_id)
+    manager.stop()
+
+
+def test_receive_file_command_reports_job_events():
+    class Node:
+        def __init__(self):
+            self.download_manager = DownloadManager(lambda filename, cancelled, on_progress, destination: on_progress(5, 5) or True)
+
+    async def run():
+        websocket_module.shared_p2p_node_instance = Node()
+        async with websockets.serve(websocket_module.handle_message, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}") as client:
+                await client.send('receive_file:{"filename": "a.txt", "priority": 2}')
+                initiated, events = None, []
+                while not events or events[-1]["event"] != COMPLETED:
+                    message = json.loads(await asyncio.wait_for(client.recv(), 5))
+                    if message.get("type") == "download_event":
+                        events.append(message)
+                    else:
+                        initiated = message
+                return initiated, events
+
+    initiated, events = asyncio.run(run())
+    assert initiated == {"status": "download_initiated", "filename": "a.txt", "job_id": 1}
+    assert events[-1]["job"]["priority"] == 2 and events[-1]["job"]["bytes_done"] == 5
@@ -0,0 +1,81 @@
+import hashlib
+import os
+from types import SimpleNamespace
+
+from utils.DiscoverPeers import DiscoverPeers
+from utils.DownloadState import DownloadState
+from utils.ManifestManager import CHUNK_SIZE, ManifestCache, ManifestManager
+from utils.P2PNode import P2PNode
+from utils.ShareIndex import ShareIndex
+from utils.SwarmDownloader import SwarmDownload
+
+
+def make_source(tmp_path, size):
+    shared = tmp_path / "seed"
+    shared.mkdir()
+    data = os.urandom(size)
+    (shared / "file.bin").write_bytes(data)
+    return shared, data
+
+
+def test_verified_chunks_survive_reload(tmp_path):
+    shared, data = make_source(tmp_path, 3 * CHUNK_SIZE + 10)
+    manifest = ManifestManager.generate_file_manifest(str(shared / "file.bin"), cache=ManifestCache(str(tmp_path / "cache")))
+    destination = tmp_path / "downloads" / "file.bin"
+    state = DownloadState.create(str(destination), manifest)
+
+    with open(state.part_path, "r+b") as f:
+        f.seek(CHUNK_SIZE)
+        f.write(data[CHUNK_SIZE:2 * CHUNK_SIZE])
+        f.seek(2 * CHUNK_SIZE)
+        f.write(b"x" * CHUNK_SIZE)
+        f.flush()
+        assert state.verify_and_mark(1, f.fileno())
+        assert not state.verify_and_mark(2, f.fileno())
+
+    reloaded = DownloadState.load(str(destination))
+    assert reloaded.file_hash == hashlib.sha256(data).hexdigest()
+    assert reloaded.done_chunks() == {1}
+    assert [s.destination_path for s in DownloadState.pending_downloads(str(tmp_path / "downloads"))] == [str(destination)]
+
+
+def test_resume_searches_for_the_requested_name_and_keeps_the_destination(tmp_path):
+    shared, _ = make_source(tmp_path, CHUNK_SIZE + 10)
+    manifest = ManifestManager.generate_file_manifest(str(shared / "file.bin"), cache=ManifestCache(str(tmp_path / "cache")))
+    downloads = tmp_path / "downloads"
+    DownloadState.create(str(downloads / "movies" / "renamed.bin"), manifest, requested_filename="file.bin")
+
+    [state] = DownloadState.pending_downloads(str(downloads))
+    assert state.requested_filename == "file.bin"
+    submitted = []
+    node = SimpleNamespace(share_index=SimpleNamespace(directory=str(downloads), files=lambda: {}),
+                           peer_discovery=SimpleNamespace(manifest_cache=ManifestCache(str(tmp_path / "cache"))),
+                           chunk_store=SimpleNamespace(gc=lambda shared, pinned: (0, 0)),
+                           download_manager=SimpleNamespace(submit=lambda name, destination: submitted.append((name, destination))))
+    P2PNode.resume_pending_downloads(node)
+    assert submitted == [("file.bin", os.path.join("movies", "renamed.bin"))]
+
+def test_resumed_swarm_fetches_only_missing_chunks(tmp_path):
+    shared, data = make_source(tmp_path, 5 * CHUNK_SIZE + 99)
+    seeder = DiscoverPeers(0, ShareIndex(str(shared)))
+    seeder.start_listening()
+    downloader = DiscoverPeers(0, ShareIndex(str(tmp_path / "downloads")))
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    manifest = downloader.fetch_manifest("127.0.0.1", seeder.port, file_hash)
+    assert manifest["chunk_count"] == 6
+    destination = tmp_path / "downloads" / "file.bin"
+    state = DownloadState.create(str(destination), manifest)
+    with open(state.part_path, "r+b") as f:
+        f.write(data[:3 * CHUNK_SIZE])
+        f.flush()
+        for chunk_index in range(3):
+            assert state.verify_and_mark(chunk_index, f.fileno())
+
+    resumed = DownloadState.load(str(destination))
+    swarm = SwarmDownload(downloader, file_hash, len(data), [("127.0.0.1", seeder.port)], str(destination), state=resumed)
+    assert swarm.run()
+    assert destination.read_bytes() == data
+    assert swarm.stats[("127.0.0.1", seeder.port)].bytes == len(data) - 3 * CHUNK_SIZE
+    assert DownloadState.load(str(destination)) is None
+    assert not os.path.exists(resumed.bitmap_path)
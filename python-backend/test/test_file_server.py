@@ -0,0 +1,130 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from utils.FileManager import FileClient, FileServer, parse_range
+from utils.ShareIndex import ShareIndex
+
+
+@pytest.fixture
+def server(tmp_path):
+    shared = tmp_path / "publicFiles"
+    shared.mkdir()
+    data = os.urandom(300_000)
+    (shared / "file.bin").write_bytes(data)
+    file_server = FileServer("127.0.0.1", 0, share_index=ShareIndex(str(shared)), max_connections=2)
+    threading.Thread(target=file_server.start_server, daemon=True).start()
+    while not file_server.running:
+        time.sleep(0.01)
+    yield file_server, data
+    file_server.stop_server()
+
+
+def request(port, raw, conn=None):
+    conn = conn or socket.create_connection(("127.0.0.1", port), timeout=5)
+    conn.sendall(raw)
+    response = b""
+    while b"\r\n\r\n" not in response:
+        response += conn.recv(65536)
+    head, body = response.split(b"\r\n\r\n", 1)
+    status_line, *header_lines = head.decode().split("\r\n")
+    headers = {name.lower(): value for name, value in (line.split(": ", 1) for line in header_lines)}
+    while len(body) < int(headers["content-length"]) and not raw.startswith(b"HEAD"):
+        body += conn.recv(65536)
+    return int(status_line.split()[1]), headers, body, conn
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_range("bytes=900-", 1000) == (900, 999)
+    assert parse_range("bytes=-100", 1000) == (900, 999)
+    assert parse_range("bytes=500-5000", 1000) == (500, 999)
+    assert parse_range("bytes=1000-", 1000) == (1000, None)
+    assert parse_range("bytes=0-1,5-9", 1000) is None
+    assert parse_range(None, 1000) is None
+
+
+def test_full_and_ranged_requests_on_one_connection(server):
+    file_server, data = server
+    status, headers, body, conn = request(file_server.port, b"GET /file.bin HTTP/1.1\r\n\r\n")
+    assert status == 200 and body == data
+    assert headers["x-content-sha256"] == hashlib.sha256(data).hexdigest()
+
+    status, headers, body, _ = request(file_server.port, b"GET /file.bin HTTP/1.1\r\nRange: bytes=1000-1999\r\n\r\n", conn)
+    assert status == 206 and body == data[1000:2000]
+    assert headers["content-range"] == f"bytes 1000-1999/{len(data)}"
+
+    status, headers, _, _ = request(file_server.port, b"HEAD /file.bin HTTP/1.1\r\n\r\n", conn)
+    assert status == 200 and int(headers["content-length"]) == len(data)
+    conn.close()
+
+
+def test_errors(server):
+    file_server, data = server
+    assert request(file_server.port, b"GET /missing.bin HTTP/1.1\r\n\r\n")[0] == 404
+    assert request(file_server.port, b"GET /../secret HTTP/1.1\r\n\r\n")[0] == 400
+    status, headers, _, _ = request(file_server.port, f"GET /file.bin HTTP/1.1\r\nRange: bytes={len(data)}-\r\n\r\n".encode())
+    assert status == 416 and headers["content-range"] == f"bytes */{len(data)}"
+
+
+def test_idle_connection_does_not_block_others(server):
+    file_server, data = server
+    idle = socket.create_connection(("127.0.0.1", file_server.port))
+    status, _, body, conn = request(file_server.port, b"GET /file.bin HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert status == 200 and body == data
+    conn.close()
+    idle.close()
+
+
+def test_legacy_bare_filename(server):
+    file_server, data = server
+    with socket.create_connection(("127.0.0.1", file_server.port), timeout=5) as conn:
+        conn.sendall(b"file.bin")
+        received = b""
+        while chunk := conn.recv(65536):
+            received += chunk
+    assert received == data
+
+
+def test_client_fetches_ranges_in_parallel(server, tmp_path):
+    file_server, data = server
+    client = FileClient("127.0.0.1", file_server.port, download_dir=str(tmp_path / "downloads"),
+                        connections=2, buffer_size=4096, range_size=50_000)
+    assert client.request_file("file.bin")
+    assert (tmp_path / "downloads" / "file.bin").read_bytes() == data
+    assert not (tmp_path / "downloads" / "file.bin.part").exists()
+
+
+def test_client_handles_missing_and_empty_files(server, tmp_path):
+    file_server, _ = server
+    (tmp_path / "publicFiles" / "empty.bin").write_bytes(b"")
+    client = FileClient("127.0.0.1", file_server.port, download_dir=str(tmp_path / "downloads"))
+    assert not client.request_file("missing.bin")
+    assert client.request_file("empty.bin")
+    assert (tmp_path / "downloads" / "empty.bin").read_bytes() == b""
+
+
+def test_client_rejects_a_response_header_larger_than_its_buffer(tmp_path, capsys):
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        for _ in range(2):
+            conn, _ = listener.accept()
+            with conn:
+                if conn.recv(65536).startswith(b"HEAD"):
+                    conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n")
+                else:
+                    conn.sendall(b"HTTP/1.1 206 Partial Content\r\nX-Padding: " + b"a" * 4096)
+                    time.sleep(0.5)
+
+    threading.Thread(target=serve, daemon=True).start()
+    try:
+        client = FileClient(ip="127.0.0.1", port=listener.getsockname()[1], download_dir=str(tmp_path), buffer_size=1024)
+        assert not client.request_file("file.bin")
+    finally:
+        listener.close()
+    assert "Response header too large" in capsys.readouterr().out
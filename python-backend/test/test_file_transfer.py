@@ -0,0 +1,168 @@
+import hashlib
+import os
+import random
+import select
+import socket
+import threading
+
+import pytest
+
+import utils.FileTransfer as file_transfer_module
+from utils.FileTransfer import FileSender, FileReceiver, PreadFile, tune_socket_buffers, FRAME_DATA, \
+    FRAME_DATA_COMPRESSED, HEADER, MAGIC, VERSION, is_transfer_frame
+from utils.ManifestManager import CHUNK_SIZE, ManifestCache, ManifestManager
+from utils.MappedFileCache import MappedFileCache
+
+
+def make_file(path, size, compressible=False):
+    data = (b"0123456789abcdef" * (size // 16 + 1))[:size] if compressible else os.urandom(size)
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def lossy_proxy(target_addr, drop_rate, stop):
+    sender_side = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_side = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for sock in (sender_side, receiver_side):
+        tune_socket_buffers(sock)
+        sock.bind(("127.0.0.1", 0))
+    rng = random.Random(1234)
+
+    def forward():
+        sender_addr = None
+        while not stop.is_set():
+            readable, _, _ = select.select([sender_side, receiver_side], [], [], 0.1)
+            for sock in readable:
+                data, addr = sock.recvfrom(65535)
+                if sock is sender_side:
+                    sender_addr = addr
+                    if is_transfer_frame(data) and HEADER.unpack_from(data)[2] in (FRAME_DATA, FRAME_DATA_COMPRESSED) and rng.random() < drop_rate:
+                        continue
+                    receiver_side.sendto(data, target_addr)
+                elif sender_addr:
+                    sender_side.sendto(data, sender_addr)
+        sender_side.close()
+        receiver_side.close()
+
+    threading.Thread(target=forward, daemon=True).start()
+    return sender_side.getsockname()
+
+
+def transfer(tmp_path, size, drop_rate=0.0, compression=None, **sender_options):
+    source = tmp_path / "source.bin"
+    destination = tmp_path / "downloads" / "source.bin"
+    file_hash = make_file(source, size, compressible=compression is not None)
+
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tune_socket_buffers(receiver_socket)
+    receiver_socket.bind(("127.0.0.1", 0))
+    stop = threading.Event()
+    reply_addr = receiver_socket.getsockname()
+    if drop_rate:
+        reply_addr = lossy_proxy(reply_addr, drop_rate, stop)
+
+    try:
+        FileSender(str(source), file_hash, reply_addr, compression=compression, **sender_options).start()
+        ok = FileReceiver(receiver_socket, "127.0.0.1", file_hash, str(destination), idle_timeout=10).receive()
+    finally:
+        stop.set()
+        receiver_socket.close()
+    return ok, source, destination
+
+
+def test_transfer_spans_multiple_chunks(tmp_path):
+    ok, source, destination = transfer(tmp_path, 3 * CHUNK_SIZE + 12345)
+    assert ok
+    assert destination.read_bytes() == source.read_bytes()
+    assert not os.path.exists(str(destination) + ".part")
+
+
+def test_transfer_empty_file(tmp_path):
+    ok, _, destination = transfer(tmp_path, 0)
+    assert ok
+    assert destination.read_bytes() == b""
+
+
+def test_transfer_recovers_from_packet_loss(tmp_path):
+    ok, source, destination = transfer(tmp_path, 2 * CHUNK_SIZE + 777, drop_rate=0.05)
+    assert ok
+    assert destination.read_bytes() == source.read_bytes()
+
+
+def test_compressed_transfer_recovers_from_packet_loss(tmp_path):
+    ok, source, destination = transfer(tmp_path, 2 * CHUNK_SIZE + 777, drop_rate=0.05, compression=["zlib"])
+    assert ok
+    assert destination.read_bytes() == source.read_bytes()
+
+
+def test_only_immutable_files_are_mapped(tmp_path):
+    cache = MappedFileCache()
+    (tmp_path / "share").mkdir()
+    (tmp_path / "store").mkdir()
+    ok, _, _ = transfer(tmp_path / "share", CHUNK_SIZE + 5, file_cache=cache)
+    assert ok and cache.misses == 0
+    ok, _, _ = transfer(tmp_path / "store", CHUNK_SIZE + 5, file_cache=cache, immutable=True)
+    assert ok and cache.misses == 1
+
+
+def test_share_file_truncated_mid_send_reads_short_instead_of_faulting(tmp_path):
+    path = tmp_path / "shared.bin"
+    path.write_bytes(os.urandom(4 * CHUNK_SIZE))
+    source = PreadFile(str(path))
+    try:
+        # Saving over the file, as an editor would, while a peer is downloading it.
+        open(path, "wb").close()
+        with pytest.raises(OSError):
+            source.read(3 * CHUNK_SIZE, CHUNK_SIZE)
+    finally:
+        source.close()
+
+
+def test_partial_transfer_is_checked_against_the_manifest_not_the_file_hash(tmp_path, monkeypatch):
+    source = tmp_path / "source.bin"
+    file_hash = make_file(source, 3 * CHUNK_SIZE + 5)
+    manifest = ManifestManager.generate_file_manifest(str(source), cache=ManifestCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(file_transfer_module, "hash_file", lambda path: pytest.fail("whole file hashed for a partial transfer"))
+
+    def receive(chunks, manifest):
+        receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        tune_socket_buffers(receiver_socket)
+        receiver_socket.bind(("127.0.0.1", 0))
+        try:
+            FileSender(str(source), file_hash, receiver_socket.getsockname(), chunks=chunks).start()
+            return FileReceiver(receiver_socket, "127.0.0.1", file_hash, str(tmp_path / "out.bin"), idle_timeout=10,
+                                manifest=manifest).receive()
+        finally:
+            receiver_socket.close()
+
+    assert receive([1, 3], manifest)
+    data = source.read_bytes()
+    received = (tmp_path / "out.bin").read_bytes()
+    assert received[CHUNK_SIZE:2 * CHUNK_SIZE] == data[CHUNK_SIZE:2 * CHUNK_SIZE] and received[-5:] == data[-5:]
+    assert not receive([1, 3], dict(manifest, chunks=manifest["chunks"][::-1]))
+    assert not receive([1], None)
+
+
+class MisplacingSender(FileSender):
+    # Sends every frame first with the offset of another frame, then cut short, then as it should be.
+    def _send_frame(self, sock, source, seq):
+        offset, length = self.frames[seq]
+        elsewhere = self.frames[seq + 1][0] if seq + 1 < len(self.frames) else 0
+        sock.sendto(HEADER.pack(MAGIC, VERSION, FRAME_DATA, self.transfer_id, seq, elsewhere) + bytes(length), self.reply_addr)
+        sock.sendto(HEADER.pack(MAGIC, VERSION, FRAME_DATA, self.transfer_id, seq, offset) + bytes(length - 1), self.reply_addr)
+        super()._send_frame(sock, source, seq)
+
+
+def test_frames_not_matching_their_sequence_number_are_dropped(tmp_path):
+    source = tmp_path / "source.bin"
+    file_hash = make_file(source, CHUNK_SIZE + 5)
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tune_socket_buffers(receiver_socket)
+    receiver_socket.bind(("127.0.0.1", 0))
+    try:
+        MisplacingSender(str(source), file_hash, receiver_socket.getsockname()).start()
+        assert FileReceiver(receiver_socket, "127.0.0.1", file_hash, str(tmp_path / "out.bin"), idle_timeout=10).receive()
+    finally:
+        receiver_socket.close()
+    assert (tmp_path / "out.bin").read_bytes() == source.read_bytes()
@@ -0,0 +1,80 @@
+import hashlib
+import os
+
+import pytest
+
+import utils.ManifestManager as manifest_module
+from utils.ManifestManager import CHUNK_SIZE, ManifestCache, ManifestManager, merkle_root, verify_chunk
+
+
+def test_manifest_has_chunk_hashes_and_merkle_root(tmp_path):
+    data = os.urandom(2 * CHUNK_SIZE + 100)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+
+    manifest = ManifestManager.generate_file_manifest(str(path), cache=ManifestCache(str(tmp_path / "cache")))
+
+    expected_chunks = [hashlib.sha256(data[i:i + CHUNK_SIZE]).hexdigest() for i in range(0, len(data), CHUNK_SIZE)]
+    assert manifest["sha256"] == hashlib.sha256(data).hexdigest()
+    assert manifest["chunk_count"] == 3
+    assert manifest["chunks"] == expected_chunks
+    assert manifest["merkle_root"] == merkle_root(expected_chunks)
+    assert verify_chunk(manifest, 1, data[CHUNK_SIZE:2 * CHUNK_SIZE])
+    assert not verify_chunk(manifest, 0, data[CHUNK_SIZE:2 * CHUNK_SIZE])
+
+
+def test_merkle_root_shapes():
+    leaves = [hashlib.sha256(bytes([i])).hexdigest() for i in range(3)]
+    left = hashlib.sha256(bytes.fromhex(leaves[0]) + bytes.fromhex(leaves[1])).digest()
+    assert merkle_root(leaves) == hashlib.sha256(left + bytes.fromhex(leaves[2])).hexdigest()
+    assert merkle_root(leaves[:1]) == leaves[0]
+    assert merkle_root([]) == hashlib.sha256(b"").hexdigest()
+
+
+def test_unchanged_files_come_from_cache(tmp_path, monkeypatch):
+    cache = ManifestCache(str(tmp_path / "cache"))
+    paths = []
+    for name in ("a.txt", "b.txt"):
+        path = tmp_path / name
+        path.write_bytes(name.encode() * 1000)
+        paths.append(str(path))
+    first = ManifestManager.generate_manifests(paths, cache=cache)
+
+    monkeypatch.setattr(manifest_module, "get_hash_pool", lambda: pytest.fail("cached manifest was rehashed"))
+    assert ManifestManager.generate_manifests(paths, cache=cache) == first
+
+    with open(paths[0], "ab") as f:
+        f.write(b"changed")
+    with pytest.raises(pytest.fail.Exception):
+        ManifestManager.generate_manifests(paths, cache=cache)
+
+
+def test_known_hash_skips_whole_file_pass(tmp_path):
+    path = tmp_path / "empty.bin"
+    path.write_bytes(b"")
+    manifest = ManifestManager.generate_file_manifest(str(path), file_hash="f" * 64, cache=ManifestCache(str(tmp_path / "cache")))
+    assert manifest["sha256"] == "f" * 64
+    assert manifest["chunks"] == []
+    assert manifest["chunk_count"] == 0
+
+
+def test_cache_lives_next_to_the_share_and_prunes_stale_entries(tmp_path):
+    share = tmp_path / "share"
+    share.mkdir()
+    cache = ManifestCache.for_share(str(share))
+    assert cache.cache_dir == str(tmp_path / ".share_manifests")
+    for name in ("kept.bin", "edited.bin", "deleted.bin"):
+        (share / name).write_bytes(name.encode())
+        ManifestManager.generate_file_manifest(str(share / name), cache=cache)
+    with open(share / "edited.bin", "ab") as f:
+        f.write(b"more")
+    # Regenerating after an edit replaces the entry instead of adding a second one.
+    ManifestManager.generate_file_manifest(str(share / "edited.bin"), cache=cache)
+    assert len(os.listdir(cache.cache_dir)) == 3
+
+    with open(share / "edited.bin", "ab") as f:
+        f.write(b"again")
+    os.remove(share / "deleted.bin")
+    assert cache.prune() == 2
+    assert len(os.listdir(cache.cache_dir)) == 1
+    assert cache.get(str(share / "kept.bin"), os.stat(share / "kept.bin")) is not None
@@ -0,0 +1,57 @@
+import os
+
+from utils.MappedFileCache import MappedFileCache
+
+
+def write_files(tmp_path, count, size=4096):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"file-{i}.bin"
+        path.write_bytes(bytes([i]) * size)
+        paths.append(str(path))
+    return paths
+
+
+def test_repeated_opens_share_one_map(tmp_path):
+    path, = write_files(tmp_path, 1)
+    cache = MappedFileCache()
+    with cache.open(path) as first, cache.open(path) as second:
+        assert first is second and first.refs == 2
+        assert bytes(first.view[10:20]) == b"\x00" * 10
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert first.refs == 0 and not first.evicted
+
+
+def test_eviction_never_unmaps_files_in_use(tmp_path):
+    paths = write_files(tmp_path, 3)
+    cache = MappedFileCache(max_files=1)
+    in_use = cache.acquire(paths[0])
+    with cache.open(paths[1]) as other:
+        assert not in_use.evicted and bytes(in_use.view[:2]) == b"\x00\x00"
+    assert other.evicted and other.map.closed
+
+    # Over the limit while both are busy; the first one released goes.
+    newest = cache.acquire(paths[2])
+    cache.release(in_use)
+    assert in_use.evicted and in_use.map.closed
+    cache.release(newest)
+    assert not newest.evicted
+
+
+def test_changed_file_gets_a_fresh_map(tmp_path):
+    path, = write_files(tmp_path, 1)
+    cache = MappedFileCache()
+    with cache.open(path) as old:
+        with open(path, "ab") as f:
+            f.write(b"more")
+        os.utime(path, ns=(0, 0))
+        with cache.open(path) as new:
+            assert new is not old and new.size == old.size + 4
+        assert old.evicted and not old.map.closed
+    assert old.map.closed
+
+    cache.invalidate(path)
+    assert new.map.closed
+    (tmp_path / "empty").write_bytes(b"")
+    with cache.open(str(tmp_path / "empty")) as empty:
+        assert empty.size == 0 and bytes(empty.view) == b""
@@ -0,0 +1,124 @@
+import asyncio
+import gc
+import hashlib
+import json
+import os
+import socket
+import urllib.request
+
+import pytest
+import websockets
+
+from utils import websocket as websocket_module
+from utils.DiscoverPeers import DiscoverPeers, LOOKUP_SECONDS
+from utils.DownloadManager import DOWNLOAD_JOBS
+from utils.FileTransfer import ACTIVE_TRANSFERS, PEER_BYTES, FileReceiver, FileSender, tune_socket_buffers
+from utils.Metrics import MetricsRegistry, metrics
+from utils.ShareIndex import HASHED_BYTES, ShareIndex
+from utils.UdpEngine import PACKETS
+
+
+def value(metric, labels=()):
+    return metric.collect().get(labels, 0)
+
+
+def test_registry_renders_prometheus_text_and_snapshots():
+    registry = MetricsRegistry()
+    packets = registry.counter("packets_total", "Packets", ("type",))
+    packets.inc(("query_file",))
+    packets.inc(('say "hi"',), 2)
+    assert registry.counter("packets_total", "Packets", ("type",)) is packets
+    with pytest.raises(ValueError):
+        registry.gauge("packets_total", "Packets", ("type",))
+
+    latency = registry.histogram("lookup_seconds", "Lookups", buckets=(0.1, 1.0))
+    for seconds in (0.05, 0.05, 0.5, 3.0):
+        latency.observe(seconds)
+    text = registry.render_prometheus()
+    assert '# TYPE packets_total counter\npackets_total{type="query_file"} 1\npackets_total{type="say \\"hi\\""} 2' in text
+    assert 'lookup_seconds_bucket{le="0.1"} 2\nlookup_seconds_bucket{le="1"} 3\nlookup_seconds_bucket{le="+Inf"} 4' in text
+    assert "lookup_seconds_sum 3.6\nlookup_seconds_count 4\n" in text
+    [sample] = registry.snapshot()["lookup_seconds"]["samples"]
+    assert sample["count"] == 4 and sample["p50"] == 0.1 and 0.1 < sample["p90"] <= 1.0
+
+
+def test_tracked_gauges_sum_live_instances_and_forget_dead_ones():
+    registry = MetricsRegistry()
+    depth = registry.gauge("queue_depth", "Depth", ("queue",))
+
+    class Queue:
+        def __init__(self, size):
+            self.size = size
+
+        def depths(self):
+            return {("work",): self.size}
+
+    first, second = Queue(3), Queue(4)
+    depth.track(first.depths)
+    depth.track(second.depths)
+    with depth.in_progress(("busy",)):
+        assert depth.collect() == {("work",): 7, ("busy",): 1}
+    del second
+    gc.collect()
+    assert depth.collect() == {("work",): 3, ("busy",): 0}
+
+
+def test_hot_paths_feed_the_shared_registry(tmp_path):
+    data = os.urandom(300_000)
+    source = tmp_path / "source.bin"
+    source.write_bytes(data)
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tune_socket_buffers(receiver_socket)
+    receiver_socket.bind(("127.0.0.1", 0))
+    uploaded, downloaded = value(PEER_BYTES, ("127.0.0.1", "upload")), value(PEER_BYTES, ("127.0.0.1", "download"))
+    hashed = value(HASHED_BYTES)
+    try:
+        FileSender(str(source), hashlib.sha256(data).hexdigest(), receiver_socket.getsockname()).start()
+        receiver = FileReceiver(receiver_socket, "127.0.0.1", hashlib.sha256(data).hexdigest(),
+                                str(tmp_path / "out.bin"), idle_timeout=10)
+        assert receiver.receive()
+    finally:
+        receiver_socket.close()
+    assert value(PEER_BYTES, ("127.0.0.1", "download")) - downloaded >= len(data)
+    assert value(PEER_BYTES, ("127.0.0.1", "upload")) - uploaded >= len(data)
+    assert value(HASHED_BYTES) - hashed >= len(data)
+    assert value(ACTIVE_TRANSFERS, ("udp", "download")) == 0
+
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "x.bin").write_bytes(b"x")
+    peer = DiscoverPeers(0, ShareIndex(str(tmp_path / "a")))
+    peer.start_listening()
+    client = DiscoverPeers(0, ShareIndex(str(tmp_path / "client")))
+    queries, answers = value(PACKETS, ("in", "query_file")), value(PACKETS, ("in", "file_found_response"))
+    found_before = LOOKUP_SECONDS.collect().get(("file_holders", "found"), ([], 0.0, 0))[2]
+    assert client.find_file_holders("x.bin", timeout_duration=2.0, targets=[("127.0.0.1", peer.port)])
+    assert value(PACKETS, ("in", "query_file")) > queries and value(PACKETS, ("in", "file_found_response")) > answers
+    assert LOOKUP_SECONDS.collect()[("file_holders", "found")][2] == found_before + 1
+    assert {"dispatch", "lookup", "pending_requests"} <= {sample["labels"]["queue"]
+                                                          for sample in metrics.snapshot()["p2p_queue_depth"]["samples"]}
+
+
+def test_stats_over_websocket_and_prometheus_endpoint():
+    async def exchange():
+        websocket_module.shared_p2p_node_instance = object()
+        async with websockets.serve(websocket_module.handle_message, "127.0.0.1", 0,
+                                    process_request=websocket_module.serve_metrics) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}") as client:
+                await client.send("get_stats:")
+                everything = json.loads(await client.recv())
+                await client.send("get_stats:p2p_lookup")
+                lookups = json.loads(await client.recv())
+
+            def scrape():
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                    return response.headers["Content-Type"], response.read().decode()
+            return everything, lookups, await asyncio.to_thread(scrape)
+
+    everything, lookups, (content_type, text) = asyncio.run(exchange())
+    assert everything["type"] == "stats" and {"p2p_control_packets_total", "p2p_peer_bytes_total",
+                                              "p2p_hashed_bytes_total", "p2p_download_jobs"} <= set(everything["metrics"])
+    assert set(lookups["metrics"]) == {"p2p_lookup_seconds"}
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert "# TYPE p2p_lookup_seconds histogram" in text and "# TYPE p2p_control_packets_total counter" in text
+    assert DOWNLOAD_JOBS.name in text
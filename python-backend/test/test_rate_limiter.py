@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+import websockets
+
+from utils import websocket as websocket_module
+from utils.FileManager import FileClient, FileServer
+from utils.FileTransfer import FileReceiver, FileSender, tune_socket_buffers
+from utils.RateLimiter import RateLimiter, TokenBucket, parse_rate, rate_limiter
+from utils.ShareIndex import ShareIndex
+
+
+def test_parse_rate():
+    assert parse_rate("1.5M") == 1572864 and parse_rate("800k") == 819200 and parse_rate(2000) == 2000
+    assert parse_rate(None) is None and parse_rate(0) is None and parse_rate("none") is None
+    with pytest.raises(ValueError):
+        parse_rate(-1)
+
+
+def test_buckets_nest_and_follow_runtime_changes():
+    limiter = RateLimiter(upload="1M")
+    with pytest.raises(ValueError):
+        limiter.configure(uplaod=1)
+    first = limiter.uploader("10.0.0.1")
+    second = limiter.uploader("10.0.0.2")
+    # The global bucket is shared: one transfer's burst is the other's wait.
+    assert first.delay(512 * 1024) < 0.6 < second.delay(512 * 1024)
+    capped = limiter.uploader("10.0.0.1", requested=100_000)
+    assert capped.transfer_bucket.rate == 100_000 and first.transfer_bucket.rate is None
+
+    limiter.configure(transfer_upload=50_000, peer_upload="200K")
+    assert first.transfer_bucket.rate == 50_000 and capped.transfer_bucket.rate == 50_000
+    assert capped.buckets[1] is first.buckets[1] and first.buckets[1].rate == 200 * 1024
+    limiter.configure(upload=None, peer_upload=0, transfer_upload=None)
+    assert not limiter.uploader("10.0.0.3").limited and capped.transfer_bucket.rate == 100_000
+
+
+def test_control_traffic_is_charged_but_never_waits():
+    limiter = RateLimiter(upload=100_000)
+    bulk = limiter.uploader("10.0.0.1")
+    limiter.charge_control(50_000)
+    assert bulk.delay(10_000) > 0.5
+    bucket = TokenBucket(None)
+    assert bucket.reserve(10 ** 9) == 0.0
+
+
+def test_udp_transfer_paces_to_the_requested_rate(tmp_path):
+    data = os.urandom(512 * 1024)
+    source = tmp_path / "source.bin"
+    source.write_bytes(data)
+    file_hash = hashlib.sha256(data).hexdigest()
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tune_socket_buffers(receiver_socket)
+    receiver_socket.bind(("127.0.0.1", 0))
+    started = time.monotonic()
+    try:
+        FileSender(str(source), file_hash, receiver_socket.getsockname(), rate_limiter=RateLimiter(),
+                   rate=2 * 1024 * 1024).start()
+        receiver = FileReceiver(receiver_socket, "127.0.0.1", file_hash, str(tmp_path / "out.bin"), idle_timeout=10,
+                                rate_limiter=RateLimiter())
+        assert receiver.receive()
+    finally:
+        receiver_socket.close()
+    assert (tmp_path / "out.bin").read_bytes() == data
+    assert time.monotonic() - started > 0.2
+
+
+def test_http_uploads_and_downloads_are_shaped(tmp_path):
+    shared = tmp_path / "publicFiles"
+    shared.mkdir()
+    data = os.urandom(400_000)
+    (shared / "file.bin").write_bytes(data)
+    file_server = FileServer("127.0.0.1", 0, share_index=ShareIndex(str(shared)), rate_limiter=RateLimiter(upload=1_000_000))
+    threading.Thread(target=file_server.start_server, daemon=True).start()
+    while not file_server.running:
+        time.sleep(0.01)
+    try:
+        for client_limiter in (RateLimiter(), RateLimiter(download=500_000)):
+            file_server.rate_limiter.configure(upload=None if client_limiter.limits['download'] else 1_000_000)
+            client = FileClient("127.0.0.1", file_server.port, download_dir=str(tmp_path / "downloads"),
+                                range_size=100_000, rate_limiter=client_limiter)
+            started = time.monotonic()
+            assert client.request_file("file.bin")
+            assert (tmp_path / "downloads" / "file.bin").read_bytes() == data
+            assert time.monotonic() - started > 0.25
+    finally:
+        file_server.stop_server()
+
+
+def test_rate_limits_websocket_command():
+    async def exchange():
+        websocket_module.shared_p2p_node_instance = object()
+        async with websockets.serve(websocket_module.handle_message, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}") as client:
+                await client.send('set_rate_limits:{"upload": "2M", "peer_download": 300000}')
+                changed = json.loads(await client.recv())
+                await client.send('set_rate_limits:{"bogus": 1}')
+                rejected = json.loads(await client.recv())
+                await client.send("get_rate_limits:")
+                return changed, rejected, json.loads(await client.recv())
+
+    try:
+        changed, rejected, current = asyncio.run(exchange())
+    finally:
+        rate_limiter.configure(upload=None, peer_download=None)
+    assert changed == current and changed["type"] == "rate_limits"
+    assert changed["limits"]["upload"] == 2 * 1024 * 1024 and changed["limits"]["peer_download"] == 300000
+    assert "error" in rejected
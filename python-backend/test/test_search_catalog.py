@@ -0,0 +1,80 @@
+import os
+
+from utils.DiscoverPeers import DiscoverPeers
+from utils.SearchCatalog import RANK_EXACT, RANK_PREFIX, RANK_SUBSTRING, SearchCatalog, search_filters
+from utils.ShareIndex import ShareIndex
+
+
+def make_share(directory, files):
+    directory.mkdir()
+    for name, data in files.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return ShareIndex(str(directory))
+
+
+def names(results):
+    return [result['name'] for result in results]
+
+
+def test_catalog_follows_share_changes(tmp_path):
+    share = tmp_path / "shared"
+    index = make_share(share, {"report.pdf": b"r" * 10, "notes/report-draft.txt": b"d" * 5})
+    catalog = SearchCatalog(index)
+    results, has_more = catalog.search("report")
+    assert sorted(names(results)) == ["report-draft.txt", "report.pdf"] and not has_more
+    assert {result['path'] for result in results} == {"report.pdf", os.path.join("notes", "report-draft.txt")}
+
+    os.remove(share / "report.pdf")
+    (share / "annual report.pdf").write_bytes(b"a" * 20)
+    index.refresh(force=True)
+    assert catalog.sync() == 2
+    assert sorted(names(catalog.search("report")[0])) == ["annual report.pdf", "report-draft.txt"]
+
+    # A fresh catalog over the same database only writes what changed while it was closed.
+    catalog.close()
+    reopened = SearchCatalog(index)
+    assert reopened.sync() == 0 and len(reopened.search("report")[0]) == 2
+
+
+def test_ranking_filters_and_paging(tmp_path):
+    index = make_share(tmp_path / "shared", {
+        "my song.mp3": b"m" * 300, "song.mp3": b"s" * 100, "songbook.pdf": b"b" * 200, "Song Of Ice.MP3": b"i" * 50,
+        "ab.txt": b"x", "cab.txt": b"xx",
+    })
+    catalog = SearchCatalog(index)
+
+    results, _ = catalog.search("SONG")
+    assert names(results) == ["song.mp3", "songbook.pdf", "Song Of Ice.MP3", "my song.mp3"]
+    assert [result['rank'] for result in results] == [RANK_EXACT, RANK_PREFIX, RANK_PREFIX, RANK_SUBSTRING]
+
+    assert names(catalog.search("song", extensions=["MP3"], min_size=60)[0]) == ["song.mp3", "my song.mp3"]
+    # Two-letter terms are below the trigram length and go through LIKE.
+    assert names(catalog.search("ab")[0]) == ["ab.txt", "cab.txt"]
+    assert names(catalog.search("", extensions=["mp3"])[0]) == ["my song.mp3", "song.mp3", "Song Of Ice.MP3"]
+
+    first, more = catalog.search("song", limit=3)
+    rest, no_more = catalog.search("song", limit=3, offset=3)
+    assert more and not no_more and names(first + rest) == names(results)
+
+    assert search_filters({'extensions': ".PDF", 'min_size': "5", 'ignored': 1}) == {'extensions': ["pdf"], 'min_size': 5}
+
+
+def test_search_merges_results_across_peers(tmp_path):
+    peers = []
+    for name, files in (("a", {"holiday.jpg": b"same", "holiday notes.txt": b"n"}), ("b", {"holiday.jpg": b"same"})):
+        peer = DiscoverPeers(0, make_share(tmp_path / name, files))
+        peer.start_listening()
+        peers.append(peer)
+    (tmp_path / "searcher").mkdir()
+    searcher = DiscoverPeers(0, ShareIndex(str(tmp_path / "searcher")))
+    targets = [("127.0.0.1", peer.port) for peer in peers]
+
+    results, has_more = searcher.search("holiday", timeout_duration=2.0, targets=targets)
+    assert names(results) == ["holiday.jpg", "holiday notes.txt"] and not has_more
+    assert sorted(results[0]['sources']) == sorted(targets) and results[1]['sources'] == [targets[0]]
+
+    page, more = searcher.search("holiday", limit=1, timeout_duration=2.0, targets=targets)
+    assert names(page) == ["holiday.jpg"] and more
+    assert searcher.search("holiday", {'extensions': ["txt"]}, timeout_duration=2.0, targets=targets)[0][0]['name'] == "holiday notes.txt"
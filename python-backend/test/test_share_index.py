@@ -0,0 +1,86 @@
+import hashlib
+import os
+
+import utils.ShareIndex as share_index_module
+from utils.ShareIndex import ShareIndex
+
+
+def counting_hash(monkeypatch):
+    calls = []
+    original = share_index_module.hash_file
+
+    def wrapper(path):
+        calls.append(path)
+        return original(path)
+
+    monkeypatch.setattr(share_index_module, "hash_file", wrapper)
+    return calls
+
+
+def test_lookups_by_name_and_hash(tmp_path):
+    shared = tmp_path / "publicFiles"
+    (shared / "sub").mkdir(parents=True)
+    (shared / "a.txt").write_bytes(b"alpha")
+    (shared / "sub" / "b.txt").write_bytes(b"beta")
+    (shared / "c.txt.part").write_bytes(b"in progress")
+
+    index = ShareIndex(str(shared))
+    index.refresh(force=True)
+
+    alpha_hash = hashlib.sha256(b"alpha").hexdigest()
+    assert index.hash_for_name("a.txt") == alpha_hash
+    assert index.path_for_hash(alpha_hash) == str(shared / "a.txt")
+    assert index.hash_for_name("b.txt") == hashlib.sha256(b"beta").hexdigest()
+    assert index.hash_for_name("c.txt.part") is None
+
+
+def test_only_changed_files_are_rehashed(tmp_path, monkeypatch):
+    shared = tmp_path / "publicFiles"
+    shared.mkdir()
+    (shared / "a.txt").write_bytes(b"alpha")
+    (shared / "b.txt").write_bytes(b"beta")
+    calls = counting_hash(monkeypatch)
+
+    index = ShareIndex(str(shared))
+    index.refresh(force=True)
+    assert len(calls) == 2
+
+    (shared / "b.txt").write_bytes(b"beta, longer now")
+    os.remove(shared / "a.txt")
+    index.refresh(force=True)
+    assert calls[2:] == [str(shared / "b.txt")]
+    assert index.hash_for_name("a.txt") is None
+    assert index.hash_for_name("b.txt") == hashlib.sha256(b"beta, longer now").hexdigest()
+
+
+def test_index_is_persisted_between_instances(tmp_path, monkeypatch):
+    shared = tmp_path / "publicFiles"
+    shared.mkdir()
+    (shared / "a.txt").write_bytes(b"alpha")
+    ShareIndex(str(shared)).refresh(force=True)
+
+    calls = counting_hash(monkeypatch)
+    index = ShareIndex(str(shared))
+    assert index.hash_for_name("a.txt") == hashlib.sha256(b"alpha").hexdigest()
+    index.refresh(force=True)
+    assert calls == []
+
+
+def test_rename_rehashes_a_file_written_before_the_move(tmp_path, monkeypatch):
+    shared = tmp_path / "publicFiles"
+    shared.mkdir()
+    (shared / "a.txt").write_bytes(b"first")
+    (shared / "c.txt").write_bytes(b"third")
+    index = ShareIndex(str(shared))
+    index.refresh(force=True)
+    calls = counting_hash(monkeypatch)
+
+    os.rename(shared / "c.txt", shared / "d.txt")
+    assert index.rename_path(str(shared / "c.txt"), str(shared / "d.txt"))
+    assert calls == [] and index.by_name["d.txt"] == hashlib.sha256(b"third").hexdigest()
+
+    # Write then mv, the way editors and rsync save atomically.
+    (shared / "a.txt").write_bytes(b"edited")
+    os.rename(shared / "a.txt", shared / "b.txt")
+    assert index.rename_path(str(shared / "a.txt"), str(shared / "b.txt"))
+    assert "a.txt" not in index.by_name and index.by_name["b.txt"] == hashlib.sha256(b"edited").hexdigest()
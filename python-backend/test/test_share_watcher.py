@@ -0,0 +1,81 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from utils.ShareIndex import ShareIndex
+from utils.ShareWatcher import ShareWatcher, InotifyBackend, PollingBackend
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+@pytest.fixture(params=["inotify", "polling"])
+def watched(request, tmp_path):
+    if request.param == "inotify" and not sys.platform.startswith("linux"):
+        pytest.skip("inotify is Linux only")
+    shared = tmp_path / "publicFiles"
+    shared.mkdir()
+    index = ShareIndex(str(shared))
+    watcher = ShareWatcher(index, debounce=0.05, poll_interval=0.1, flush_interval=0.1,
+                           use_inotify=request.param == "inotify")
+    watcher.start()
+    expected_backend = InotifyBackend if request.param == "inotify" else PollingBackend
+    assert isinstance(watcher.backend, expected_backend)
+    yield shared, index
+    watcher.stop()
+
+
+def test_watcher_tracks_create_modify_rename_delete(watched):
+    shared, index = watched
+    digest = hashlib.sha256(b"first").hexdigest()
+
+    (shared / "a.txt").write_bytes(b"first")
+    assert wait_for(lambda: index.by_name.get("a.txt") == digest)
+
+    (shared / "a.txt").write_bytes(b"second")
+    assert wait_for(lambda: index.by_name.get("a.txt") == hashlib.sha256(b"second").hexdigest())
+
+    os.rename(shared / "a.txt", shared / "b.txt")
+    assert wait_for(lambda: "a.txt" not in index.by_name and "b.txt" in index.by_name)
+
+    os.remove(shared / "b.txt")
+    assert wait_for(lambda: not index.by_name)
+
+
+
+def test_watcher_rehashes_a_file_written_then_renamed(watched):
+    shared, index = watched
+    (shared / "draft.txt").write_bytes(b"first")
+    assert wait_for(lambda: index.by_name.get("draft.txt") == hashlib.sha256(b"first").hexdigest())
+
+    # Renamed while the write is still inside its debounce window.
+    (shared / "draft.txt").write_bytes(b"second")
+    os.rename(shared / "draft.txt", shared / "final.txt")
+    assert wait_for(lambda: index.by_name.get("final.txt") == hashlib.sha256(b"second").hexdigest())
+    assert "draft.txt" not in index.by_name
+
+def test_watcher_indexes_new_directories(watched):
+    shared, index = watched
+    nested = shared / "nested" / "deeper"
+    nested.mkdir(parents=True)
+    (nested / "c.txt").write_bytes(b"nested")
+    assert wait_for(lambda: index.by_name.get("c.txt") == hashlib.sha256(b"nested").hexdigest())
+
+
+def test_lookups_do_not_walk_while_watching(watched, monkeypatch):
+    _, index = watched
+    walking_threads = []
+    monkeypatch.setattr(index, "_refresh", lambda: walking_threads.append(threading.get_ident()) or False)
+    assert index.hash_for_name("missing.txt") is None
+    assert index.files() == {}
+    assert threading.get_ident() not in walking_threads
@@ -0,0 +1,53 @@
+import hashlib
+import os
+
+from utils.DiscoverPeers import DiscoverPeers
+from utils.ManifestManager import CHUNK_SIZE
+from utils.ShareIndex import ShareIndex
+from utils.SwarmDownloader import ChunkScheduler, SwarmDownload
+
+
+def test_scheduler_prefers_rarest_chunks():
+    scheduler = ChunkScheduler(4)
+    scheduler.add_source(("a", 1))
+    scheduler.add_source(("b", 1), have={2, 3})
+    assert scheduler.next_batch(("a", 1), 2) == [0, 1]
+    assert scheduler.next_batch(("b", 1), 1) == [2]
+
+
+def test_scheduler_endgame_duplicates_outstanding_chunks():
+    scheduler = ChunkScheduler(2)
+    scheduler.add_source(("a", 1))
+    scheduler.add_source(("b", 1))
+    assert scheduler.next_batch(("a", 1), 2) == [0, 1]
+    assert scheduler.next_batch(("b", 1), 2) == [0, 1]
+    scheduler.mark_done(0)
+    scheduler.mark_done(1)
+    assert scheduler.redundant_sources() == {("a", 1), ("b", 1)}
+    assert scheduler.is_complete()
+
+
+def start_seeder(tmp_path, name, data):
+    shared = tmp_path / name
+    shared.mkdir()
+    (shared / "file.bin").write_bytes(data)
+    node = DiscoverPeers(0, ShareIndex(str(shared)))
+    node.start_listening()
+    return node
+
+
+def test_swarm_download_from_several_seeders_despite_dead_source(tmp_path):
+    data = os.urandom(9 * CHUNK_SIZE + 321)
+    file_hash = hashlib.sha256(data).hexdigest()
+    seeders = [start_seeder(tmp_path, f"seed{i}", data) for i in range(3)]
+    downloader = DiscoverPeers(0, ShareIndex(str(tmp_path / "downloads")))
+
+    dead = DiscoverPeers(0, ShareIndex(str(tmp_path / "empty")))
+    sources = [("127.0.0.1", node.port) for node in seeders] + [("127.0.0.1", dead.port)]
+    destination = tmp_path / "downloads" / "file.bin"
+
+    swarm = SwarmDownload(downloader, file_hash, len(data), sources, str(destination), batch_timeout=0.5)
+    assert swarm.run()
+    assert destination.read_bytes() == data
+    assert swarm.stats[("127.0.0.1", dead.port)].bytes == 0
+    assert sum(1 for source in sources[:3] if swarm.stats[source].bytes) >= 2
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+
+import pytest
+import websockets
+
+from utils import websocket as websocket_module
+from utils.DiscoverPeers import DiscoverPeers
+from utils.ShareIndex import ShareIndex
+from utils.Tracer import MAX_ARGS, Tracer, tracer
+
+
+def test_ring_overwrites_the_oldest_records():
+    ring = Tracer(capacity=4)
+    channel = ring.channel("udp")
+    for i in range(6):
+        channel.info("received", i, ("10.0.0.1", 5003))
+    channel.warning("too_many_args", *range(MAX_ARGS + 2))
+    records, overwritten = ring.dump()
+    assert overwritten == 3 and [record["seq"] for record in records] == [3, 4, 5, 6]
+    assert records[0]["args"] == [3, "10.0.0.1:5003"] and records[-1]["args"] == list(range(MAX_ARGS))
+    assert [record["event"] for record in ring.dump(level=logging.WARNING)[0]] == ["too_many_args"]
+    assert len(ring.dump(limit=2)[0]) == 2 and ring.dump(subsystem="query")[0] == []
+
+
+def test_levels_and_sampling_are_per_subsystem():
+    ring = Tracer()
+    udp, query = ring.channel("udp"), ring.channel("query")
+    udp.debug("received", 1)
+    assert ring.dump()[0] == []
+
+    config = ring.configure(levels={"udp": "debug"}, sample={"udp": 10})
+    assert config == {"query": {"level": "info", "sample_every": 1}, "udp": {"level": "debug", "sample_every": 10}}
+    for i in range(25):
+        udp.debug("received", i)
+        query.info("query_file", i)
+    udp.debug("sent", 0)
+    udp.warning("undecodable", "always kept")
+    records = ring.dump()[0]
+    # One in ten of each event, starting with the first, so a rare event is never starved by a busy one.
+    assert [r["args"][0] for r in records if r["event"] == "received"] == [0, 10, 20]
+    assert sum(r["event"] == "query_file" for r in records) == 25
+    assert [r["event"] for r in records if r["subsystem"] == "udp"][-2:] == ["sent", "undecodable"]
+
+    with pytest.raises(ValueError):
+        ring.configure(levels={"udp": "info", "nonexistent": "debug"})
+    with pytest.raises(ValueError):
+        ring.configure(sample={"udp": 0})
+    assert ring.config()["udp"]["level"] == "debug"
+    ring.configure(levels={"*": "off"})
+    query.warning("ignored")
+    assert ring.dump()[0][-1]["event"] == "undecodable"
+
+
+def test_query_packets_are_traced_not_logged(tmp_path, caplog):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "x.bin").write_bytes(b"x")
+    peer = DiscoverPeers(0, ShareIndex(str(tmp_path / "a")))
+    peer.start_listening()
+    client = DiscoverPeers(0, ShareIndex(str(tmp_path / "client")))
+    with caplog.at_level(logging.INFO, logger="utils.DiscoverPeers"):
+        assert client.find_file_holders("x.bin", timeout_duration=2.0, targets=[("127.0.0.1", peer.port)])
+    assert not any("query_file" in record.getMessage() for record in caplog.records)
+    [record] = [r for r in tracer.dump(subsystem="query")[0]
+                if r["event"] == "query_file" and r["args"][0] == f"127.0.0.1:{client.port}"]
+    assert record["args"][1] == "x.bin"
+    assert record["args"][2] == peer.share_index.hash_for_name("x.bin")
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1"), reason="no SIGUSR1 on this platform")
+def test_signal_dumps_the_buffer_to_a_file(tmp_path):
+    ring = Tracer()
+    ring.channel("discovery").info("peer_seen", ("10.0.0.2", 5003))
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        ring.install_signal_handler(str(tmp_path))
+        os.kill(os.getpid(), signal.SIGUSR1)
+        deadline = time.monotonic() + 5
+        while not list(tmp_path.glob("trace-*.log")) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    [dump] = tmp_path.glob("trace-*.log")
+    assert dump.read_text().rstrip().endswith("discovery  info    peer_seen 10.0.0.2:5003")
+
+
+def test_trace_websocket_commands():
+    async def exchange():
+        websocket_module.shared_p2p_node_instance = object()
+        async with websockets.serve(websocket_module.handle_message, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}") as client:
+                replies = []
+                for message in ('set_trace_config:{"sample": {"websocket": 1}, "levels": {"websocket": "debug"}}',
+                                'set_trace_config:{"levels": {"websocket": "loud"}}',
+                                'dump_trace:{"subsystem": "websocket", "limit": 2}'):
+                    await client.send(message)
+                    replies.append(json.loads(await client.recv()))
+                return replies
+
+    try:
+        configured, rejected, dumped = asyncio.run(exchange())
+    finally:
+        tracer.configure(levels={"websocket": "info"})
+    assert configured["type"] == "trace_config" and configured["channels"]["websocket"]["level"] == "debug"
+    assert "error" in rejected
+    assert dumped["type"] == "trace" and [r["args"][1] for r in dumped["records"]] == ["set_trace_config", "dump_trace"]
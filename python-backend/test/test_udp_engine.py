@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from utils.DiscoverPeers import DiscoverPeers
+from utils.ShareIndex import ShareIndex
+from utils.UdpEngine import PACKETS, UdpEngine
+
+
+def start_peer(directory, files):
+    directory.mkdir()
+    for name, data in files.items():
+        (directory / name).write_bytes(data)
+    peer = DiscoverPeers(0, ShareIndex(str(directory)))
+    peer.start_listening()
+    return peer
+
+
+def test_concurrent_requests_share_one_socket(tmp_path):
+    files = {f"file-{i}.bin": bytes([i]) * 32 for i in range(20)}
+    peer = start_peer(tmp_path / "peer", files)
+    client = start_peer(tmp_path / "client", {})
+    target = [("127.0.0.1", peer.port)]
+
+    async def search_all():
+        return await asyncio.gather(*(client.find_file_holders_async(name, timeout_duration=2.0, targets=target)
+                                      for name in list(files) + ["missing.bin"]))
+
+    results = asyncio.run_coroutine_threadsafe(search_all(), client.loop).result()
+    assert [len(holders) for holders in results] == [1] * len(files) + [0]
+    assert [holders[0][2] for holders in results[:-1]] == [peer.share_index.hash_for_name(name) for name in files]
+    assert client.engine._pending == {}
+
+
+def test_slow_handler_does_not_stall_queries(tmp_path):
+    peer = start_peer(tmp_path / "peer", {"quick.bin": b"q"})
+    client = start_peer(tmp_path / "client", {})
+    peer.share_index.refresh(force=True)
+    handler, executor = peer._handlers['get_manifest']
+    peer._handlers['get_manifest'] = (lambda message, addr: (time.sleep(1.5), handler(message, addr)), executor)
+
+    manifest = asyncio.run_coroutine_threadsafe(
+        client.fetch_manifest_async("127.0.0.1", peer.port, peer.share_index.hash_for_name("quick.bin"), 5.0), client.loop)
+    started = time.monotonic()
+    holders = client.find_file_holders("quick.bin", timeout_duration=2.0, targets=[("127.0.0.1", peer.port)])
+    assert time.monotonic() - started < 0.5
+    assert len(holders) == 1
+    assert manifest.result()["chunk_count"] == 1
+
+
+def test_malformed_type_or_request_id_is_dropped():
+    dispatched = []
+    engine = UdpEngine(lambda message, addr: dispatched.append(message))
+    invalid = PACKETS.collect().get(("in", "invalid"), 0)
+    for data in (b'{"type": []}', b'{"type": {"a": 1}}', b'{"type": "x", "request_id": [1]}', b'[1, 2]', b'"type"'):
+        engine.datagram_received(data, ("127.0.0.1", 9))
+    engine.datagram_received(b'{"type": "x", "request_id": 7}', ("127.0.0.1", 9))
+    assert PACKETS.collect()[("in", "invalid")] == invalid + 5
+    assert dispatched == [{"type": "x", "request_id": 7}]
+
+
+def test_requests_reusing_an_outstanding_id_are_still_answered(tmp_path):
+    # Both nodes pick the same id for their concurrent lookups, as per-node counters used to.
+    alice = start_peer(tmp_path / "alice", {"from-alice.bin": b"a" * 64})
+    bob = start_peer(tmp_path / "bob", {"from-bob.bin": b"b" * 64})
+    for node in (alice, bob):
+        node.engine._new_request_id = lambda: 1
+
+    async def lookup(node, name, peer):
+        return await node.find_file_holders_async(name, timeout_duration=2.0, targets=[("127.0.0.1", peer.port)])
+
+    alice_lookup = asyncio.run_coroutine_threadsafe(lookup(alice, "from-bob.bin", bob), alice.loop)
+    bob_lookup = asyncio.run_coroutine_threadsafe(lookup(bob, "from-alice.bin", alice), bob.loop)
+    assert [holder[2] for holder in alice_lookup.result()] == [bob.share_index.hash_for_name("from-bob.bin")]
+    assert [holder[2] for holder in bob_lookup.result()] == [alice.share_index.hash_for_name("from-alice.bin")]
+
+
+def test_only_responses_from_the_asked_peer_complete_a_request():
+    dispatched = []
+    engine = UdpEngine(lambda message, addr: dispatched.append(message))
+    engine.loop = asyncio.new_event_loop()
+    try:
+        with engine.pending(peers=[("127.0.0.1", 5000)]) as (request_id, request):
+            assert request_id != 0
+            engine.datagram_received(b'{"type": "search", "request_id": %d}' % request_id, ("127.0.0.1", 5000))
+            engine.datagram_received(b'{"type": "manifest_response", "request_id": %d}' % request_id, ("127.0.0.1", 5001))
+            assert not request.future.done()
+            engine.datagram_received(b'{"type": "manifest_response", "request_id": %d}' % request_id, ("127.0.0.1", 5000))
+            assert request.future.result()[1] == ("127.0.0.1", 5000)
+    finally:
+        engine.loop.close()
+    assert dispatched == [{"type": "search", "request_id": request_id}]
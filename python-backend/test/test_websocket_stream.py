@@ -0,0 +1,55 @@
+import asyncio
+import hashlib
+import json
+import os
+
+import websockets
+
+from utils import websocket as websocket_module
+
+
+class StubDiscovery:
+    def __init__(self, local_files):
+        self.local_files = local_files
+        self.peers = []
+
+
+class StubNode:
+    def __init__(self, local_files):
+        self.peer_discovery = StubDiscovery(local_files)
+
+
+async def stream(node, filename):
+    websocket_module.shared_p2p_node_instance = node
+    async with websockets.serve(websocket_module.handle_message, "127.0.0.1", 0, max_size=None,
+                                write_limit=websocket_module.STREAM_WRITE_LIMIT) as server:
+        port = server.sockets[0].getsockname()[1]
+        async with websockets.connect(f"ws://127.0.0.1:{port}", max_size=None) as client:
+            await client.send(f"serve_file:{filename}")
+            messages = [json.loads(await client.recv())]
+            if messages[0].get("type") != "file_stream_start":
+                return messages, b""
+            chunks = []
+            while isinstance(message := await client.recv(), bytes):
+                chunks.append(message)
+            messages.append(json.loads(message))
+            return messages, chunks
+
+
+def test_serve_file_streams_binary_chunks(tmp_path):
+    data = os.urandom(int(2.5 * websocket_module.CHUNK_SIZE))
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    (start, end), chunks = asyncio.run(stream(StubNode({file_hash: str(path)}), "video.mp4"))
+
+    assert start["file_name"] == "video.mp4" and start["file_format"] == "mp4"
+    assert start["size"] == len(data) and start["chunk_count"] == 3 == len(chunks)
+    assert b"".join(chunks) == data
+    assert end == {"type": "file_stream_end", "file_hash": file_hash, "bytes_sent": len(data)}
+
+
+def test_serve_file_reports_missing_file(tmp_path):
+    messages, _ = asyncio.run(stream(StubNode({}), "missing.bin"))
+    assert messages == [{"status": "file_not_found_locally", "filename": "missing.bin"}]
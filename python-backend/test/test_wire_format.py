@@ -0,0 +1,64 @@
+import json
+import socket
+
+import pytest
+
+from utils.DiscoverPeers import DiscoverPeers
+from utils.ShareIndex import ShareIndex
+from utils.WireFormat import decode_message, encode_message, is_control_frame
+
+DIGEST = "ab" * 32
+
+MESSAGES = [
+    {'type': 'discover', 'port': 5003, 'node_id': "0123456789abcdef", 'capabilities': ['chunks', 'nack', 'binary'],
+     'ts': 12.5, 'index_version': 4, 'interval': 2.0, 'hello': True},
+    {'type': 'peer_info', 'port': 5003, 'node_id': "0123456789abcdef", 'capabilities': ['summary'],
+     'echo_ts': None, 'index_version': None, 'interval': 32.0},
+    {'type': 'query_file', 'filename': "şarkı.mp3", 'reply_port': 40000, 'nack': True},
+    {'type': 'file_found_response', 'filename': "a.bin", 'file_hash': DIGEST, 'size': 10, 'port': 5003},
+    {'type': 'file_not_found_response', 'filename': "a.bin", 'port': 5003},
+    {'type': 'receive_file', 'file_hash': DIGEST, 'port': 41000, 'chunks': [0, 7, 70000]},
+    {'type': 'receive_file', 'file_hash': DIGEST, 'port': 41000},
+    {'type': 'receive_file', 'file_hash': DIGEST, 'port': 41000, 'chunks': [3], 'compression': ['zlib', 'zstd']},
+    {'type': 'receive_file', 'file_hash': DIGEST, 'port': 41000, 'compression': ['lzma'], 'rate': 2_000_000},
+    {'type': 'query_files', 'reply_port': 40000, 'nack': False, 'part': 3, 'names': ["a", "b/c.txt"], 'hashes': [DIGEST]},
+    {'type': 'query_files_response', 'port': 5003, 'part': 3, 'last': True,
+     'found': [{'hash': DIGEST, 'size': 1, 'name': "a"}, {'hash': DIGEST, 'size': None}]},
+]
+
+
+@pytest.mark.parametrize("message", MESSAGES, ids=lambda m: m['type'])
+def test_control_messages_round_trip(message):
+    encoded = encode_message({**message, 'request_id': 99})
+    assert is_control_frame(encoded) and len(encoded) < len(json.dumps(message))
+    assert decode_message(encoded) == {**message, 'request_id': 99, 'binary': True}
+
+
+def test_messages_without_binary_form_fall_back_to_json():
+    assert encode_message({'type': 'get_summary', 'port': 1}) is None
+    assert encode_message({'type': 'receive_file', 'file_hash': "not-a-digest", 'port': 1}) is None
+    with pytest.raises(ValueError):
+        decode_message(b"PC\x09\x01" + bytes(8))
+
+
+def test_peers_answer_in_the_format_they_were_asked(tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    (shared / "song.mp3").write_bytes(b"la" * 100)
+    peer = DiscoverPeers(0, ShareIndex(str(shared)))
+    peer.start_listening()
+    file_hash = peer.share_index.hash_for_name("song.mp3")
+
+    old_node = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    old_node.bind(("127.0.0.1", 0))
+    old_node.settimeout(2.0)
+    query = {'type': 'query_file', 'filename': "song.mp3", 'reply_port': old_node.getsockname()[1], 'nack': True}
+
+    old_node.sendto(json.dumps(query).encode(), ("127.0.0.1", peer.port))
+    response = json.loads(old_node.recv(65535))
+    assert response['type'] == 'file_found_response' and response['file_hash'] == file_hash
+
+    old_node.sendto(encode_message({**query, 'request_id': 5}), ("127.0.0.1", peer.port))
+    response = decode_message(old_node.recv(65535))
+    assert response['file_hash'] == file_hash and response['request_id'] == 5 and response['size'] == 200
+    old_node.close()
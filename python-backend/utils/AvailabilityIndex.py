@@ -0,0 +1,116 @@
+import math
+import hashlib
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+PeerAddress = Tuple[str, int]
+
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+# A summary must fit one UDP datagram after base64; larger shares trade a higher false-positive rate for size.
+MAX_BLOOM_BYTES = 44 * 1024
+MAX_HASH_COUNT = 16
+# Tiny shares would otherwise get filters of a few bits that match almost everything.
+MIN_BLOOM_BITS = 1024
+
+
+def bloom_key_hashes(key: str) -> Tuple[int, int]:
+    digest = hashlib.sha256(key.encode()).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:16], "little") | 1
+
+
+def name_key(name: str) -> str:
+    return "n:" + name
+
+
+def hash_key(file_hash: str) -> str:
+    return "h:" + file_hash
+
+
+class BloomFilter:
+    def __init__(self, bit_count: int, hash_count: int, bits: bytearray | None = None):
+        self.bit_count = max(8, bit_count)
+        self.hash_count = max(1, min(hash_count, MAX_HASH_COUNT))
+        self.bits = bits if bits is not None else bytearray((self.bit_count + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, item_count: int, false_positive_rate: float = BLOOM_FALSE_POSITIVE_RATE) -> "BloomFilter":
+        item_count = max(1, item_count)
+        bit_count = int(math.ceil(-item_count * math.log(false_positive_rate) / math.log(2) ** 2))
+        bit_count = min(max(bit_count, MIN_BLOOM_BITS), MAX_BLOOM_BYTES * 8)
+        hash_count = int(round(bit_count / item_count * math.log(2)))
+        return cls(bit_count, hash_count)
+
+    def _positions(self, hashes: Tuple[int, int]):
+        h1, h2 = hashes
+        return ((h1 + i * h2) % self.bit_count for i in range(self.hash_count))
+
+    def add(self, key: str):
+        for position in self._positions(bloom_key_hashes(key)):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def contains_hashes(self, hashes: Tuple[int, int]) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(hashes))
+
+    def __contains__(self, key: str) -> bool:
+        return self.contains_hashes(bloom_key_hashes(key))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, bit_count: int, hash_count: int) -> "BloomFilter":
+        if len(data) != (bit_count + 7) // 8:
+            raise ValueError(f"Bloom filter of {bit_count} bits cannot be {len(data)} bytes")
+        return cls(bit_count, hash_count, bytearray(data))
+
+
+def build_summary(names: Iterable[str], hashes: Iterable[str]) -> BloomFilter:
+    keys = [name_key(name) for name in names] + [hash_key(file_hash) for file_hash in hashes]
+    bloom = BloomFilter.for_capacity(len(keys))
+    for key in keys:
+        bloom.add(key)
+    return bloom
+
+
+class AvailabilityIndex:
+    def __init__(self):
+        # peer -> (node_id, index_version, summary)
+        self._summaries: Dict[PeerAddress, Tuple[str | None, int | None, BloomFilter]] = {}
+        self._lock = threading.Lock()
+
+    def update(self, peer: PeerAddress, node_id: str | None, index_version: int | None, summary: BloomFilter):
+        with self._lock:
+            self._summaries[peer] = (node_id, index_version, summary)
+
+    def remove(self, peer: PeerAddress):
+        with self._lock:
+            self._summaries.pop(peer, None)
+
+    def is_current(self, peer: PeerAddress, node_id: str | None, index_version: int | None) -> bool:
+        with self._lock:
+            entry = self._summaries.get(peer)
+        return entry is not None and entry[0] == node_id and entry[1] == index_version
+
+    def peers(self) -> Set[PeerAddress]:
+        with self._lock:
+            return set(self._summaries)
+
+    def _lookup(self, key: str, peers: Iterable[PeerAddress]) -> Tuple[List[PeerAddress], bool]:
+        hashes = bloom_key_hashes(key)
+        candidates = []
+        complete = True
+        with self._lock:
+            for peer in peers:
+                entry = self._summaries.get(peer)
+                if entry is None:
+                    # Without a summary the peer has to be asked the old way.
+                    complete = False
+                elif entry[2].contains_hashes(hashes):
+                    candidates.append(peer)
+        return candidates, complete
+
+    def lookup_name(self, name: str, peers: Iterable[PeerAddress]) -> Tuple[List[PeerAddress], bool]:
+        return self._lookup(name_key(name), peers)
+
+    def lookup_hash(self, file_hash: str, peers: Iterable[PeerAddress]) -> Tuple[List[PeerAddress], bool]:
+        return self._lookup(hash_key(file_hash), peers)
@@ -0,0 +1,288 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Dict, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Missing on Windows; clones there fall back to copies.
+    fcntl = None
+
+from utils.FileTransfer import read_at
+from utils.MappedFileCache import file_cache
+from utils.ManifestManager import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# ioctl from linux/fs.h: makes the destination share the source's extents copy-on-write (btrfs, XFS).
+FICLONE = 0x40049409
+
+
+def reflink_file(source: str, destination: str) -> bool:
+    # False where the filesystem cannot share extents (ext4, overlayfs, tmpfs); nothing is left behind then.
+    if fcntl is None:
+        return False
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(destination)
+    return False
+
+
+def clone_file(source: str, destination: str):
+    # A reflink where the filesystem has them, else a copy kept in the kernel, else a plain copy. Either way
+    # the destination is its own inode, so writing to one never changes the other.
+    if reflink_file(source, destination):
+        return
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), 1024 * 1024 * 1024):
+                    pass
+                return
+            except OSError:
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def _signature(st: os.stat_result) -> Tuple[int, int, int]:
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class ChunkStore:
+    # Chunks are looked up by their SHA-256. Each complete file is held once per content hash: as a private,
+    # read-only reflink in files/ where the filesystem shares extents, otherwise as a reference to the shared
+    # file itself, valid while its size, mtime and inode are unchanged. Their manifests index the chunks they
+    # contain; new names for the same bytes are cloned from them. Chunks that belong to no complete file are
+    # kept loose in objects/.
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.objects_dir = os.path.join(self.root, "objects")
+        self.files_dir = os.path.join(self.root, "files")
+        self.manifests_dir = os.path.join(self.root, "manifests")
+        for directory in (self.objects_dir, self.files_dir, self.manifests_dir):
+            os.makedirs(directory, exist_ok=True)
+        # chunk hash -> (file hash, offset, length) inside a stored file
+        self._locations: Dict[str, Tuple[str, int, int]] = {}
+        # file hash -> (referenced share file or None for an object in files/, its signature when added)
+        self._files: Dict[str, Tuple[str | None, Tuple[int, int, int]]] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def for_share(cls, share_directory: str) -> "ChunkStore":
+        # Next to the share so reflinks stay on one filesystem, hidden like the share index.
+        parent, name = os.path.split(os.path.abspath(share_directory))
+        return cls(os.path.join(parent, f".{name}_chunks"))
+
+    def _load(self):
+        for entry in os.listdir(self.manifests_dir):
+            if not entry.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.manifests_dir, entry), "r") as f:
+                    record = json.load(f)
+                self._index(record["manifest"], record.get("path"), tuple(record["stat"]))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Ignoring unreadable chunk store manifest {entry}: {e}")
+
+    def _index(self, manifest: Dict, path: str | None, stat: Tuple[int, int, int]):
+        file_hash = manifest["sha256"]
+        self._files[file_hash] = (path, stat)
+        for chunk_index, chunk_hash in enumerate(manifest["chunks"]):
+            offset = chunk_index * CHUNK_SIZE
+            self._locations.setdefault(chunk_hash, (file_hash, offset, min(CHUNK_SIZE, manifest["size"] - offset)))
+
+    def chunk_path(self, chunk_hash: str) -> str:
+        return os.path.join(self.objects_dir, chunk_hash[:2], chunk_hash)
+
+    def file_path(self, file_hash: str) -> str:
+        return os.path.join(self.files_dir, file_hash)
+
+    def _manifest_path(self, file_hash: str) -> str:
+        return os.path.join(self.manifests_dir, file_hash + ".json")
+
+    def source_path(self, file_hash: str) -> str | None:
+        # Where the file's bytes can be read, as long as they are still the ones that were added.
+        with self._lock:
+            record = self._files.get(file_hash)
+        if record is None:
+            return None
+        path = record[0] or self.file_path(file_hash)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        # An edited share file, or a stored one written to despite its permissions, no longer matches the hash.
+        return path if _signature(st) == record[1] else None
+
+    def has_file(self, file_hash: str) -> bool:
+        return self.source_path(file_hash) is not None
+
+    def has_object(self, file_hash: str) -> bool:
+        # Held as a private reflink, which nothing in the share can change.
+        return self.source_path(file_hash) == self.file_path(file_hash)
+
+    def manifest(self, file_hash: str) -> Dict | None:
+        if not self.has_file(file_hash):
+            return None
+        try:
+            with open(self._manifest_path(file_hash), "r") as f:
+                return json.load(f)["manifest"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def has_chunk(self, chunk_hash: str) -> bool:
+        with self._lock:
+            location = self._locations.get(chunk_hash)
+        return (location is not None and self.has_file(location[0])) or os.path.exists(self.chunk_path(chunk_hash))
+
+    def read_chunk(self, chunk_hash: str) -> bytes | None:
+        with self._lock:
+            location = self._locations.get(chunk_hash)
+        path = self.source_path(location[0]) if location is not None else None
+        if path is not None:
+            _, offset, length = location
+            try:
+                fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                try:
+                    data = read_at(fd, offset, length)
+                finally:
+                    os.close(fd)
+                if hashlib.sha256(data).hexdigest() == chunk_hash:
+                    return data
+            except OSError:
+                pass
+        try:
+            with open(self.chunk_path(chunk_hash), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        return data if hashlib.sha256(data).hexdigest() == chunk_hash else None
+
+    def put_chunk(self, chunk_hash: str, data) -> bool:
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            return False
+        path = self.chunk_path(chunk_hash)
+        if os.path.exists(path):
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        return True
+
+    def add_file(self, path: str, manifest: Dict) -> bool:
+        file_hash = manifest["sha256"]
+        if self.has_file(file_hash):
+            return True
+        path = os.path.abspath(path)
+        object_path = self.file_path(file_hash)
+        tmp_path = object_path + ".tmp"
+        try:
+            before = os.stat(path)
+            if before.st_size != manifest["size"]:
+                return False
+            # Without reflinks a private copy would double the space the file takes; the share file is then
+            # referenced in place instead.
+            if reflink_file(path, tmp_path):
+                if _signature(os.stat(path)) != _signature(before):
+                    # Edited while it was being cloned; the clone may mix old and new bytes.
+                    os.remove(tmp_path)
+                    return False
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, object_path)
+                path, before = None, os.stat(object_path)
+        except OSError as e:
+            logger.warning(f"Not adding {path} to the chunk store: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        stat = _signature(before)
+        with open(self._manifest_path(file_hash) + ".tmp", "w") as f:
+            json.dump({"manifest": manifest, "path": path, "stat": stat}, f)
+        os.replace(self._manifest_path(file_hash) + ".tmp", self._manifest_path(file_hash))
+        with self._lock:
+            self._index(manifest, path, stat)
+        return True
+
+    def link_file(self, file_hash: str, destination_path: str) -> bool:
+        source = self.source_path(file_hash)
+        if source is None or os.path.exists(destination_path):
+            return False
+        os.makedirs(os.path.dirname(destination_path) or ".", exist_ok=True)
+        tmp_path = destination_path + ".clone"
+        try:
+            clone_file(source, tmp_path)
+            if self.source_path(file_hash) != source:
+                # A referenced share file was edited while it was being copied.
+                raise OSError(f"{source} changed while being cloned")
+            os.replace(tmp_path, destination_path)
+        except OSError as e:
+            logger.warning(f"Could not clone {destination_path} from the chunk store: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        logger.info(f"{destination_path} cloned from the chunk store, no transfer needed")
+        return True
+
+    def gc(self, shared: Set[str], pinned: Set[str] = frozenset()) -> Tuple[int, int]:
+        # Drops stored files whose hash is no longer shared under any name, references to share files that
+        # changed, and loose chunks that no pending download needs or that a stored file already holds.
+        # Returns (entries removed, bytes freed); dropping a reference frees nothing, the share file stays.
+        removed = 0
+        freed = 0
+        with self._lock:
+            files = dict(self._files)
+        for file_hash, (path, _) in files.items():
+            if file_hash in shared and self.has_file(file_hash):
+                continue
+            doomed = [self._manifest_path(file_hash)]
+            if path is None:
+                try:
+                    freed += os.stat(self.file_path(file_hash)).st_size
+                except OSError:
+                    pass
+                # Unmap it now rather than at eviction, or the bytes of a deleted object stay pinned on disk.
+                file_cache.invalidate(self.file_path(file_hash))
+                doomed.append(self.file_path(file_hash))
+            for doomed_path in doomed:
+                try:
+                    os.remove(doomed_path)
+                except OSError:
+                    pass
+            removed += 1
+            with self._lock:
+                self._files.pop(file_hash, None)
+                self._locations = {h: loc for h, loc in self._locations.items() if loc[0] != file_hash}
+
+        with self._lock:
+            located = set(self._locations)
+        for directory, _, filenames in os.walk(self.objects_dir):
+            for filename in filenames:
+                if filename in pinned and filename not in located:
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += size
+        if removed:
+            logger.info(f"Chunk store GC removed {removed} object(s), freed {freed} bytes")
+        return removed, freed
@@ -0,0 +1,84 @@
+import lzma
+import zlib
+from typing import Callable, Dict, Iterable, List
+
+try:
+    import zstandard
+except ImportError:
+    # Optional: without it transfers negotiate one of the stdlib codecs.
+    zstandard = None
+
+# Bytes of each chunk compressed up front to decide whether the rest of it is worth compressing.
+SAMPLE_SIZE = 16 * 1024
+# Data is sent compressed only when it shrinks below this fraction of its size; media and archives never do.
+COMPRESSIBLE_RATIO = 0.9
+# Fast settings: at gigabit speeds a slow codec costs more time than the bytes it saves.
+ZLIB_LEVEL = 1
+LZMA_PRESET = 0
+ZSTD_LEVEL = 3
+# Raw LZMA2 skips the .xz container, whose headers and checksums would take back most of the saving on small frames.
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': LZMA_PRESET}]
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class Codec:
+    def __init__(self, name: str, compress: Callable[[bytes], bytes], decompress: Callable[[bytes, int], bytes]):
+        self.name = name
+        self.compress = compress
+        self._decompress = decompress
+
+    def decompress(self, data, expected_length: int) -> bytes:
+        # Bounded by the length the receiver expects, so a hostile frame cannot inflate without limit.
+        try:
+            result = self._decompress(data, expected_length)
+        except DECOMPRESS_ERRORS as e:
+            raise ValueError(f"Corrupt {self.name} data: {e}") from e
+        if len(result) != expected_length:
+            raise ValueError(f"{self.name} data inflated to {len(result)} bytes, expected {expected_length}")
+        return result
+
+    def worth_compressing(self, sample) -> bool:
+        return bool(sample) and len(self.compress(sample)) < len(sample) * COMPRESSIBLE_RATIO
+
+
+def _zlib_decompress(data, max_length: int) -> bytes:
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(data, max_length)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("zlib data does not end within the expected length")
+    return result
+
+
+def _lzma_decompress(data, max_length: int) -> bytes:
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    result = decompressor.decompress(data, max_length)
+    if not decompressor.eof:
+        raise ValueError("lzma data does not end within the expected length")
+    return result
+
+
+CODECS: Dict[str, Codec] = {
+    'zlib': Codec('zlib', lambda data: zlib.compress(data, ZLIB_LEVEL), _zlib_decompress),
+    'lzma': Codec('lzma', lambda data: lzma.compress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS),
+                  _lzma_decompress),
+}
+if zstandard is not None:
+    # Compressor objects are not safe to share between sender threads, so each call makes its own.
+    CODECS['zstd'] = Codec('zstd', lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data),
+                           lambda data, max_length: zstandard.ZstdDecompressor().decompress(data, max_output_size=max_length))
+
+# Senders pick the first of these the receiver offers. lzma trades a lot of CPU for ratio, so it is only
+# chosen when a receiver on a slow link offers nothing else.
+PREFERENCE = ('zstd', 'zlib', 'lzma')
+
+
+def available_codecs() -> List[str]:
+    return [name for name in PREFERENCE if name in CODECS]
+
+
+def choose_codec(offered: Iterable[str] | None) -> Codec | None:
+    offered = set(offered or ())
+    for name in PREFERENCE:
+        if name in offered and name in CODECS:
+            return CODECS[name]
+    return None
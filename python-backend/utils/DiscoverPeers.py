@@ -1,204 +1,421 @@
 import socket
 import json
 import netifaces
-from typing import List, Dict
+from typing import List, Dict, Set, Tuple
 import threading
 import time
 import pathlib
 import os
 import logging
 import base64
-import hashlib
-import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.FileTransfer import FileSender, FileReceiver, tune_socket_buffers
+from utils.ShareIndex import ShareIndex, hash_file
+from utils.ChunkStore import ChunkStore
+from utils.Compression import available_codecs
+from utils.Metrics import metrics
+from utils.RateLimiter import LANE_CONTROL, rate_limiter, set_traffic_class
+from utils.Tracer import tracer
+from utils.SearchCatalog import SearchCatalog, DEFAULT_SEARCH_LIMIT, MAX_SEARCH_RESULTS, RANK_SUBSTRING, search_filters
+from utils.ManifestManager import ManifestCache, ManifestManager, CHUNK_SIZE, MANIFEST_VERSION, merkle_root
+from utils.PeerTable import PeerTable
+from utils.AvailabilityIndex import AvailabilityIndex, BloomFilter, build_summary
+from utils.UdpEngine import UdpEngine, start_event_loop
+from utils.WireFormat import binary_item_size, encode_message
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+MANIFEST_PAGE_CHUNKS = 1024
+# Advertised in discovery so peers can pick protocol features without probing.
+CAPABILITIES = ['chunks', 'manifest', 'query_files', 'nack', 'summary', 'binary']
+DISCOVERY_MIN_INTERVAL = 2.0
+DISCOVERY_MAX_INTERVAL = 32.0
+DISCOVERY_JITTER = 0.25
+HELLO_ANNOUNCEMENTS = 3
+INTERFACE_CACHE_TTL = 60.0
+SUMMARY_REQUEST_INTERVAL = 1.0
+# Broadcast queries stay under a typical Ethernet MTU so they are never fragmented;
+# unicast answers may be larger.
+QUERY_DATAGRAM_LIMIT = 1200
+RESPONSE_DATAGRAM_LIMIT = 8192
+# Handlers that may hash files or read the disk run here so the event loop keeps serving discovery.
+DISPATCH_WORKERS = 4
+
+# From the first query datagram to the last answer (or the end of the window), by lookup kind and whether anything
+# was found. Lookups the availability summaries answer without asking the network are not timed.
+LOOKUP_SECONDS = metrics.histogram("p2p_lookup_seconds", "Network lookup latency", ("kind", "outcome"))
+QUEUE_DEPTH = metrics.gauge("p2p_queue_depth", "Work waiting in internal queues", ("queue",))
+# Per-packet and per-request events go to the trace ring, not the log; see utils/Tracer.py.
+DISCOVERY_TRACE = tracer.channel("discovery")
+QUERY_TRACE = tracer.channel("query")
+TRANSFER_TRACE = tracer.channel("transfer")
+
+
+class DiscoveryScheduler:
+    def __init__(self, min_interval: float = DISCOVERY_MIN_INTERVAL, max_interval: float = DISCOVERY_MAX_INTERVAL,
+                 jitter: float = DISCOVERY_JITTER):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.interval = min_interval
+
+    def next_delay(self, changed: bool) -> float:
+        # Announce quickly while the neighbourhood changes, back off exponentially once it is stable.
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        # Jitter keeps nodes that started together from broadcasting in lockstep.
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+def split_batches(base: Dict, key: str, items: List, limit: int, binary: bool = False) -> List[Dict]:
+    # Splits items over as few messages as fit the datagram limit in the wire format they will be sent in.
+    empty = {**base, key: []}
+    if binary and (encoded := encode_message(empty)) is not None:
+        empty_size = len(encoded)
+        item_size = lambda item: binary_item_size(key, item)
+    else:
+        empty_size = len(json.dumps(empty))
+        item_size = lambda item: len(json.dumps(item)) + 2
+    batches = []
+    batch: List = []
+    size = empty_size
+    for item in items:
+        size_of_item = item_size(item)
+        if batch and size + size_of_item > limit:
+            batches.append({**base, key: batch})
+            batch = []
+            size = empty_size
+        batch.append(item)
+        size += size_of_item
+    if batch:
+        batches.append({**base, key: batch})
+    return batches
+
+
 class DiscoverPeers:
-    def __init__(self, port: int):
+    def __init__(self, port: int, share_index: ShareIndex | None = None, chunk_store: ChunkStore | None = None,
+                 seed_peers: List[Tuple[str, int]] | None = None, broadcast: bool = True,
+                 compression: List[str] | None = None):
         self.discovery_target_port = port 
         self.port = port 
+        self.share_index = share_index if share_index is not None else ShareIndex("publicFiles")
+        self.chunk_store = chunk_store
+        # Seeds are announced to and queried by unicast, for networks (or a loopback test bed) broadcasts do not reach.
+        self.seed_peers = list(seed_peers or [])
+        self.broadcast = broadcast
+        # Codecs offered to senders with every file request; an empty list asks for raw transfers.
+        self.compression = available_codecs() if compression is None else list(compression)
+        self.catalog = SearchCatalog(self.share_index)
+        self.manifest_cache = ManifestCache.for_share(self.share_index.directory)
         self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        set_traffic_class(self.discovery_socket, LANE_CONTROL)
         try:
             self.discovery_socket.bind(('0.0.0.0', self.port))
+            self.port = self.discovery_socket.getsockname()[1]
         except OSError as e:
             logger.error(f"Error binding discovery socket to {self.port}: {e}. Trying random port.")
             self.discovery_socket.bind(('0.0.0.0', 0))
             self.port = self.discovery_socket.getsockname()[1]
             logger.info(f"Bound to new port: {self.port}. Discovery broadcasts will still target: {self.discovery_target_port}")
 
-        self.peers: List[str] = []
-        self.discovery_socket.settimeout(1.0)
+        self.node_id = os.urandom(8).hex()
+        self.peer_table = PeerTable()
+        self.discovery_scheduler = DiscoveryScheduler()
+        self.last_announcement = 0.0
+        self._discovery_changed = threading.Event()
+        self._discovery_wakeup = asyncio.Event()
+        self._interfaces_cache: Tuple[float, List[str]] = (0.0, [])
+        self.availability = AvailabilityIndex()
+        self._summary_cache: Tuple[int | None, bytes] = (None, b"")
+        self._summary_requests: Dict[Tuple[str, int], float] = {}
+        self.discovery_socket.setblocking(False)
+        self.engine = UdpEngine(self._dispatch)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._start_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS, thread_name_prefix="discovery")
+        # Lookups stay serial so none answers from an index another lookup is still refreshing.
+        self._lookup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="discovery-lookup")
+        QUEUE_DEPTH.track(self.queue_depths)
+        self._handlers = {
+            'query_file': (self._answer_file_query, self._lookup_executor),
+            'query_files': (self._answer_file_queries, self._lookup_executor),
+            'get_summary': (self._answer_summary_request, self._lookup_executor),
+            'search': (self._answer_search, self._lookup_executor),
+            'receive_file': (self._start_file_send, self._executor),
+            'get_manifest': (self._send_manifest_page, self._executor),
+        }
 
-    def discover_peers(self):
+    async def discover_peers(self):
         
         logger.info("Starting peer discovery broadcast.")
         message = {
             'type': 'discover',
-            'port': self.port
+            'port': self.port,
+            'node_id': self.node_id,
+            'capabilities': CAPABILITIES
         }
+        announcements = 0
+        advertised_version = None
 
         while True:
-            try:
-                interfaces = netifaces.interfaces()
-                for interface in interfaces:
-                    ifaddresses = netifaces.ifaddresses(interface)
-                    inet_info = ifaddresses.get(netifaces.AF_INET, [])
-
-                    for link in inet_info:
-                        broadcast_ip = link.get('broadcast')
-                        if broadcast_ip:
-                            try:
-                                self.discovery_socket.sendto(
-                                    json.dumps(message).encode(),
-                                    (broadcast_ip, self.discovery_target_port) 
-                                )
-                                logger.debug(f"Discovery message sent to {broadcast_ip}:{self.discovery_target_port}")
-                            except Exception as send_err:
-                                logger.warning(f"Error sending to {broadcast_ip}: {send_err}")
-                logger.debug("Finished broadcasting discovery messages for this cycle.")
-            except Exception as e:
-                logger.error(f"Error during interface scan or broadcast: {e}", exc_info=True)
-            time.sleep(2)
-
-    def listen_for_peers(self):
-        
-        logger.info("Starting to listen for peers.")
-        while True:
-            try:
-                data, addr = self.discovery_socket.recvfrom(1024)
-                message = json.loads(data.decode())
-                sender_ip = addr[0]
-                sender_port = message.get('port', addr[1])
-                logger.debug(f"Received message: {message} from {sender_ip}:{sender_port}")
-
-                if message['type'] == 'discover':
-                    response = {
-                        'type': 'peer_info',
-                        'port': self.port,
-                    }
-                    logger.info(f"Received discover from {sender_ip}:{sender_port}. Responding.")
-                    self.discovery_socket.sendto(
-                        json.dumps(response).encode(),
-                        (sender_ip, sender_port)
-                    )
-                    peer_addr = f"{sender_ip}:{sender_port}"
-                    if peer_addr not in self.peers:
-                        self.peers.append(peer_addr)
-                        logger.info(f"Peer added: {peer_addr}")
-
-                elif message['type'] == 'peer_info':
-                    peer_addr = f"{sender_ip}:{message['port']}"
-                    if peer_addr not in self.peers:
-                        self.peers.append(peer_addr)
-                        logger.info(f"Discovered peer via peer_info: {peer_addr}")
-                
-                elif message['type'] == 'query_file':
-                    requested_filename = message['filename']
-                    sender_ip = addr[0]
-                    original_sender_port = addr[1]
-                    
-                   
-                    logger.info(f"Received query_file for '{requested_filename}' from {sender_ip}:{original_sender_port} (reply to port: {message.get('reply_port')})")
-                    
-                    found_file_hash = None
-                    local_files = self.list_all_files("publicFiles")
-                    for f_hash, f_path in local_files.items():
-                        if os.path.basename(f_path) == requested_filename:
-                            found_file_hash = f_hash
-                            break
-                    
-                    if found_file_hash:
-                        logger.info(f"File '{requested_filename}' found locally with hash {found_file_hash}. Responding.")
-                        response = {
-                            'type': 'file_found_response',
-                            'filename': requested_filename,
-                            'file_hash': found_file_hash,
-                            'peer_ip': self.get_local_ip(),
-                            'port': self.port            
-                        }
-                        
-                       
-                        reply_to_port = message.get('reply_port')
-                        if reply_to_port:
-                           
-                            response_addr = (sender_ip, reply_to_port)
-                            logger.debug(f"Sending file_found_response to {response_addr} (using reply_port from message)")
-                        else:
-                           
-                           
-                            response_addr = addr 
-                            logger.warning(f"reply_port not found in query_file message from {sender_ip}. Responding to original sender port {original_sender_port}.")
-                        
-                        self.discovery_socket.sendto(json.dumps(response).encode(), response_addr)
-                    else:
-                        logger.info(f"File '{requested_filename}' not found locally.")
-
-                elif message['type'] == "receive_file" and 'file_hash' in message:
-                    file_hash_to_send = message['file_hash']
-                    requester_ip = addr[0]
-                   
-                    requester_reply_port = message.get('port')
-
-                    logger.info(f"Received 'receive_file' request for hash {file_hash_to_send} from {requester_ip}:{addr[1]}. Requester expects data on port {requester_reply_port}.")
-                    
-                    local_files = self.list_all_files("publicFiles")
-                    if file_hash_to_send in local_files:
-                        file_path_to_send = local_files[file_hash_to_send]
-                        file_name_to_send = os.path.basename(file_path_to_send)
-                        file_format = file_name_to_send.split('.')[-1] if '.' in file_name_to_send else ""
-                        
-                        try:
-                            with open(file_path_to_send, 'rb') as f:
-                                file_data_bytes = f.read()
-                            
-                            import base64
-                            file_data_encoded = base64.b64encode(file_data_bytes).decode('utf-8')
-
-                            data_message = {
-                                'type': 'file_data',
-                                'port': self.port,
-                                'file_hash': file_hash_to_send,
-                                'file_name': file_name_to_send,
-                                'file_format': file_format,
-                                'data': file_data_encoded
-                            }
-
-                            data_payload_bytes = json.dumps(data_message).encode()
-                            payload_size = len(data_payload_bytes)
-                            logger.info(f"Attempting to send file_data payload of size: {payload_size} bytes for {file_name_to_send} to {requester_ip}:{requester_reply_port}")
-                            if payload_size > 60000:
-                                logger.warning(f"Payload size {payload_size} for {file_name_to_send} is very large for a single UDP packet and may cause transmission failure. Consider implementing chunking for robust transfer.")
-
-                            if requester_reply_port:
-                               
-                                reply_address = (requester_ip, requester_reply_port)
-                                self.discovery_socket.sendto(data_payload_bytes, reply_address)
-                                logger.info(f"Sent file data for {file_name_to_send} to {reply_address[0]}:{reply_address[1]}")
-                            else:
-                                logger.error(f"Cannot send file {file_name_to_send}: 'port' not specified in 'receive_file' message from {requester_ip}:{addr[1]}.")
-                        except FileNotFoundError:
-                            logger.error(f"File not found for sending: {file_path_to_send}")
-                        except Exception as e:
-                            logger.error(f"Error reading or sending file {file_path_to_send}: {e}", exc_info=True)
-                    else:
-                        logger.warning(f"Requested file hash {file_hash_to_send} not found in local files for sending.")
-
-            except socket.timeout:
-                continue
-            except json.JSONDecodeError:
-                logger.warning(f"Error decoding JSON from {addr[0] if 'addr' in locals() else 'unknown'}. Data: {data if 'data' in locals() else 'N/A'}")
-            except Exception as e:
-                logger.error(f"Error in listen_for_peers: {e}", exc_info=True)
+            expired = self.peer_table.expire()
+            for address in expired:
+                logger.info(f"Peer expired: {address[0]}:{address[1]}")
+                self.availability.remove(address)
+                self._summary_requests.pop(address, None)
+            await self.loop.run_in_executor(self._lookup_executor, self.share_index.refresh)
+            index_version = self.share_index.version
+            if index_version != advertised_version:
+                # Keeps the search catalog warm off the lookup thread; a first build of a large share takes a while.
+                self.loop.run_in_executor(None, self.catalog.sync)
+            changed = self._discovery_changed.is_set() or bool(expired) or index_version != advertised_version
+            self._discovery_changed.clear()
+            delay = self.discovery_scheduler.next_delay(changed)
+
+            # Echoed back in peer_info so every reply doubles as an RTT sample.
+            message['ts'] = time.monotonic()
+            message['index_version'] = advertised_version = index_version
+            message['interval'] = round(delay, 3)
+            # Until we have announced a few times, every peer answers so we learn the table quickly.
+            message['hello'] = announcements < HELLO_ANNOUNCEMENTS
+            encoded_message = self.engine.encode(message, self._broadcast_binary())
+            for destination in self._broadcast_destinations():
+                self.engine.send(encoded_message, destination, message_type='discover')
+            self.last_announcement = time.monotonic()
+            announcements += 1
+            DISCOVERY_TRACE.debug("announced", delay, announcements)
+
+            # Wake early when our share changes so peers refresh their copy of our summary within about a second.
+            wake_at = time.monotonic() + delay
+            while (remaining := wake_at - time.monotonic()) > 0 and self.share_index.version == advertised_version:
+                try:
+                    await asyncio.wait_for(self._discovery_wakeup.wait(), min(remaining, 1.0))
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            self._discovery_wakeup.clear()
+
+    def announce_soon(self):
+        self._discovery_changed.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._discovery_wakeup.set)
+
+    def _should_reply(self, message: Dict, is_new: bool) -> bool:
+        if is_new or message.get('hello'):
+            return True
+        # Everyone on the segment heard our last broadcast; a unicast reply would tell the sender nothing new.
+        return time.monotonic() - self.last_announcement > self.discovery_scheduler.interval * 1.5
+
+    def _speaks_binary(self, addr: Tuple[str, int]) -> bool:
+        record = self.peer_table.get(addr)
+        return record is not None and 'binary' in record.capabilities
+
+    def _broadcast_binary(self) -> bool:
+        # Broadcasts stay JSON until every live peer can read the binary form, so older nodes still hear us.
+        live_peers = self.peer_table.live_peers()
+        return bool(live_peers) and self.peer_table.with_capability('binary') == live_peers
+
+    def _answer_binary(self, message: Dict, addr: Tuple[str, int]) -> bool:
+        return bool(message.get('binary')) or self._speaks_binary(addr)
+
+    def start_listening(self, loop: asyncio.AbstractEventLoop | None = None):
+        with self._start_lock:
+            if self.loop is not None:
+                return
+            loop = loop or start_event_loop(f"discovery-{self.port}")
+            asyncio.run_coroutine_threadsafe(
+                loop.create_datagram_endpoint(lambda: self.engine, sock=self.discovery_socket), loop).result()
+            self.loop = loop
+        logger.info(f"Listening for peers on UDP port {self.port}.")
+
+    def _call(self, coroutine):
+        # Blocking entry point for download threads; code already on the event loop awaits the *_async variant.
+        self.start_listening()
+        if self.engine.in_loop_thread():
+            coroutine.close()
+            raise RuntimeError("Blocking discovery call made from the event loop; await the async variant instead.")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _reply_address(self, message: Dict, addr: Tuple[str, int]) -> Tuple[str, int]:
+        return (addr[0], message.get('reply_port') or addr[1])
+
+    def _dispatch(self, message: Dict, addr: Tuple[str, int]):
+        sender_ip = addr[0]
+        sender_port = message.get('port', addr[1])
+
+        if message['type'] in ('discover', 'peer_info') and message.get('node_id') == self.node_id:
+            # Our own broadcast looping back.
+            return
+
+        if message['type'] == 'discover':
+            is_new = self._note_peer((sender_ip, sender_port), message)
+            if self._should_reply(message, is_new):
+                response = {
+                    'type': 'peer_info',
+                    'port': self.port,
+                    'echo_ts': message.get('ts'),
+                    'node_id': self.node_id,
+                    'capabilities': CAPABILITIES,
+                    'index_version': self.share_index.version,
+                    'interval': self.discovery_scheduler.interval
+                }
+                DISCOVERY_TRACE.debug("discover_answered", (sender_ip, sender_port), is_new)
+                self.engine.send(response, (sender_ip, sender_port), self._answer_binary(message, (sender_ip, sender_port)))
+
+        elif message['type'] == 'peer_info':
+            peer = (sender_ip, message['port'])
+            self._note_peer(peer, message)
+            if isinstance(message.get('echo_ts'), (int, float)):
+                self.peer_table.observe_rtt(peer, time.monotonic() - message['echo_ts'])
+
+        elif message['type'] == 'summary_response' and 'port' in message:
+            self._store_summary((sender_ip, message['port']), message)
+
+        elif message['type'] in self._handlers:
+            # Lookups may refresh the share index or read files; never let them stall the loop.
+            handler, executor = self._handlers[message['type']]
+            self.loop.run_in_executor(executor, self._run_handler, handler, message, addr)
+
+    def _run_handler(self, handler, message: Dict, addr: Tuple[str, int]):
+        try:
+            handler(message, addr)
+        except Exception as e:
+            logger.error(f"Error handling {message['type']} from {addr[0]}:{addr[1]}: {e}", exc_info=True)
+
+    def _answer_file_query(self, message: Dict, addr: Tuple[str, int]):
+        requested_filename = message['filename']
+        reply_addr = self._reply_address(message, addr)
+
+        found_file_hash = self.share_index.hash_for_name(requested_filename)
+        QUERY_TRACE.info("query_file", addr, requested_filename, found_file_hash)
+        if found_file_hash:
+            response = {
+                'type': 'file_found_response',
+                'request_id': message.get('request_id'),
+                'filename': requested_filename,
+                'file_hash': found_file_hash,
+                'size': self.share_index.size_for_hash(found_file_hash),
+                'peer_ip': self.get_local_ip(),
+                'port': self.port
+            }
+            self.engine.send(response, reply_addr, self._answer_binary(message, reply_addr))
+        elif message.get('nack'):
+            # Lets the searcher stop waiting as soon as every known peer has answered.
+            response = {'type': 'file_not_found_response', 'request_id': message.get('request_id'),
+                        'filename': requested_filename, 'port': self.port}
+            self.engine.send(response, reply_addr, self._answer_binary(message, reply_addr))
+
+    def _answer_summary_request(self, message: Dict, addr: Tuple[str, int]):
+        self.engine.send(self._encoded_summary(), addr, message_type='summary_response')
+
+    def _start_file_send(self, message: Dict, addr: Tuple[str, int]):
+        file_hash_to_send = message.get('file_hash')
+        requester_ip = addr[0]
+        requester_reply_port = message.get('port')
+        if not file_hash_to_send:
+            return
+
+        TRANSFER_TRACE.info("receive_file", addr, file_hash_to_send, requester_reply_port, message.get('chunks') is not None)
+
+        file_path_to_send = self._path_for_hash(file_hash_to_send)
+        if file_path_to_send:
+            if requester_reply_port:
+                sender = FileSender(
+                    file_path_to_send,
+                    file_hash_to_send,
+                    (requester_ip, requester_reply_port),
+                    chunks=message.get('chunks'),
+                    compression=message.get('compression'),
+                    rate=message.get('rate'),
+                    immutable=self.chunk_store is not None and file_path_to_send == self.chunk_store.file_path(file_hash_to_send)
+                )
+                sender.start()
+                TRANSFER_TRACE.info("transfer_started", sender.transfer_id, file_path_to_send, (requester_ip, requester_reply_port))
+            else:
+                logger.error(f"Cannot send file {file_path_to_send}: 'port' not specified in 'receive_file' message from {requester_ip}:{addr[1]}.")
+        else:
+            logger.warning(f"Requested file hash {file_hash_to_send} not found in local files for sending.")
+
+    def _path_for_hash(self, file_hash: str) -> str | None:
+        # Stored objects are private and never written, so they are preferred over a share file that may be mid-edit.
+        if self.chunk_store is not None and self.chunk_store.has_object(file_hash):
+            return self.chunk_store.file_path(file_hash)
+        return self.share_index.path_for_hash(file_hash)
+
+    def _note_peer(self, peer: Tuple[str, int], message: Dict) -> bool:
+        is_new = self.peer_table.get(peer) is None
+        self.peer_table.update(peer, message)
+        if is_new:
+            logger.info(f"Peer added: {peer[0]}:{peer[1]}")
+            self._discovery_changed.set()
+        if 'summary' in (message.get('capabilities') or ()) and isinstance(message.get('index_version'), int) \
+                and not self.availability.is_current(peer, message.get('node_id'), message['index_version']):
+            # A stale summary could hide files the peer just added; fall back to asking it until the new one arrives.
+            self.availability.remove(peer)
+            self._request_summary(peer)
+        return is_new
+
+    def _request_summary(self, peer: Tuple[str, int]):
+        now = time.monotonic()
+        if now - self._summary_requests.get(peer, 0.0) < SUMMARY_REQUEST_INTERVAL:
+            return
+        self._summary_requests[peer] = now
+        self.engine.send({'type': 'get_summary', 'port': self.port}, peer)
+
+    def _encoded_summary(self) -> bytes:
+        self.share_index.refresh()
+        version = self.share_index.version
+        cached_version, encoded = self._summary_cache
+        if cached_version == version:
+            return encoded
+        names, hashes = self.share_index.shared_keys()
+        bloom = build_summary(names, hashes)
+        encoded = json.dumps({
+            'type': 'summary_response',
+            'port': self.port,
+            'node_id': self.node_id,
+            'index_version': version,
+            'bit_count': bloom.bit_count,
+            'hash_count': bloom.hash_count,
+            'bloom': base64.b64encode(bloom.to_bytes()).decode()
+        }).encode()
+        self._summary_cache = (version, encoded)
+        return encoded
+
+    def _store_summary(self, peer: Tuple[str, int], message: Dict):
+        try:
+            bloom = BloomFilter.from_bytes(base64.b64decode(message['bloom']), int(message['bit_count']), int(message['hash_count']))
+        except (KeyError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring malformed summary from {peer[0]}:{peer[1]}: {e}")
+            return
+        self.availability.update(peer, message.get('node_id'), message.get('index_version'), bloom)
+        self._summary_requests.pop(peer, None)
+        DISCOVERY_TRACE.debug("summary_stored", peer, message.get('index_version'), len(bloom.bits))
+
+    @property
+    def peers(self) -> List[str]:
+        return [f"{ip}:{port}" for ip, port in sorted(self.peer_table.live_peers())]
+
+    def queue_depths(self) -> Dict[Tuple[str], int]:
+        return {
+            ('dispatch',): self._executor._work_queue.qsize(),
+            ('lookup',): self._lookup_executor._work_queue.qsize(),
+            ('pending_requests',): self.engine.outstanding,
+        }
 
-    def start_discovery(self):
+    def start_discovery(self, loop: asyncio.AbstractEventLoop | None = None):
         
-        logger.info("Initializing discovery threads.")
-        threading.Thread(target=self.listen_for_peers, daemon=True).start()
-
-        threading.Thread(target=self.discover_peers, daemon=True).start()
+        logger.info("Initializing discovery on the event loop.")
+        self.start_listening(loop)
+        asyncio.run_coroutine_threadsafe(self.discover_peers(), self.loop)
 
     def list_of_peer_accordingly_to_ips(self, file_name, files) -> List[str]:
         
@@ -208,97 +425,270 @@ class DiscoverPeers:
         return ("", "")
 
     def find_file_source(self, requested_filename: str) -> tuple[str | None, int | None, str | None]:
-        
-        logger.info(f"Searching for file source: {requested_filename}")
-
-        response_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        response_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            response_socket.bind(('0.0.0.0', 0))
-        except Exception as e:
-            logger.error(f"Error binding temporary response socket for find_file_source: {e}", exc_info=True)
-            response_socket.close()
+        QUERY_TRACE.info("find_file_source", requested_filename)
+        holders = self.find_file_holders(requested_filename, max_sources=1)
+        if not holders:
+            logger.warning(f"File '{requested_filename}' not found on the network.")
             return None, None, None
-            
-        reply_to_port = response_socket.getsockname()[1]
-        logger.debug(f"find_file_source listening for response on temporary port {reply_to_port}")
-
-        message = {
-            'type': 'query_file',
-            'filename': requested_filename,
-            'reply_port': reply_to_port
-        }
-        encoded_message = json.dumps(message).encode()
-
+        peer_ip, peer_port, file_hash, _ = holders[0]
+        logger.info(f"Found file '{requested_filename}' at {peer_ip}:{peer_port} with hash {file_hash}")
+        return peer_ip, peer_port, file_hash
+
+    def _query_destinations(self, targets: List[Tuple[str, int]] | None) -> List[Tuple[Tuple[str, int], bool]]:
+        # (destination, whether it reads the binary wire format)
+        if targets is not None:
+            return [(target, self._speaks_binary(target)) for target in targets]
+        binary = self._broadcast_binary()
+        return [(destination, binary) for destination in self._broadcast_destinations()]
+
+    def _search_deadline(self, sent_at: float, expected: Set[Tuple[str, int]], timeout_duration: float | None) -> float:
+        if timeout_duration is not None:
+            return sent_at + timeout_duration
+        return sent_at + self.peer_table.search_window(expected)
+
+    def find_file_holders(self, requested_filename: str, timeout_duration: float | None = None, max_sources: int | None = None,
+                          targets: List[Tuple[str, int]] | None = None) -> List[Tuple[str, int, str, int | None]]:
+        return self._call(self.find_file_holders_async(requested_filename, timeout_duration, max_sources, targets))
+
+    async def find_file_holders_async(self, requested_filename: str, timeout_duration: float | None = None,
+                                      max_sources: int | None = None,
+                                      targets: List[Tuple[str, int]] | None = None) -> List[Tuple[str, int, str, int | None]]:
+        QUERY_TRACE.info("find_file_holders", requested_filename, targets is not None)
+
+        if targets is None:
+            live_peers = self.peer_table.live_peers()
+            candidates, complete = self.availability.lookup_name(requested_filename, live_peers)
+            if live_peers and complete:
+                # Every live peer's summary is current: only the candidates can have it, so unicast to them alone.
+                if not candidates:
+                    QUERY_TRACE.info("no_candidates", requested_filename, len(live_peers))
+                    return []
+                targets = candidates
+
+        # Peers we expect an answer (hit or miss) from; once all have replied there is nothing left to wait for.
+        expected = set(targets) if targets is not None else self.peer_table.live_peers()
+        holders: Dict[Tuple[str, int], Tuple[str, int, str, int | None]] = {}
+        answered: Set[Tuple[str, int]] = set()
+
+        def on_response(response: Dict, addr: Tuple[str, int]) -> bool:
+            if response.get('type') not in ('file_found_response', 'file_not_found_response') \
+                    or response.get('filename') != requested_filename or response.get('port') is None:
+                return False
+            peer = (addr[0], response['port'])
+            if peer not in answered:
+                self.peer_table.observe_rtt(peer, time.monotonic() - sent_at)
+                answered.add(peer)
+            if response['type'] == 'file_found_response' and response.get('file_hash'):
+                # Transfers come from the address the peer answered from, which is more reliable than its self-reported IP.
+                holders[peer] = (addr[0], response['port'], response['file_hash'], response.get('size'))
+                if max_sources is not None and len(holders) >= max_sources:
+                    return True
+            return bool(expected) and expected <= answered
+
+        with self.engine.pending(on_response, targets) as (request_id, request):
+            message = {
+                'type': 'query_file',
+                'request_id': request_id,
+                'filename': requested_filename,
+                'reply_port': self.port,
+                'nack': True
+            }
+            sent_at = time.monotonic()
+            for destination, binary in self._query_destinations(targets):
+                self.engine.send(message, destination, binary)
+            await self.engine.wait(request, self._search_deadline(sent_at, expected, timeout_duration) - sent_at)
+
+        ranked = self.peer_table.rank(list(holders.values()))
+        LOOKUP_SECONDS.observe(time.monotonic() - sent_at, ("file_holders", "found" if ranked else "not_found"))
+        logger.info(f"Found {len(ranked)} source(s) for '{requested_filename}' in {time.monotonic() - sent_at:.3f}s ({len(answered)} peer(s) answered)")
+        return ranked
+
+    def _answer_file_queries(self, message: Dict, addr: Tuple[str, int]):
+        reply_addr = self._reply_address(message, addr)
+        found = []
+        for name in message.get('names', []):
+            file_hash = self.share_index.hash_for_name(name)
+            if file_hash:
+                found.append({'name': name, 'hash': file_hash, 'size': self.share_index.size_for_hash(file_hash)})
+        for file_hash in message.get('hashes', []):
+            if self.share_index.path_for_hash(file_hash):
+                found.append({'hash': file_hash, 'size': self.share_index.size_for_hash(file_hash)})
+        QUERY_TRACE.info("query_files", reply_addr, len(message.get('names', [])) + len(message.get('hashes', [])), len(found))
+        if not found and not message.get('nack'):
+            return
+        binary = self._answer_binary(message, reply_addr)
+        base = {'type': 'query_files_response', 'request_id': message.get('request_id'), 'part': message.get('part'), 'port': self.port}
+        responses = split_batches(base, 'found', found, RESPONSE_DATAGRAM_LIMIT, binary) or [{**base, 'found': []}]
+        # 'last' marks the final datagram for this query part so the searcher knows the peer is done with it.
+        responses[-1]['last'] = True
+        for response in responses:
+            self.engine.send(response, reply_addr, binary)
+
+    def _answer_search(self, message: Dict, addr: Tuple[str, int]):
+        reply_addr = self._reply_address(message, addr)
+        try:
+            limit = min(int(message.get('limit') or DEFAULT_SEARCH_LIMIT), MAX_SEARCH_RESULTS)
+            results, has_more = self.catalog.search(str(message.get('query', '')), **search_filters(message.get('filters')),
+                                                    limit=limit)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Malformed search from {reply_addr[0]}:{reply_addr[1]}: {e}")
+            return
+        found = [{key: result[key] for key in ('name', 'hash', 'size', 'mtime', 'rank')} for result in results]
+        QUERY_TRACE.info("search", reply_addr, message.get('query'), len(found))
+        base = {'type': 'search_response', 'request_id': message.get('request_id'), 'port': self.port, 'has_more': has_more}
+        responses = split_batches(base, 'results', found, RESPONSE_DATAGRAM_LIMIT) or [{**base, 'results': []}]
+        # Sent even without matches so the searcher can stop waiting for this peer.
+        responses[-1]['last'] = True
+        for response in responses:
+            self.engine.send(response, reply_addr)
+
+    def search(self, query: str, filters: Dict | None = None, limit: int = DEFAULT_SEARCH_LIMIT, offset: int = 0,
+               timeout_duration: float | None = None, targets: List[Tuple[str, int]] | None = None) -> Tuple[List[Dict], bool]:
+        return self._call(self.search_async(query, filters, limit, offset, timeout_duration, targets))
+
+    async def search_async(self, query: str, filters: Dict | None = None, limit: int = DEFAULT_SEARCH_LIMIT, offset: int = 0,
+                           timeout_duration: float | None = None,
+                           targets: List[Tuple[str, int]] | None = None) -> Tuple[List[Dict], bool]:
+        # Every peer returns its own best offset + limit matches; the page is cut from the merged ranking.
+        filters = search_filters(filters)
+        wanted = min(max(0, offset) + max(0, limit), MAX_SEARCH_RESULTS)
+        merged: Dict[str, Dict] = {}
+        answered: Set[Tuple[str, int]] = set()
+        more = False
+        expected = set(targets) if targets is not None else self.peer_table.live_peers()
+
+        def on_response(response: Dict, addr: Tuple[str, int]) -> bool:
+            nonlocal more
+            peer_port = response.get('port')
+            if response.get('type') != 'search_response' or peer_port is None:
+                return False
+            peer = (addr[0], peer_port)
+            if peer not in answered:
+                self.peer_table.observe_rtt(peer, time.monotonic() - sent_at)
+            for entry in response.get('results', []):
+                file_hash = entry.get('hash')
+                if not file_hash:
+                    continue
+                result = merged.setdefault(file_hash, {**entry, 'sources': []})
+                result['rank'] = min(result.get('rank', RANK_SUBSTRING), entry.get('rank', RANK_SUBSTRING))
+                if peer not in result['sources']:
+                    result['sources'].append(peer)
+            more = more or bool(response.get('has_more'))
+            if response.get('last'):
+                answered.add(peer)
+            return bool(expected) and expected <= answered
+
+        with self.engine.pending(on_response, targets) as (request_id, request):
+            message = {'type': 'search', 'request_id': request_id, 'reply_port': self.port, 'query': query,
+                       'filters': filters, 'limit': wanted}
+            sent_at = time.monotonic()
+            for destination, _ in self._query_destinations(targets):
+                self.engine.send(message, destination)
+            await self.engine.wait(request, self._search_deadline(sent_at, expected, timeout_duration) - sent_at)
+
+        if query.split():
+            # Better matches first, then files more peers can serve.
+            ranked = sorted(merged.values(), key=lambda r: (r['rank'], -len(r['sources']), len(r['name']), r['name']))
+        else:
+            # Attribute-only searches list the largest files first, as each catalog does.
+            ranked = sorted(merged.values(), key=lambda r: (-r.get('size', 0), r['name']))
+        page = ranked[offset:offset + limit]
+        LOOKUP_SECONDS.observe(time.monotonic() - sent_at, ("search", "found" if ranked else "not_found"))
+        logger.info(f"Search for {query!r} matched {len(ranked)} file(s) on {len(answered)} peer(s) in {time.monotonic() - sent_at:.3f}s")
+        return page, more or len(ranked) > offset + limit
+
+    def find_file_sources(self, names: List[str] = (), hashes: List[str] = (), timeout_duration: float | None = None,
+                          targets: List[Tuple[str, int]] | None = None) -> Dict[str, List[Tuple[str, int, str, int | None]]]:
+        return self._call(self.find_file_sources_async(names, hashes, timeout_duration, targets))
+
+    async def find_file_sources_async(self, names: List[str] = (), hashes: List[str] = (), timeout_duration: float | None = None,
+                                      targets: List[Tuple[str, int]] | None = None) -> Dict[str, List[Tuple[str, int, str, int | None]]]:
+        names, hashes = list(dict.fromkeys(names)), list(dict.fromkeys(hashes))
+        logger.info(f"Batch query for {len(names)} name(s) and {len(hashes)} hash(es)")
+        sources: Dict[str, Dict[Tuple[str, int], Tuple[str, int, str, int | None]]] = {key: {} for key in names + hashes}
+        if not sources:
+            return {}
+
+        if targets is None:
+            live_peers = self.peer_table.live_peers()
+            lookups = [self.availability.lookup_name(name, live_peers) for name in names] + \
+                [self.availability.lookup_hash(file_hash, live_peers) for file_hash in hashes]
+            if live_peers and all(complete for _, complete in lookups):
+                targets = sorted({peer for candidates, _ in lookups for peer in candidates})
+                if not targets:
+                    return {key: [] for key in sources}
+
+        expected = set(targets) if targets is not None else self.peer_table.live_peers()
+        answered_parts: Dict[Tuple[str, int], Set[int]] = {}
+        queries: List[Dict] = []
+
+        def on_response(response: Dict, addr: Tuple[str, int]) -> bool:
+            peer_port = response.get('port')
+            if response.get('type') != 'query_files_response' or peer_port is None:
+                return False
+            peer = (addr[0], peer_port)
+            if peer not in answered_parts:
+                self.peer_table.observe_rtt(peer, time.monotonic() - sent_at)
+                answered_parts[peer] = set()
+            for entry in response.get('found', []):
+                file_hash = entry.get('hash')
+                key = entry.get('name', file_hash)
+                if file_hash and key in sources:
+                    sources[key][peer] = (addr[0], peer_port, file_hash, entry.get('size'))
+            if response.get('last'):
+                answered_parts[peer].add(response.get('part'))
+            return bool(expected) and all(len(answered_parts.get(peer, ())) >= len(queries) for peer in expected)
+
+        destinations = self._query_destinations(targets)
+        # Every destination must see the same parts, so the split follows the least compact format in use.
+        binary_split = all(binary for _, binary in destinations)
+        with self.engine.pending(on_response, targets) as (request_id, request):
+            base = {'type': 'query_files', 'request_id': request_id, 'reply_port': self.port, 'nack': True, 'part': 0}
+            queries = split_batches({**base, 'hashes': []}, 'names', names, QUERY_DATAGRAM_LIMIT, binary_split) + \
+                split_batches({**base, 'names': []}, 'hashes', hashes, QUERY_DATAGRAM_LIMIT, binary_split)
+            for part, query in enumerate(queries):
+                query['part'] = part
+
+            sent_at = time.monotonic()
+            for destination, binary in destinations:
+                for query in queries:
+                    self.engine.send(query, destination, binary)
+            await self.engine.wait(request, self._search_deadline(sent_at, expected, timeout_duration) - sent_at)
+
+        found = sum(1 for holders in sources.values() if holders)
+        LOOKUP_SECONDS.observe(time.monotonic() - sent_at, ("file_sources", "found" if found else "not_found"))
+        logger.info(f"Batch query resolved {found}/{len(sources)} file(s) in {time.monotonic() - sent_at:.3f}s")
+        return {key: self.peer_table.rank(list(holders.values())) for key, holders in sources.items()}
+
+    def _broadcast_destinations(self) -> List[Tuple[str, int]]:
+        destinations = [(ip, self.discovery_target_port) for ip in self._broadcast_addresses()] if self.broadcast else []
+        return destinations + [seed for seed in self.seed_peers if seed not in destinations]
+
+    def _broadcast_addresses(self) -> List[str]:
+        fetched_at, cached = self._interfaces_cache
+        if cached and time.monotonic() - fetched_at < INTERFACE_CACHE_TTL:
+            return cached
         broadcast_addresses = []
         try:
-            interfaces = netifaces.interfaces()
-            for interface in interfaces:
-                ifaddresses = netifaces.ifaddresses(interface)
-                inet_info = ifaddresses.get(netifaces.AF_INET, [])
-                for link in inet_info:
+            for interface in netifaces.interfaces():
+                for link in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
                     broadcast_ip = link.get('broadcast')
                     if broadcast_ip:
                         broadcast_addresses.append(broadcast_ip)
         except Exception as e:
             logger.error(f"Error getting broadcast addresses: {e}. Using 255.255.255.255.", exc_info=True)
-            broadcast_addresses.append("255.255.255.255")
-
         if not broadcast_addresses:
-             logger.warning("No broadcast addresses found by netifaces, using 255.255.255.255 as a fallback.")
-             broadcast_addresses.append("255.255.255.255")
-        
-        logger.info(f"Attempting to broadcast file query to the following addresses: {list(set(broadcast_addresses))}")
-
-        for bcast_ip in set(broadcast_addresses):
-            try:
-               
-                self.discovery_socket.sendto(encoded_message, (bcast_ip, self.discovery_target_port))
-                logger.debug(f"File query for '{requested_filename}' sent to {bcast_ip}:{self.discovery_target_port}, reply expected on port {reply_to_port}")
-            except Exception as send_err:
-                logger.warning(f"Error sending file query to {bcast_ip}: {send_err}")
-        
-        start_time = time.time()
-        timeout_duration = 3
-        
-        response_socket.settimeout(0.5)
-
-        try:
-            while time.time() - start_time < timeout_duration:
-                try:
-                    data, addr = response_socket.recvfrom(1024)
-                    response = json.loads(data.decode())
-                    logger.debug(f"Received response while searching for file: {response} from {addr} on temp port {reply_to_port}")
-                    
-                    if response.get('type') == 'file_found_response' and \
-                       response.get('filename') == requested_filename:
-                        peer_ip = response.get('peer_ip', addr[0])
-                        file_hash = response.get('file_hash')
-                        peer_port = response.get('port')
-                        if peer_port is None:
-                            logger.warning(f"File_found_response from {peer_ip} for '{requested_filename}' did not include a port.")
-                            return None, None, None 
-                        logger.info(f"Found file '{requested_filename}' at {peer_ip}:{peer_port} with hash {file_hash}")
-                        return peer_ip, peer_port, file_hash 
-                except socket.timeout:
-                    continue
-                except json.JSONDecodeError:
-                    logger.warning(f"JSON decode error while searching for file from {addr[0] if 'addr' in locals() else 'unknown'}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving file_found_response: {e}", exc_info=True)
-                    continue
-        finally:
-            response_socket.close()
-            logger.debug(f"Closed temporary response socket on port {reply_to_port} for find_file_source")
-
-        logger.warning(f"File '{requested_filename}' not found on the network after {timeout_duration}s.")
-        return None, None, None
+            broadcast_addresses.append("255.255.255.255")
+        broadcast_addresses = sorted(set(broadcast_addresses))
+        if broadcast_addresses != cached:
+            logger.info(f"Broadcast addresses: {broadcast_addresses}")
+            # New interfaces may have new neighbours; announce at full rate again.
+            self._discovery_changed.set()
+        self._interfaces_cache = (time.monotonic(), broadcast_addresses)
+        return broadcast_addresses
 
     def query_peer_for_file(self, target_peer_address_str: str, requested_filename: str) -> tuple[str | None, int | None, str | None]:
-        
         logger.info(f"Querying peer {target_peer_address_str} for file: {requested_filename}")
-        
         try:
             target_ip, target_port_str = target_peer_address_str.split(':')
             target_port = int(target_port_str)
@@ -306,153 +696,162 @@ class DiscoverPeers:
             logger.error(f"Invalid peer address format: {target_peer_address_str}. Expected IP:PORT")
             return None, None, None
 
-        response_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        response_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            response_socket.bind(('0.0.0.0', 0))
-        except Exception as e:
-            logger.error(f"Error binding temporary response socket for query_peer_for_file: {e}", exc_info=True)
-            response_socket.close()
-            return None, None, None
-
-        reply_to_port = response_socket.getsockname()[1]
-        logger.debug(f"query_peer_for_file listening for response on temporary port {reply_to_port}")
-
-        message = {
-            'type': 'query_file',
-            'filename': requested_filename,
-            'reply_port': reply_to_port 
-        }
-        encoded_message = json.dumps(message).encode()
-
-        try:
-           
-            self.discovery_socket.sendto(encoded_message, (target_ip, target_port))
-            logger.debug(f"File query for '{requested_filename}' sent to {target_ip}:{target_port}, reply expected on port {reply_to_port}")
-        except Exception as send_err:
-            logger.warning(f"Error sending file query to {target_ip}:{target_port}: {send_err}")
-            response_socket.close() 
+        holders = self.find_file_holders(requested_filename, max_sources=1, targets=[(target_ip, target_port)])
+        if not holders:
+            logger.info(f"File '{requested_filename}' not found on peer {target_peer_address_str} or no response.")
             return None, None, None
-        
-        start_time = time.time()
-        timeout_duration = 2  
-        
-        response_socket.settimeout(0.2)
-
-        try:
-            while time.time() - start_time < timeout_duration:
-                try:
-                    data, addr = response_socket.recvfrom(1024)
-                    
-                    if addr[0] == target_ip: 
-                        response = json.loads(data.decode())
-                        logger.debug(f"Received response while querying {target_peer_address_str}: {response} from {addr} on temp port {reply_to_port}")
-                        
-                        if response.get('type') == 'file_found_response' and \
-                           response.get('filename') == requested_filename:
-                            peer_ip_from_response = response.get('peer_ip', addr[0])
-                            file_hash = response.get('file_hash')
-                            peer_port_from_response = response.get('port') 
-                            if peer_port_from_response is None:
-                                logger.warning(f"File_found_response from {target_peer_address_str} for '{requested_filename}' did not include a port.")
-                                return None, None, None
-                            logger.info(f"Peer {target_peer_address_str} has file '{requested_filename}' (IP: {peer_ip_from_response}, Port: {peer_port_from_response}, Hash: {file_hash})")
-                            return peer_ip_from_response, peer_port_from_response, file_hash 
-                except socket.timeout:
-                    continue
-                except json.JSONDecodeError:
-                    logger.warning(f"JSON decode error while querying {target_peer_address_str} from {addr[0] if 'addr' in locals() else 'unknown'}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving response from {target_peer_address_str}: {e}", exc_info=True)
-                    break 
-        finally:
-            response_socket.close()
-            logger.debug(f"Closed temporary response socket on port {reply_to_port} for query_peer_for_file")
-
-        logger.info(f"File '{requested_filename}' not found on peer {target_peer_address_str} or no response.")
-        return None, None, None
-
-    def receive_file(self, peer_ip: str, peer_port: int, file_hash: str, destination_path: str) -> bool:
-        logger.info(f"Requesting file with hash {file_hash} from {peer_ip}:{peer_port} to be saved at {destination_path}")
+        peer_ip, peer_port, file_hash, _ = holders[0]
+        logger.info(f"Peer {target_peer_address_str} has file '{requested_filename}' (Port: {peer_port}, Hash: {file_hash})")
+        return peer_ip, peer_port, file_hash
 
+    def _open_transfer_socket(self, purpose: str) -> socket.socket | None:
+        # Frame streams get their own socket so bulk data never queues behind control traffic on the event loop.
         response_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         response_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tune_socket_buffers(response_socket)
         try:
             response_socket.bind(('0.0.0.0', 0))
         except Exception as e:
-            logger.error(f"Error binding temporary response socket for receive_file: {e}", exc_info=True)
+            logger.error(f"Error binding data socket for {purpose}: {e}", exc_info=True)
             response_socket.close()
-            return False
-            
-        reply_to_port = response_socket.getsockname()[1]
-        logger.debug(f"receive_file listening for file data on temporary port {reply_to_port}")
+            return None
+        return response_socket
 
+    def _send_file_request(self, peer_ip: str, peer_port: int, file_hash: str, reply_to_port: int, chunks: List[int] | None = None) -> bool:
         request_message = {
             'type': 'receive_file', 
             'file_hash': file_hash,
             'port': reply_to_port
         }
+        if chunks is not None:
+            request_message['chunks'] = chunks
+        if self.compression:
+            request_message['compression'] = self.compression
+        rate = rate_limiter.requested_download_rate()
+        if rate:
+            request_message['rate'] = rate
         
         try:
-           
-            self.discovery_socket.sendto(json.dumps(request_message).encode(), (peer_ip, peer_port))
-            logger.debug(f"Sent 'receive_file' request to {peer_ip}:{peer_port} for hash {file_hash}, expecting data on port {reply_to_port}")
+            self.start_listening()
+            self.engine.send(request_message, (peer_ip, peer_port), self._speaks_binary((peer_ip, peer_port)))
+            TRANSFER_TRACE.info("file_requested", (peer_ip, peer_port), file_hash, reply_to_port, chunks is not None)
+            return True
         except Exception as e:
             logger.error(f"Error sending file request to {peer_ip}:{peer_port}: {e}", exc_info=True)
-            response_socket.close() 
             return False
 
-        start_time = time.time()
-        timeout_duration = 30
-        
-        response_socket.settimeout(2.0)
+    def _send_manifest_page(self, message: Dict, addr: Tuple[str, int]):
+        file_hash = message.get('file_hash')
+        file_path = self._path_for_hash(file_hash) if file_hash else None
+        if not file_path:
+            TRANSFER_TRACE.info("manifest_unknown", addr, file_hash)
+            return
+        first_chunk = int(message.get('first_chunk', 0))
+        reply_addr = self._reply_address(message, addr)
+        try:
+            manifest = (self.chunk_store.manifest(file_hash) if self.chunk_store is not None else None) or \
+                ManifestManager.generate_file_manifest(file_path, file_hash=file_hash, cache=self.manifest_cache)
+            page = manifest['chunks'][first_chunk:first_chunk + MANIFEST_PAGE_CHUNKS]
+            response = {
+                'type': 'manifest_response',
+                'request_id': message.get('request_id'),
+                'file_hash': file_hash,
+                'size': manifest['size'],
+                'chunk_count': manifest['chunk_count'],
+                'merkle_root': manifest['merkle_root'],
+                'first_chunk': first_chunk,
+                'chunks': base64.b64encode(b"".join(bytes.fromhex(h) for h in page)).decode()
+            }
+            self.engine.send(response, reply_addr)
+        except Exception as e:
+            logger.error(f"Error sending manifest page for {file_path} to {reply_addr[0]}:{reply_addr[1]}: {e}", exc_info=True)
+
+    def fetch_manifest(self, peer_ip: str, peer_port: int, file_hash: str, timeout_duration: float = 30.0) -> Dict | None:
+        return self._call(self.fetch_manifest_async(peer_ip, peer_port, file_hash, timeout_duration))
+
+    async def fetch_manifest_async(self, peer_ip: str, peer_port: int, file_hash: str, timeout_duration: float = 30.0) -> Dict | None:
+        chunk_hashes: List[str] = []
+        manifest = None
+        deadline = time.monotonic() + timeout_duration
+        wait = 1.0
+        while (remaining := deadline - time.monotonic()) > 0:
+            with self.engine.pending(peers=[(peer_ip, peer_port)]) as (request_id, request):
+                self.engine.send({'type': 'get_manifest', 'request_id': request_id, 'file_hash': file_hash,
+                                  'first_chunk': len(chunk_hashes), 'reply_port': self.port}, (peer_ip, peer_port))
+                reply = await self.engine.wait(request, min(wait, remaining))
+            if reply is None:
+                # The peer may still be hashing a large file; back off instead of piling up requests.
+                wait = min(wait * 2, 8.0)
+                continue
+            response, _ = reply
+            if response.get('type') != 'manifest_response' or response.get('file_hash') != file_hash \
+                    or response.get('first_chunk') != len(chunk_hashes):
+                continue
+            try:
+                raw = base64.b64decode(response['chunks'])
+                chunk_hashes.extend(raw[i:i + 32].hex() for i in range(0, len(raw), 32))
+                if len(chunk_hashes) >= response['chunk_count'] or not raw:
+                    manifest = {
+                        'version': MANIFEST_VERSION,
+                        'filename': None,
+                        'size': response['size'],
+                        'sha256': file_hash,
+                        'chunk_size': CHUNK_SIZE,
+                        'chunk_count': response['chunk_count'],
+                        'chunks': chunk_hashes,
+                        'merkle_root': response['merkle_root']
+                    }
+                    break
+            except (KeyError, ValueError, TypeError) as e:
+                logger.error(f"Malformed manifest page for {file_hash} from {peer_ip}:{peer_port}: {e}")
+                break
+
+        if manifest is None or len(chunk_hashes) != manifest['chunk_count'] or merkle_root(chunk_hashes) != manifest['merkle_root']:
+            logger.warning(f"Could not fetch a consistent manifest for {file_hash} from {peer_ip}:{peer_port}")
+            return None
+        return manifest
+
+    def receive_file(self, peer_ip: str, peer_port: int, file_hash: str, destination_path: str,
+                     cancelled: threading.Event | None = None, on_progress=None) -> bool:
+        logger.info(f"Requesting file with hash {file_hash} from {peer_ip}:{peer_port} to be saved at {destination_path}")
+
+        response_socket = self._open_transfer_socket("receive_file")
+        if response_socket is None:
+            return False
+        reply_to_port = response_socket.getsockname()[1]
 
         try:
-            while time.time() - start_time < timeout_duration:
-                try:
-                    data, addr = response_socket.recvfrom(65535) 
-                    logger.debug(f"Received {len(data)} bytes from {addr} while waiting for file on temp port {reply_to_port}")
-                    
-                    if addr[0] != peer_ip:
-                        logger.warning(f"Received data from unexpected IP {addr[0]} (expected {peer_ip}) while expecting file from {peer_ip} on port {reply_to_port}. Ignoring.")
-                        continue
-
-                    response = json.loads(data.decode())
-                    logger.debug(f"Received message type: {response.get('type')} from {addr} on temp port {reply_to_port} for hash {file_hash}")
-
-                    if response.get('type') == 'file_data' and response.get('file_hash') == file_hash:
-                        logger.info(f"Received file_data for hash {file_hash} from {addr[0]}")
-                        file_data_encoded = response.get('data')
-                        
-                        
-                        try:
-                            file_data_bytes = base64.b64decode(file_data_encoded)
-                            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
-                            with open(destination_path, 'wb') as f:
-                                f.write(file_data_bytes)
-                            logger.info(f"File {destination_path} received and saved successfully.")
-                            return True
-                        except (base64.binascii.Error, TypeError) as b64_err:
-                            logger.error(f"Base64 decode error for file {file_hash}: {b64_err}", exc_info=True)
-                            return False
-                        except IOError as io_err:
-                            logger.error(f"IOError writing file {destination_path}: {io_err}", exc_info=True)
-                            return False
-                except socket.timeout:
-                    continue
-                except json.JSONDecodeError:
-                    logger.warning(f"JSON decode error while receiving file data from {addr[0] if 'addr' in locals() else 'unknown'}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving file data: {e}", exc_info=True)
-                    return False 
+            if not self._send_file_request(peer_ip, peer_port, file_hash, reply_to_port):
+                return False
+            receiver = FileReceiver(response_socket, peer_ip, file_hash, destination_path)
+            if cancelled is not None:
+                receiver.cancelled = cancelled
+            if on_progress is not None:
+                receiver.on_chunk = lambda _: on_progress(receiver.bytes_received, receiver.file_size)
+            return receiver.receive()
+        except Exception as e:
+            logger.error(f"Error receiving file data: {e}", exc_info=True)
+            return False
         finally:
             response_socket.close()
-            logger.debug(f"Closed temporary response socket on port {reply_to_port} for receive_file")
 
-        logger.warning(f"Timeout or error receiving file {file_hash} from {peer_ip}:{peer_port}.")
-        return False
+    def request_chunks(self, peer_ip: str, peer_port: int, file_hash: str, f, chunks: List[int],
+                       expected_size: int | None = None, cancelled: threading.Event | None = None,
+                       idle_timeout: float = 10.0, on_chunk=None) -> Set[int]:
+        response_socket = self._open_transfer_socket("request_chunks")
+        if response_socket is None:
+            return set()
+        receiver = FileReceiver(response_socket, peer_ip, file_hash, idle_timeout=idle_timeout, on_chunk=on_chunk)
+        if cancelled is not None:
+            receiver.cancelled = cancelled
+        try:
+            if self._send_file_request(peer_ip, peer_port, file_hash, response_socket.getsockname()[1], chunks):
+                receiver.receive_into(f, expected_size)
+        except Exception as e:
+            logger.error(f"Error receiving chunks of {file_hash} from {peer_ip}:{peer_port}: {e}", exc_info=True)
+        finally:
+            response_socket.close()
+        return receiver.completed_chunks
 
     def get_key_by_value(self,d, target_value_basename):
         
@@ -477,7 +876,13 @@ class DiscoverPeers:
         except Exception:
             return '127.0.0.1'
         
+    @property
+    def local_files(self) -> Dict[str, str]:
+        return self.share_index.files()
+
     def list_all_files(self, directory):
+        if os.path.abspath(directory) == self.share_index.directory:
+            return self.share_index.files()
         files = {}
         for root, _, filenames in os.walk(directory):
             for filename in filenames:
@@ -487,10 +892,4 @@ class DiscoverPeers:
         return files
 
     def hash_file(self, filepath):
-        sha256_hash = hashlib.sha256()
-
-        with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-
-        return sha256_hash.hexdigest()
\ No newline at end of file
+        return hash_file(filepath)
\ No newline at end of file
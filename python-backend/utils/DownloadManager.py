@@ -0,0 +1,279 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from utils.Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+PAUSED = "paused"
+CANCELLED = "cancelled"
+COMPLETED = "completed"
+FAILED = "failed"
+ACTIVE_STATES = (QUEUED, RUNNING, PAUSED)
+
+DEFAULT_MAX_CONCURRENT = 3
+PROGRESS_INTERVAL = 0.5
+RATE_SMOOTHING = 0.3
+MAX_FINISHED_JOBS = 500
+
+DOWNLOAD_JOBS = metrics.gauge("p2p_download_jobs", "Download jobs queued, running or paused", ("state",))
+
+
+class DownloadJob:
+    def __init__(self, job_id: int, filename: str, priority: int = 0, destination: str | None = None):
+        self.job_id = job_id
+        self.filename = filename
+        # Where the file goes, relative to the share; the requested name unless resuming into a subfolder.
+        self.destination = destination or filename
+        self.priority = priority
+        self.state = QUEUED
+        self.bytes_done = 0
+        self.total_bytes: int | None = None
+        self.rate = 0.0
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.cancelled = threading.Event()
+        # PAUSED or CANCELLED when the user interrupts a running job; decides its state once the download returns.
+        self.requested_state: str | None = None
+        self.queue_seq = -1
+        self._sample: tuple[float, int] | None = None
+        self._last_event = 0.0
+
+    @property
+    def eta(self) -> float | None:
+        if self.total_bytes is None or self.rate <= 0:
+            return None
+        return max(self.total_bytes - self.bytes_done, 0) / self.rate
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "destination": self.destination,
+            "priority": self.priority,
+            "state": self.state,
+            "bytes_done": self.bytes_done,
+            "total_bytes": self.total_bytes,
+            "rate": round(self.rate, 1),
+            "eta": round(self.eta, 1) if self.eta is not None else None,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class DownloadManager:
+    def __init__(self, download: Callable[..., bool], max_concurrent: int = DEFAULT_MAX_CONCURRENT,
+                 discard: Callable[[str], None] | None = None):
+        self.download = download
+        self.discard = discard
+        self.max_concurrent = max_concurrent
+        self.jobs: Dict[int, DownloadJob] = {}
+        # (-priority, sequence, job_id); entries whose sequence no longer matches the job are stale and skipped.
+        self._queue: List[tuple] = []
+        self._sequence = itertools.count()
+        self._job_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._subscribers: List[Callable[[str, Dict], None]] = []
+        self._stopped = False
+        DOWNLOAD_JOBS.track(self.state_counts)
+        self._workers = [threading.Thread(target=self._worker_loop, name=f"download-{i}", daemon=True)
+                         for i in range(max_concurrent)]
+        for worker in self._workers:
+            worker.start()
+
+    def subscribe(self, callback: Callable[[str, Dict], None]):
+        with self._cond:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[str, Dict], None]):
+        with self._cond:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _emit(self, event: str, job: DownloadJob):
+        payload = job.to_dict()
+        with self._cond:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event, payload)
+            except Exception as e:
+                logger.error(f"Download event subscriber failed: {e}", exc_info=True)
+
+    def _enqueue(self, job: DownloadJob):
+        job.queue_seq = next(self._sequence)
+        heapq.heappush(self._queue, (-job.priority, job.queue_seq, job.job_id))
+        self._cond.notify()
+
+    def submit(self, filename: str, priority: int = 0, destination: str | None = None) -> DownloadJob:
+        with self._cond:
+            for job in self.jobs.values():
+                if job.destination == (destination or filename) and job.state in ACTIVE_STATES:
+                    return job
+            job = DownloadJob(next(self._job_ids), filename, priority, destination)
+            self.jobs[job.job_id] = job
+            self._enqueue(job)
+            self._prune()
+        logger.info(f"Queued download job {job.job_id} for {filename} (priority {priority})")
+        self._emit("queued", job)
+        return job
+
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if job.state not in ACTIVE_STATES]
+        for job in sorted(finished, key=lambda j: j.finished_at or 0)[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job.job_id]
+
+    def list_jobs(self) -> List[Dict]:
+        with self._cond:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def state_counts(self) -> Dict[Tuple[str], int]:
+        with self._cond:
+            counts = {(state,): 0 for state in ACTIVE_STATES}
+            for job in self.jobs.values():
+                if job.state in ACTIVE_STATES:
+                    counts[(job.state,)] += 1
+            return counts
+
+    def set_priority(self, job_id: int, priority: int) -> bool:
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in ACTIVE_STATES:
+                return False
+            job.priority = priority
+            if job.state == QUEUED:
+                self._enqueue(job)
+        self._emit("priority", job)
+        return True
+
+    def pause(self, job_id: int) -> bool:
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            if job.state == QUEUED:
+                job.state = PAUSED
+            elif job.state == RUNNING:
+                job.requested_state = PAUSED
+                job.cancelled.set()
+                return True
+            else:
+                return False
+        self._emit(PAUSED, job)
+        return True
+
+    def resume(self, job_id: int) -> bool:
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None or job.state != PAUSED:
+                return False
+            job.state = QUEUED
+            self._enqueue(job)
+        self._emit("resumed", job)
+        return True
+
+    def cancel(self, job_id: int) -> bool:
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            if job.state == RUNNING:
+                job.requested_state = CANCELLED
+                job.cancelled.set()
+                return True
+            if job.state not in (QUEUED, PAUSED):
+                return False
+            job.state = CANCELLED
+            job.finished_at = time.time()
+        self._discard(job)
+        self._emit(CANCELLED, job)
+        return True
+
+    def _discard(self, job: DownloadJob):
+        if self.discard is not None:
+            try:
+                self.discard(job.destination)
+            except OSError as e:
+                logger.warning(f"Could not remove partial download of {job.destination}: {e}")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            # Running downloads keep their partial state so they resume on the next start.
+            for job in self.jobs.values():
+                if job.state == RUNNING:
+                    job.requested_state = PAUSED
+                    job.cancelled.set()
+            self._cond.notify_all()
+
+    def _next_job(self) -> DownloadJob | None:
+        with self._cond:
+            while not self._stopped:
+                while self._queue:
+                    _, sequence, job_id = heapq.heappop(self._queue)
+                    job = self.jobs.get(job_id)
+                    if job is not None and job.state == QUEUED and job.queue_seq == sequence:
+                        job.state = RUNNING
+                        job.requested_state = None
+                        job.cancelled.clear()
+                        job.error = None
+                        job.started_at = time.time()
+                        job._sample = None
+                        return job
+                self._cond.wait()
+            return None
+
+    def _worker_loop(self):
+        while (job := self._next_job()) is not None:
+            self._emit("started", job)
+            try:
+                success = self.download(job.filename, cancelled=job.cancelled, destination=job.destination,
+                                        on_progress=lambda done, total, job=job: self._progress(job, done, total))
+            except Exception as e:
+                logger.error(f"Download job {job.job_id} for {job.filename} crashed: {e}", exc_info=True)
+                job.error = str(e)
+                success = False
+
+            with self._cond:
+                if success:
+                    # A pause or cancel that arrived as the download finished is moot: the file is in the share.
+                    job.state = COMPLETED
+                elif job.requested_state is not None:
+                    job.state = job.requested_state
+                else:
+                    job.state = FAILED
+                    job.error = job.error or "No peer could deliver the file"
+                if job.state != PAUSED:
+                    job.finished_at = time.time()
+                if job.state == COMPLETED and job.total_bytes is not None:
+                    job.bytes_done = job.total_bytes
+            if job.state == CANCELLED:
+                self._discard(job)
+            logger.info(f"Download job {job.job_id} for {job.filename} {job.state}")
+            self._emit(job.state, job)
+
+    def _progress(self, job: DownloadJob, bytes_done: int, total_bytes: int | None):
+        now = time.monotonic()
+        if job._sample is not None:
+            sample_time, sample_bytes = job._sample
+            elapsed = now - sample_time
+            if elapsed < PROGRESS_INTERVAL / 2:
+                job.bytes_done, job.total_bytes = bytes_done, total_bytes
+                return
+            rate = (bytes_done - sample_bytes) / elapsed
+            job.rate = rate if job.rate <= 0 else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * job.rate
+        job._sample = (now, bytes_done)
+        job.bytes_done, job.total_bytes = bytes_done, total_bytes
+        if now - job._last_event >= PROGRESS_INTERVAL:
+            job._last_event = now
+            self._emit("progress", job)
@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, Set
+
+from utils.FileTransfer import read_at
+from utils.ManifestManager import CHUNK_SIZE, hash_whole_file, merkle_root
+
+logger = logging.getLogger(__name__)
+
+BITMAP_MAGIC = b"P2PB\x01"
+
+
+class DownloadState:
+    def __init__(self, destination_path: str, manifest: Dict, done: bytearray, requested_filename: str | None = None):
+        self.destination_path = destination_path
+        # The name peers were asked for; a resumed download searches for it again, whatever folder it lands in.
+        self.requested_filename = requested_filename or os.path.basename(destination_path)
+        self.manifest = manifest
+        self.done = done
+        self.part_path, self.manifest_path, self.bitmap_path = DownloadState.sidecar_paths(destination_path)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sidecar_paths(destination_path: str):
+        directory, name = os.path.split(destination_path)
+        return (destination_path + ".part",
+                os.path.join(directory, f".{name}.manifest.json"),
+                os.path.join(directory, f".{name}.bitmap"))
+
+    @property
+    def file_hash(self) -> str:
+        return self.manifest["sha256"]
+
+    @property
+    def file_size(self) -> int:
+        return self.manifest["size"]
+
+    @property
+    def chunk_count(self) -> int:
+        return self.manifest["chunk_count"]
+
+    @classmethod
+    def load(cls, destination_path: str) -> "DownloadState | None":
+        part_path, manifest_path, bitmap_path = cls.sidecar_paths(destination_path)
+        try:
+            with open(manifest_path, "r") as f:
+                saved = json.load(f)
+            # Sidecars written before the requested name was kept hold just the manifest.
+            manifest, requested_filename = (saved["manifest"], saved.get("requested_filename")) if "manifest" in saved \
+                else (saved, None)
+            with open(bitmap_path, "rb") as f:
+                raw = f.read()
+            part_size = os.path.getsize(part_path)
+        except (OSError, ValueError, TypeError):
+            return None
+        if not raw.startswith(BITMAP_MAGIC) or part_size != manifest.get("size"):
+            logger.warning(f"Discarding inconsistent partial download state for {destination_path}")
+            return None
+        bitmap = bytearray(raw[len(BITMAP_MAGIC):])
+        if len(bitmap) != (manifest["chunk_count"] + 7) // 8:
+            return None
+        return cls(destination_path, manifest, bitmap, requested_filename)
+
+    @classmethod
+    def create(cls, destination_path: str, manifest: Dict, requested_filename: str | None = None) -> "DownloadState":
+        if len(manifest.get("chunks", [])) != manifest.get("chunk_count") or merkle_root(manifest["chunks"]) != manifest.get("merkle_root"):
+            raise ValueError(f"Manifest for {manifest.get('sha256')} is inconsistent")
+        state = cls(destination_path, manifest, bytearray((manifest["chunk_count"] + 7) // 8), requested_filename)
+        os.makedirs(os.path.dirname(destination_path) or ".", exist_ok=True)
+        with open(state.part_path, "wb") as f:
+            f.truncate(state.file_size)
+        with open(state.manifest_path + ".tmp", "w") as f:
+            json.dump({"requested_filename": state.requested_filename, "manifest": manifest}, f)
+        os.replace(state.manifest_path + ".tmp", state.manifest_path)
+        with open(state.bitmap_path, "wb") as f:
+            f.write(BITMAP_MAGIC + bytes(state.done))
+        return state
+
+    @classmethod
+    def load_or_create(cls, destination_path: str, manifest: Dict) -> "DownloadState":
+        state = cls.load(destination_path)
+        if state is not None and state.file_hash == manifest["sha256"]:
+            return state
+        return cls.create(destination_path, manifest)
+
+    def is_done(self, chunk_index: int) -> bool:
+        return bool(self.done[chunk_index >> 3] & (1 << (chunk_index & 7)))
+
+    def done_chunks(self) -> Set[int]:
+        return {c for c in range(self.chunk_count) if self.is_done(c)}
+
+    def is_complete(self) -> bool:
+        return all(self.is_done(c) for c in range(self.chunk_count))
+
+    def verify_and_mark(self, chunk_index: int, fd: int) -> bool:
+        length = min(CHUNK_SIZE, self.file_size - chunk_index * CHUNK_SIZE)
+        digest = hashlib.sha256(read_at(fd, chunk_index * CHUNK_SIZE, length)).hexdigest()
+        if digest != self.manifest["chunks"][chunk_index]:
+            return False
+        with self._lock:
+            if self.is_done(chunk_index):
+                return True
+            byte_index = chunk_index >> 3
+            self.done[byte_index] |= 1 << (chunk_index & 7)
+            # Rewrite only the byte that changed so progress survives a crash at O(1) cost per chunk.
+            with open(self.bitmap_path, "r+b") as f:
+                f.seek(len(BITMAP_MAGIC) + byte_index)
+                f.write(self.done[byte_index:byte_index + 1])
+        return True
+
+    def finalize(self) -> bool:
+        if not self.is_complete():
+            return False
+        if hash_whole_file(self.part_path) != self.file_hash:
+            logger.error(f"Hash mismatch for {self.destination_path} despite verified chunks, discarding download.")
+            self.discard()
+            return False
+        os.replace(self.part_path, self.destination_path)
+        self._remove_sidecars()
+        return True
+
+    def discard(self):
+        for path in (self.part_path, self.manifest_path, self.bitmap_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _remove_sidecars(self):
+        for path in (self.manifest_path, self.bitmap_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def pending_downloads(directory: str):
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.startswith('.') and filename.endswith(".bitmap"):
+                    destination_path = os.path.join(root, filename[1:-len(".bitmap")])
+                    state = DownloadState.load(destination_path)
+                    if state is not None:
+                        yield state
@@ -1,15 +1,85 @@
 import socket
 import os
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+from utils.FileTransfer import ACTIVE_TRANSFERS, PEER_BYTES, tune_socket_buffers, write_at
+from utils.RateLimiter import LANE_BULK, rate_limiter as shared_rate_limiter, set_traffic_class
+from utils.ShareIndex import hash_file
+
+MAX_HEADER_SIZE = 8192
+DEFAULT_MAX_CONNECTIONS = 32
+CONNECTION_IDLE_TIMEOUT = 30.0
+DEFAULT_CLIENT_CONNECTIONS = 4
+CLIENT_BUFFER_SIZE = 1024 * 1024
+RANGE_SIZE = 16 * 1024 * 1024
+# Under a rate limit, sendfile goes out in slices this size so each one can wait for its tokens.
+THROTTLED_SLICE = 64 * 1024
+STATUS_TEXT = {
+    200: "OK",
+    206: "Partial Content",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    500: "Internal Server Error",
+}
+
+
+def parse_range(value, file_size):
+    # Single "bytes=start-end", "bytes=start-" or "bytes=-suffix" range; anything else is ignored.
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    start_text, _, end_text = value[len("bytes="):].strip().partition("-")
+    try:
+        if not start_text:
+            suffix = int(end_text)
+            if suffix <= 0:
+                raise ValueError
+            return max(0, file_size - suffix), file_size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size:
+        return start, None
+    if start > end:
+        return None
+    return start, min(end, file_size - 1)
+
+
+def throttled_sendfile(conn, f, offset, count, throttle):
+    if throttle is None or not throttle.limited:
+        return conn.sendfile(f, offset, count)
+    sent = 0
+    while sent < count:
+        size = min(THROTTLED_SLICE, count - sent)
+        throttle.wait(size)
+        written = conn.sendfile(f, offset + sent, size)
+        if not written:
+            break
+        sent += written
+    return sent
+
 
 class FileServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, share_index=None, max_connections=DEFAULT_MAX_CONNECTIONS, rate_limiter=None):
         self.host = host
         self.port = port
         self.running = False
         self.server = None
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.public_files_dir = os.path.abspath(os.path.join(script_dir, "publicFiles"))
+        self.share_index = share_index
+        self.max_connections = max_connections
+        self.rate_limiter = rate_limiter or shared_rate_limiter
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._executor = None
+        if share_index is not None:
+            self.public_files_dir = share_index.directory
+        else:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            self.public_files_dir = os.path.abspath(os.path.join(script_dir, "publicFiles"))
         
         if not os.path.isdir(self.public_files_dir):
             try:
@@ -20,7 +90,7 @@ class FileServer:
         
         print(f"FileServer: Serving files from '{self.public_files_dir}'")
 
-    def send_file(self, requested_filename, conn):
+    def resolve_file(self, requested_filename):
         if not os.path.isdir(self.public_files_dir):
             try:
                 print(f"FileServer: Public files directory '{self.public_files_dir}' not found. Attempting to recreate.")
@@ -28,104 +98,337 @@ class FileServer:
                 print(f"FileServer: Successfully recreated public files directory '{self.public_files_dir}'.")
             except OSError as e:
                 print(f"FileServer: FAILED to recreate public files directory '{self.public_files_dir}': {e}")
-                error_msg = b"ERROR: Server configuration issue (public directory could not be accessed or created)."
-                conn.sendall(error_msg)
-                return
-        
-        if not os.path.isdir(self.public_files_dir):
-             print(f"FileServer: CRITICAL - Public files directory '{self.public_files_dir}' is still not accessible after creation attempt.")
-             error_msg = b"ERROR: Server critical issue (public directory state invalid)."
-             conn.sendall(error_msg)
-             return
+                return None, 500, "Server configuration issue (public directory could not be accessed or created)."
 
         if ".." in requested_filename or requested_filename.startswith('/') or requested_filename.startswith('\\'):
-            error_msg = b"ERROR: Invalid filename."
-            conn.sendall(error_msg)
             print(f"FileServer: Denied invalid filename request: '{requested_filename}'")
-            return
+            return None, 400, "Invalid filename."
 
-        prospective_path = os.path.join(self.public_files_dir, requested_filename)
-        abs_file_path = os.path.abspath(prospective_path)
+        if self.share_index is not None and requested_filename == os.path.basename(requested_filename):
+            file_hash = self.share_index.hash_for_name(requested_filename)
+            indexed_path = self.share_index.path_for_hash(file_hash) if file_hash else None
+            if indexed_path and os.path.isfile(indexed_path):
+                return indexed_path, 200, None
 
-        if not os.path.isdir(self.public_files_dir):
-            error_msg = b"ERROR: Server configuration issue (public directory not found)."
-            conn.sendall(error_msg)
-            print(f"FileServer: Error - Public files directory not found or not a directory: '{self.public_files_dir}'")
-            return
-            
-        if not abs_file_path.startswith(self.public_files_dir + os.sep) and abs_file_path != self.public_files_dir:
-            error_msg = b"ERROR: Access denied."
-            conn.sendall(error_msg)
+        abs_file_path = os.path.abspath(os.path.join(self.public_files_dir, requested_filename))
+        if not abs_file_path.startswith(self.public_files_dir + os.sep):
             print(f"FileServer: Denied access to '{abs_file_path}' (not within '{self.public_files_dir}')")
-            return
+            return None, 403, "Access denied."
 
         if not os.path.isfile(abs_file_path):
-            error_msg = b"ERROR: File not found."
-            conn.sendall(error_msg)
             print(f"FileServer: File not found at '{abs_file_path}'")
-            return
+            return None, 404, "File not found."
+
+        return abs_file_path, 200, None
 
+    def _hash_for_path(self, abs_file_path, st):
+        if self.share_index is None:
+            return None
+        entry = self.share_index.entries.get(abs_file_path)
+        # Only advertise a hash the index computed for exactly this version of the file.
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[3]
+        return None
+
+    def send_file(self, requested_filename, conn, throttle=None):
+        abs_file_path, _, error = self.resolve_file(requested_filename)
+        if abs_file_path is None:
+            conn.sendall(f"ERROR: {error}".encode())
+            return
         try:
-            with open(abs_file_path, 'rb') as f:
-                while chunk := f.read(1024):
-                    conn.sendall(chunk)
+            with open(abs_file_path, 'rb') as f, ACTIVE_TRANSFERS.in_progress(("http", "upload")):
+                sent = throttled_sendfile(conn, f, 0, os.fstat(f.fileno()).st_size, throttle)
+            PEER_BYTES.inc((conn.getpeername()[0], "upload"), sent)
             print(f"FileServer: Successfully sent file '{abs_file_path}'")
-        except IOError as e:
-            print(f"FileServer: IOError sending file '{abs_file_path}': {e}")
-            conn.sendall(b"ERROR: Could not read or send file.")
+        except OSError as e:
+            print(f"FileServer: Error sending file '{abs_file_path}': {e}")
+
+    def _send_response(self, conn, status, headers, body=b""):
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT[status]}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        conn.sendall(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+
+    def _send_error(self, conn, status, message, keep_alive, extra_headers=None):
+        body = (message or STATUS_TEXT[status]).encode()
+        headers = {"Content-Type": "text/plain", "Content-Length": len(body),
+                   "Connection": "keep-alive" if keep_alive else "close", **(extra_headers or {})}
+        self._send_response(conn, status, headers, body)
+
+    def _serve_request(self, conn, method, target, headers, throttle=None):
+        keep_alive = headers.get("connection", "").lower() != "close"
+        if method not in ("GET", "HEAD"):
+            self._send_error(conn, 405, None, keep_alive)
+            return keep_alive
+
+        requested_filename = unquote(target.lstrip("/"))
+        abs_file_path, status, error = self.resolve_file(requested_filename)
+        if abs_file_path is None:
+            self._send_error(conn, status, error, keep_alive)
+            return keep_alive
+
+        with open(abs_file_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            response_headers = {"Accept-Ranges": "bytes", "Connection": "keep-alive" if keep_alive else "close"}
+            file_hash = self._hash_for_path(abs_file_path, st)
+            if file_hash:
+                response_headers["X-Content-SHA256"] = file_hash
+
+            byte_range = parse_range(headers.get("range"), st.st_size)
+            if byte_range is None:
+                status, offset, count = 200, 0, st.st_size
+            elif byte_range[1] is None:
+                self._send_error(conn, 416, None, keep_alive, {"Content-Range": f"bytes */{st.st_size}"})
+                return keep_alive
+            else:
+                status, offset, count = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+                response_headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{st.st_size}"
+            response_headers["Content-Length"] = count
+
+            self._send_response(conn, status, response_headers)
+            if method == "GET" and count:
+                # socket.sendfile uses os.sendfile where available, so the file never passes through userspace.
+                with ACTIVE_TRANSFERS.in_progress(("http", "upload")):
+                    sent = throttled_sendfile(conn, f, offset, count, throttle)
+                PEER_BYTES.inc((conn.getpeername()[0], "upload"), sent)
+                if sent != count:
+                    raise ConnectionError(f"sent {sent} of {count} bytes of '{abs_file_path}'")
+        return keep_alive
+
+    def handle_connection(self, conn, addr):
+        try:
+            conn.settimeout(CONNECTION_IDLE_TIMEOUT)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            set_traffic_class(conn, LANE_BULK)
+            # Every request on this connection shares one per-transfer bucket under the global and per-peer ones.
+            throttle = self.rate_limiter.uploader(addr[0])
+            buffer = b""
+            while self.running:
+                data = conn.recv(MAX_HEADER_SIZE)
+                if not data:
+                    break
+                buffer += data
+                if not buffer.startswith(b"GET ") and not buffer.startswith(b"HEAD "):
+                    # Legacy clients send a bare filename and read the raw file until the connection closes.
+                    requested_file = buffer.decode(errors="replace")
+                    print("İstenen dosya:", requested_file)
+                    self.send_file(requested_file, conn, throttle)
+                    break
+
+                while b"\r\n\r\n" in buffer:
+                    head, buffer = buffer.split(b"\r\n\r\n", 1)
+                    request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                    try:
+                        method, target, _ = request_line.split(" ", 2)
+                    except ValueError:
+                        self._send_error(conn, 400, "Malformed request line.", False)
+                        return
+                    headers = {}
+                    for line in header_lines:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    if not self._serve_request(conn, method, target, headers, throttle):
+                        return
+                if len(buffer) > MAX_HEADER_SIZE:
+                    self._send_error(conn, 400, "Request header too large.", False)
+                    break
+        except (socket.timeout, ConnectionError) as e:
+            print(f"FileServer: Connection from {addr} ended: {e}")
         except Exception as e:
-            print(f"FileServer: Unexpected error sending file '{abs_file_path}': {e}")
-            conn.sendall(b"ERROR: Server error while sending file.")
+            print(f"Dosya sunucusu hatası: {e}")
+        finally:
+            conn.close()
+            self._slots.release()
 
     def start_server(self):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((self.host, self.port))
-        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        self.server.listen(128)
         self.server.settimeout(1.0)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix="file-server")
         print("Dosya sunucusu başlatıldı...")
         
         self.running = True
         
         while self.running:
+            # Connections beyond the limit wait in the listen backlog until a worker frees up.
+            if not self._slots.acquire(timeout=1.0):
+                continue
             try:
                 conn, addr = self.server.accept()
-                print("Bağlantı geldi:", addr)
-                
-                requested_file = conn.recv(1024).decode()
-                print("İstenen dosya:", requested_file)
-                
-                self.send_file(requested_file, conn)
-                conn.close()
             except socket.timeout:
+                self._slots.release()
+                continue
+            except OSError as e:
+                self._slots.release()
+                if self.running:
+                    print(f"Dosya sunucusu hatası: {e}")
                 continue
-            except Exception as e:
-                print(f"Dosya sunucusu hatası: {e}")
+            print("Bağlantı geldi:", addr)
+            self._executor.submit(self.handle_connection, conn, addr)
     
     def stop_server(self):
         self.running = False
         if self.server:
             self.server.close()
+        if self._executor:
+            self._executor.shutdown(wait=False)
         print("Dosya sunucusu durduruldu.")
 
 class FileClient:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, download_dir="publicFiles", connections=DEFAULT_CLIENT_CONNECTIONS,
+                 buffer_size=CLIENT_BUFFER_SIZE, range_size=RANGE_SIZE, rate_limiter=None):
         self.ip = ip
         self.port = port
+        self.download_dir = download_dir
+        self.connections = connections
+        self.buffer_size = buffer_size
+        self.range_size = range_size
+        self.rate_limiter = rate_limiter or shared_rate_limiter
 
-    def request_file(self, filename):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((self.ip, self.port))
+    def _connect(self):
+        conn = socket.create_connection((self.ip, self.port), timeout=CONNECTION_IDLE_TIMEOUT)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tune_socket_buffers(conn)
+        return conn
 
-        client.send(filename.encode()) 
+    def _request(self, conn, method, filename, buffer, byte_range=None):
+        request = f"{method} /{quote(filename)} HTTP/1.1\r\nHost: {self.ip}:{self.port}\r\n"
+        if byte_range is not None:
+            request += f"Range: bytes={byte_range[0]}-{byte_range[1]}\r\n"
+        conn.sendall((request + "\r\n").encode())
 
-        with open(f'received_{filename}', 'wb') as f:
-            while True:
-                data = client.recv(1024)
-                if not data:
-                    break
-                if b"ERROR" in data:
-                    print(data.decode()) 
-                    break
-                f.write(data)
+        view = memoryview(buffer)
+        filled = 0
+        while True:
+            # A full buffer would hand recv_into an empty view, whose 0 looks like the server hanging up.
+            if filled >= len(buffer):
+                raise ConnectionError("Response header too large")
+            received = conn.recv_into(view[filled:])
+            if not received:
+                raise ConnectionError("Server closed the connection before sending a response header")
+            filled += received
+            header_end = buffer.find(b"\r\n\r\n", 0, filled)
+            if header_end >= 0:
+                break
+            if filled >= MAX_HEADER_SIZE:
+                raise ConnectionError("Response header too large")
+
+        status_line, *header_lines = bytes(view[:header_end]).decode("latin-1").split("\r\n")
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        status = int(status_line.split(" ", 2)[1])
+        body_start = header_end + 4
+        return status, headers, body_start, filled
+
+    def _read_error(self, conn, headers, buffer, body_start, filled):
+        length = int(headers.get("content-length", 0))
+        body = bytearray(buffer[body_start:filled])
+        while len(body) < length:
+            data = conn.recv(length - len(body))
+            if not data:
+                break
+            body += data
+        return body.decode(errors="replace")
+
+    def file_info(self, filename):
+        with self._connect() as conn:
+            buffer = bytearray(MAX_HEADER_SIZE)
+            status, headers, body_start, filled = self._request(conn, "HEAD", filename, buffer)
+            if status != 200:
+                raise FileNotFoundError(f"{filename}: HTTP {status}")
+            return int(headers["content-length"]), headers.get("x-content-sha256")
+
+    def _receive_body(self, conn, fd, offset, length, view, body_start, filled, throttle=None):
+        # The tail of the header read may already hold the start of the body.
+        leftover = min(filled - body_start, length)
+        if leftover:
+            written = 0
+            while written < leftover:
+                written += write_at(fd, offset + written, view[body_start + written:body_start + leftover])
+            if throttle is not None:
+                throttle.wait(leftover)
+        position, remaining = offset + leftover, length - leftover
+        while remaining:
+            received = conn.recv_into(view, min(remaining, len(view)))
+            if not received:
+                raise ConnectionError(f"Connection closed with {remaining} bytes of range at {offset} outstanding")
+            written = 0
+            while written < received:
+                written += write_at(fd, position + written, view[written:received])
+            position += received
+            remaining -= received
+            if throttle is not None:
+                # Reading slower lets TCP flow control slow the server down.
+                throttle.wait(received)
+        PEER_BYTES.inc((self.ip, "download"), length)
+
+    def _range_worker(self, filename, fd, ranges, lock, failures, throttle=None):
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        conn = None
+        try:
+            while not failures:
+                with lock:
+                    if not ranges:
+                        return
+                    start, end = ranges.pop()
+                # Connections are kept alive and reused for every range this worker picks up.
+                conn = conn or self._connect()
+                status, headers, body_start, filled = self._request(conn, "GET", filename, buffer, (start, end))
+                if status != 206 or not headers.get("content-range", "").startswith(f"bytes {start}-{end}/"):
+                    raise ConnectionError(f"Unexpected response {status} for bytes {start}-{end}: {self._read_error(conn, headers, buffer, body_start, filled)}")
+                self._receive_body(conn, fd, start, end - start + 1, view, body_start, filled, throttle)
+                if headers.get("connection", "").lower() == "close":
+                    conn.close()
+                    conn = None
+        except Exception as e:
+            failures.append(e)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def request_file(self, filename, destination_path=None):
+        destination_path = destination_path or os.path.join(self.download_dir, os.path.basename(filename))
+        part_path = destination_path + ".part"
+        try:
+            file_size, file_hash = self.file_info(filename)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"FileClient: Could not request '{filename}' from {self.ip}:{self.port}: {e}")
+            return False
+
+        os.makedirs(os.path.dirname(destination_path) or ".", exist_ok=True)
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, file_size)
+            ranges = [(start, min(start + self.range_size, file_size) - 1) for start in range(0, file_size, self.range_size)]
+            # Workers pop from the end, so reverse to fetch the file front to back.
+            ranges.reverse()
+            lock = threading.Lock()
+            failures = []
+            throttle = self.rate_limiter.downloader(self.ip)
+            workers = [threading.Thread(target=self._range_worker, args=(filename, fd, ranges, lock, failures, throttle),
+                                        daemon=True)
+                       for _ in range(max(1, min(self.connections, len(ranges))))]
+            with ACTIVE_TRANSFERS.in_progress(("http", "download")):
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        finally:
+            os.close(fd)
 
-        client.close()
\ No newline at end of file
+        if failures:
+            print(f"FileClient: Download of '{filename}' failed: {failures[0]}")
+            os.remove(part_path)
+            return False
+        if file_hash and hash_file(part_path) != file_hash:
+            print(f"FileClient: Hash mismatch for '{filename}', discarding download.")
+            os.remove(part_path)
+            return False
+        os.replace(part_path, destination_path)
+        print(f"FileClient: Received '{filename}' ({file_size} bytes) into '{destination_path}'")
+        return True
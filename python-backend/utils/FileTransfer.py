@@ -0,0 +1,667 @@
+import socket
+import struct
+import json
+import os
+import time
+import select
+import random
+import logging
+import threading
+from typing import Callable, Dict, List, Set, Tuple, Iterable, Optional
+
+from utils.ManifestManager import CHUNK_SIZE, verify_chunk
+from utils.Compression import CODECS, COMPRESSIBLE_RATIO, SAMPLE_SIZE, Codec, choose_codec
+from utils.RateLimiter import LANE_BULK, RateLimiter, rate_limiter as shared_rate_limiter, set_traffic_class
+from utils.MappedFileCache import MappedFile, MappedFileCache, file_cache as shared_file_cache
+from utils.Metrics import metrics
+from utils.ShareIndex import hash_file
+from utils.Tracer import tracer
+
+logger = logging.getLogger(__name__)
+
+# Binary frame layout shared by data, ack and control frames:
+# magic, version, frame type, transfer id, sequence number, file offset.
+MAGIC = b"PT"
+VERSION = 1
+FRAME_DATA = 1
+FRAME_ACK = 2
+FRAME_FIN = 3
+FRAME_ABORT = 4
+# Data frame whose payload is the frame's bytes compressed with the codec named in the transfer start.
+FRAME_DATA_COMPRESSED = 5
+HEADER = struct.Struct("!2sBBIIQ")
+
+FRAME_PAYLOAD_SIZE = 32 * 1024
+ACK_BITMAP_BYTES = 64
+ACK_BITMAP_BITS = ACK_BITMAP_BYTES * 8
+ACK_EVERY = 16
+INITIAL_WINDOW = 32
+MAX_WINDOW = ACK_BITMAP_BITS
+MIN_RTO = 0.05
+MAX_RTO = 2.0
+HANDSHAKE_RETRIES = 5
+HANDSHAKE_TIMEOUT = 1.0
+IDLE_TIMEOUT = 30.0
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Shared with the HTTP server and client, so a peer's total shows whichever path its data took.
+PEER_BYTES = metrics.counter("p2p_peer_bytes_total", "File transfer bytes exchanged with each peer",
+                             ("peer", "direction"))
+ACTIVE_TRANSFERS = metrics.gauge("p2p_active_transfers", "File transfers in progress", ("protocol", "direction"))
+TRACE = tracer.channel("transfer")
+
+
+def is_transfer_frame(data) -> bool:
+    return len(data) >= HEADER.size and data[:2] == MAGIC
+
+
+def chunk_count(file_size: int) -> int:
+    return (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+def chunk_frames(file_size: int, chunks: Iterable[int], frame_size: int = FRAME_PAYLOAD_SIZE) -> List[Tuple[int, int]]:
+    frames = []
+    for chunk_index in chunks:
+        start = chunk_index * CHUNK_SIZE
+        end = min(start + CHUNK_SIZE, file_size)
+        for offset in range(start, end, frame_size):
+            frames.append((offset, min(frame_size, end - offset)))
+    return frames
+
+
+def tune_socket_buffers(sock: socket.socket):
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+        except OSError as e:
+            logger.debug(f"Could not set socket buffer size: {e}")
+
+
+def read_at(fd: int, offset: int, length: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def write_at(fd: int, offset: int, data) -> int:
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+class PreadFile:
+    # Share files can be saved over while a peer downloads them. Read with pread, a truncated file reads short
+    # and aborts the transfer; a mapped page past the new end would kill the whole process with SIGBUS.
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        self.size = os.fstat(self.fd).st_size
+
+    def read(self, offset: int, length: int) -> bytes:
+        data = read_at(self.fd, offset, length)
+        if len(data) < length:
+            raise OSError(f"{self.path} shrank while being sent")
+        return data
+
+    def prefetch(self, offset: int, length: int):
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileSender:
+    def __init__(self, file_path: str, file_hash: str, reply_addr: Tuple[str, int],
+                 chunks: Optional[List[int]] = None, frame_size: int = FRAME_PAYLOAD_SIZE,
+                 file_cache: MappedFileCache | None = None, compression: Iterable[str] | None = None,
+                 rate_limiter: RateLimiter | None = None, rate: int | None = None, immutable: bool = False):
+        self.file_path = file_path
+        # Only files that never change (chunk store objects) are served from the shared map.
+        self.immutable = immutable
+        self.file_cache = file_cache or shared_file_cache
+        self.file_hash = file_hash
+        self.reply_addr = reply_addr
+        self.chunks = chunks
+        self.frame_size = frame_size
+        self.transfer_id = random.getrandbits(32)
+        self.frames: List[Tuple[int, int]] = []
+        # Picked from what the receiver offered; None sends every frame as is.
+        self.codec: Codec | None = choose_codec(compression)
+        self._encoded: Dict[int, bytes | None] = {}
+        self._compressible: Dict[int, bool] = {}
+        self.payload_bytes = 0
+        # `rate` is the cap the receiver asked for; frames are paced to the tightest bucket.
+        self.throttle = (rate_limiter or shared_rate_limiter).uploader(reply_addr[0], rate)
+        self._paced_until = 0.0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self) -> bool:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        tune_socket_buffers(sock)
+        set_traffic_class(sock, LANE_BULK)
+        try:
+            sock.bind(('0.0.0.0', 0))
+            with ACTIVE_TRANSFERS.in_progress(("udp", "upload")):
+                return self._send(sock)
+        except Exception as e:
+            logger.error(f"Error sending {self.file_path} to {self.reply_addr[0]}:{self.reply_addr[1]}: {e}", exc_info=True)
+            self._send_control(sock, FRAME_ABORT)
+            return False
+        finally:
+            sock.close()
+
+    def _send(self, sock: socket.socket) -> bool:
+        if self.immutable:
+            with self.file_cache.open(self.file_path) as mapped:
+                return self._send_file(sock, mapped)
+        source = PreadFile(self.file_path)
+        try:
+            return self._send_file(sock, source)
+        finally:
+            source.close()
+
+    def _send_file(self, sock: socket.socket, source: MappedFile | PreadFile) -> bool:
+        file_size = source.size
+        total_chunks = chunk_count(file_size)
+        chunks = list(range(total_chunks)) if self.chunks is None else [c for c in self.chunks if 0 <= c < total_chunks]
+        self.frames = chunk_frames(file_size, chunks, self.frame_size)
+        file_name = os.path.basename(self.file_path)
+
+        start_message = {
+            'type': 'file_transfer_start',
+            'transfer_id': self.transfer_id,
+            'file_hash': self.file_hash,
+            'file_name': file_name,
+            'file_format': file_name.split('.')[-1] if '.' in file_name else "",
+            'size': file_size,
+            'chunk_size': CHUNK_SIZE,
+            'chunks': chunks,
+            'frame_size': self.frame_size,
+            'frame_count': len(self.frames)
+        }
+        if self.codec is not None:
+            start_message['compression'] = self.codec.name
+        if not self._handshake(sock, json.dumps(start_message).encode()):
+            logger.warning(f"No answer from {self.reply_addr[0]}:{self.reply_addr[1]} to transfer start for {file_name}.")
+            return False
+
+        start_time = time.monotonic()
+        for chunk_index in chunks:
+            source.prefetch(chunk_index * CHUNK_SIZE, CHUNK_SIZE)
+        completed = self._send_frames(sock, source)
+
+        if completed:
+            for _ in range(3):
+                self._send_control(sock, FRAME_FIN)
+            elapsed = max(time.monotonic() - start_time, 1e-6)
+            sent_bytes = sum(length for _, length in self.frames)
+            wire = f", {self.payload_bytes} with {self.codec.name}" if self.codec is not None else ""
+            logger.info(f"Sent {file_name} ({sent_bytes} bytes{wire}, {len(chunks)} chunks) to {self.reply_addr[0]}:{self.reply_addr[1]} at {sent_bytes / elapsed / 1e6:.1f} MB/s")
+        return completed
+
+    def _handshake(self, sock: socket.socket, start_payload: bytes) -> bool:
+        for _ in range(HANDSHAKE_RETRIES):
+            sock.sendto(start_payload, self.reply_addr)
+            deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+            while (remaining := deadline - time.monotonic()) > 0:
+                readable, _, _ = select.select([sock], [], [], remaining)
+                if not readable:
+                    break
+                data, addr = sock.recvfrom(HEADER.size + ACK_BITMAP_BYTES)
+                if addr != self.reply_addr or not is_transfer_frame(data):
+                    continue
+                _, _, frame_type, transfer_id, _, _ = HEADER.unpack_from(data)
+                if transfer_id != self.transfer_id:
+                    continue
+                if frame_type == FRAME_ABORT:
+                    return False
+                if frame_type == FRAME_ACK:
+                    return True
+        return False
+
+    def _send_control(self, sock: socket.socket, frame_type: int):
+        try:
+            sock.sendto(HEADER.pack(MAGIC, VERSION, frame_type, self.transfer_id, 0, 0), self.reply_addr)
+        except OSError:
+            pass
+
+    def _compressed_payload(self, source: MappedFile | PreadFile, seq: int) -> bytes | None:
+        # Compressed once and kept until acknowledged, so retransmissions cost no CPU. None means send it raw.
+        if seq in self._encoded:
+            return self._encoded[seq]
+        offset, length = self.frames[seq]
+        chunk_index = offset // CHUNK_SIZE
+        compressible = self._compressible.get(chunk_index)
+        if compressible is None:
+            # One sample per chunk keeps already-compressed media from costing a full compression pass.
+            start = chunk_index * CHUNK_SIZE
+            sample = source.read(start, min(SAMPLE_SIZE, source.size - start))
+            compressible = self._compressible[chunk_index] = self.codec.worth_compressing(sample)
+        payload = None
+        if compressible:
+            compressed = self.codec.compress(source.read(offset, length))
+            if len(compressed) < length * COMPRESSIBLE_RATIO:
+                payload = compressed
+        self._encoded[seq] = payload
+        self.payload_bytes += length if payload is None else len(payload)
+        return payload
+
+    def _pace(self, nbytes: int):
+        # Tokens are taken as the frame goes out; the send loop then holds new frames until the debt is repaid,
+        # still reading acks meanwhile.
+        pause = self.throttle.delay(nbytes)
+        if pause:
+            self._paced_until = time.monotonic() + pause
+
+    def _send_frame(self, sock: socket.socket, source: MappedFile | PreadFile, seq: int):
+        offset, length = self.frames[seq]
+        payload = self._compressed_payload(source, seq) if self.codec is not None else None
+        nbytes = HEADER.size + (length if payload is None else len(payload))
+        self._pace(nbytes)
+        PEER_BYTES.inc((self.reply_addr[0], "upload"), nbytes)
+        if payload is not None:
+            sock.sendto(HEADER.pack(MAGIC, VERSION, FRAME_DATA_COMPRESSED, self.transfer_id, seq, offset) + payload,
+                        self.reply_addr)
+            return
+        header = HEADER.pack(MAGIC, VERSION, FRAME_DATA, self.transfer_id, seq, offset)
+        data = source.read(offset, length)
+        if hasattr(sock, "sendmsg"):
+            # Gathers the header and the payload in the kernel; a mapped payload is never copied into Python.
+            sock.sendmsg([header, data], [], 0, self.reply_addr)
+        else:
+            sock.sendto(header + data, self.reply_addr)
+
+    def _send_frames(self, sock: socket.socket, source: MappedFile | PreadFile) -> bool:
+        frame_count = len(self.frames)
+        acked = bytearray(frame_count)
+        sent_at = [0.0] * frame_count
+        retransmitted = bytearray(frame_count)
+        base = 0
+        next_seq = 0
+        cwnd = float(INITIAL_WINDOW)
+        ssthresh = float(MAX_WINDOW)
+        srtt = None
+        rto = MAX_RTO / 4
+        last_loss = 0.0
+        last_progress = time.monotonic()
+
+        while base < frame_count:
+            now = time.monotonic()
+            while next_seq < frame_count and next_seq - base < int(cwnd) and now >= self._paced_until:
+                self._send_frame(sock, source, next_seq)
+                sent_at[next_seq] = now
+                next_seq += 1
+
+            oldest_unacked = sent_at[base] if base < next_seq else now
+            wait = max(rto - (now - oldest_unacked), 0.0)
+            if next_seq < frame_count and next_seq - base < int(cwnd):
+                # Held back only by the rate limit: wake up when the next frame may go.
+                wait = min(wait, max(self._paced_until - now, 0.0))
+            readable, _, _ = select.select([sock], [], [], wait)
+            now = time.monotonic()
+
+            while readable:
+                data, addr = sock.recvfrom(HEADER.size + ACK_BITMAP_BYTES)
+                readable, _, _ = select.select([sock], [], [], 0)
+                if addr != self.reply_addr or not is_transfer_frame(data):
+                    continue
+                _, _, frame_type, transfer_id, cumulative, _ = HEADER.unpack_from(data)
+                if transfer_id != self.transfer_id:
+                    continue
+                if frame_type == FRAME_ABORT:
+                    logger.warning(f"Receiver {self.reply_addr[0]}:{self.reply_addr[1]} aborted transfer {self.transfer_id}.")
+                    return False
+                if frame_type != FRAME_ACK:
+                    continue
+
+                cumulative = min(cumulative, frame_count)
+                for seq in range(base, cumulative):
+                    acked[seq] = 1
+                bits = int.from_bytes(data[HEADER.size:], "little")
+                highest_selective = -1
+                while bits:
+                    low_bit = bits & -bits
+                    seq = cumulative + low_bit.bit_length() - 1
+                    if seq < frame_count:
+                        acked[seq] = 1
+                        highest_selective = seq
+                    bits ^= low_bit
+
+                old_base = base
+                while base < frame_count and acked[base]:
+                    base += 1
+                if base > old_base:
+                    last_progress = now
+                    for seq in range(old_base, base):
+                        self._encoded.pop(seq, None)
+                    if not retransmitted[base - 1]:
+                        sample = now - sent_at[base - 1]
+                        srtt = sample if srtt is None else 0.875 * srtt + 0.125 * sample
+                        rto = min(max(2 * srtt, MIN_RTO), MAX_RTO)
+                    advanced = base - old_base
+                    if cwnd < ssthresh:
+                        cwnd = min(cwnd + advanced, float(MAX_WINDOW))
+                    else:
+                        cwnd = min(cwnd + advanced / cwnd, float(MAX_WINDOW))
+
+                # Holes below the highest selectively acked frame are treated as NACKs.
+                if highest_selective > base:
+                    recovery_interval = srtt if srtt is not None else MIN_RTO
+                    lost = False
+                    for seq in range(base, highest_selective):
+                        if not acked[seq] and now - sent_at[seq] > recovery_interval:
+                            self._send_frame(sock, source, seq)
+                            sent_at[seq] = now
+                            retransmitted[seq] = 1
+                            lost = True
+                    if lost and now - last_loss > recovery_interval:
+                        ssthresh = max(cwnd / 2, 2.0)
+                        cwnd = ssthresh
+                        last_loss = now
+
+            if base < next_seq and now - sent_at[base] >= rto:
+                if now - last_progress > IDLE_TIMEOUT:
+                    logger.warning(f"Transfer {self.transfer_id} to {self.reply_addr[0]}:{self.reply_addr[1]} stalled, aborting.")
+                    self._send_control(sock, FRAME_ABORT)
+                    return False
+                # Retransmission timeout: back off and resend everything outstanding for too long.
+                for seq in range(base, next_seq):
+                    if not acked[seq] and now - sent_at[seq] >= rto:
+                        self._send_frame(sock, source, seq)
+                        sent_at[seq] = now
+                        retransmitted[seq] = 1
+                if now - last_loss > rto:
+                    ssthresh = max(cwnd / 2, 2.0)
+                    cwnd = max(cwnd / 2, 1.0)
+                    last_loss = now
+                rto = min(rto * 2, MAX_RTO)
+        return True
+
+
+class FileReceiver:
+    def __init__(self, sock: socket.socket, peer_ip: str, file_hash: str, destination_path: str | None = None,
+                 idle_timeout: float = IDLE_TIMEOUT, on_chunk: Callable[[int], None] | None = None,
+                 rate_limiter: RateLimiter | None = None, manifest: Dict | None = None):
+        self.sock = sock
+        # Checks the chunks of a transfer that covers only part of the file; a whole file is checked by its hash.
+        self.manifest = manifest
+        self.peer_ip = peer_ip
+        self.file_hash = file_hash
+        self.destination_path = destination_path
+        self.idle_timeout = idle_timeout
+        self.on_chunk = on_chunk
+        self.cancelled = threading.Event()
+        # Senders pace to the rate we request; this only holds the line when several downloads share a budget.
+        self.throttle = (rate_limiter or shared_rate_limiter).downloader(peer_ip)
+        self.sender_addr: Tuple[str, int] | None = None
+        self.transfer_id = 0
+        self.file_size = 0
+        self.frame_size = FRAME_PAYLOAD_SIZE
+        self.received = bytearray()
+        self.frame_chunks: List[int] = []
+        self.chunk_remaining: Dict[int, int] = {}
+        self.completed_chunks: Set[int] = set()
+        self.bytes_received = 0
+        self.wire_bytes = 0
+        self.codec: Codec | None = None
+        self.frame_offsets: List[int] = []
+        self.frame_lengths: List[int] = []
+        self.cumulative = 0
+        self.highest = -1
+
+    def _prepare(self, start_message: dict):
+        self.file_size = int(start_message['size'])
+        self.frame_size = int(start_message.get('frame_size', FRAME_PAYLOAD_SIZE))
+        self.transfer_id = int(start_message['transfer_id'])
+        chunks = start_message.get('chunks')
+        if chunks is None:
+            chunks = range(chunk_count(self.file_size))
+        frames = chunk_frames(self.file_size, chunks, self.frame_size)
+        if len(frames) != int(start_message['frame_count']):
+            raise ValueError(f"Transfer {self.transfer_id} announced {start_message['frame_count']} frames, expected {len(frames)}")
+        compression = start_message.get('compression')
+        self.codec = CODECS.get(compression) if compression else None
+        if compression and self.codec is None:
+            raise ValueError(f"Transfer {self.transfer_id} uses unsupported compression {compression}")
+        self.frame_chunks = [offset // CHUNK_SIZE for offset, _ in frames]
+        self.frame_offsets = [offset for offset, _ in frames]
+        self.frame_lengths = [length for _, length in frames]
+        self.chunk_remaining = {}
+        for chunk_index in self.frame_chunks:
+            self.chunk_remaining[chunk_index] = self.chunk_remaining.get(chunk_index, 0) + 1
+        self.received = bytearray(len(frames))
+
+    def receive_into(self, f, expected_size: int | None = None) -> bool:
+        start_message = self._wait_for_start()
+        if start_message is None:
+            logger.warning(f"No transfer start received for hash {self.file_hash} from {self.peer_ip}.")
+            return False
+        self._prepare(start_message)
+        if expected_size is not None and self.file_size != expected_size:
+            logger.warning(f"Peer {self.peer_ip} reports size {self.file_size} for {self.file_hash}, expected {expected_size}.")
+            self._send_control(FRAME_ABORT)
+            return False
+        self._send_ack()
+        with ACTIVE_TRANSFERS.in_progress(("udp", "download")):
+            return self._receive_frames(f)
+
+    def receive(self) -> bool:
+        start_message = self._wait_for_start()
+        if start_message is None:
+            logger.warning(f"No transfer start received for hash {self.file_hash} from {self.peer_ip}.")
+            return False
+        self._prepare(start_message)
+        file_size = self.file_size
+
+        part_path = self.destination_path + ".part"
+        os.makedirs(os.path.dirname(self.destination_path) or ".", exist_ok=True)
+        start_time = time.monotonic()
+        try:
+            with open(part_path, "wb") as f:
+                f.truncate(file_size)
+                self._send_ack()
+                with ACTIVE_TRANSFERS.in_progress(("udp", "download")):
+                    completed = self._receive_frames(f)
+        except OSError as e:
+            logger.error(f"IOError writing file {part_path}: {e}", exc_info=True)
+            self._send_control(FRAME_ABORT)
+            completed = False
+
+        if not completed:
+            self._remove(part_path)
+            return False
+
+        if not self._verify(part_path):
+            logger.error(f"Hash mismatch for {self.destination_path}, discarding download.")
+            self._remove(part_path)
+            return False
+
+        os.replace(part_path, self.destination_path)
+        elapsed = max(time.monotonic() - start_time, 1e-6)
+        wire = f", {self.wire_bytes} with {self.codec.name}" if self.codec is not None else ""
+        logger.info(f"File {self.destination_path} received ({file_size} bytes{wire}) at {file_size / elapsed / 1e6:.1f} MB/s")
+        return True
+
+    def _verify(self, path: str) -> bool:
+        # The whole-file hash only means something when every chunk was sent; a subset is checked chunk by chunk.
+        chunks = sorted(self.chunk_remaining)
+        if len(chunks) == chunk_count(self.file_size):
+            return hash_file(path) == self.file_hash
+        if self.manifest is None:
+            logger.error(f"Transfer {self.transfer_id} sent {len(chunks)} of {chunk_count(self.file_size)} chunks and there is no manifest to check them against.")
+            return False
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            return all(verify_chunk(self.manifest, chunk_index,
+                                    read_at(fd, chunk_index * CHUNK_SIZE, min(CHUNK_SIZE, self.file_size - chunk_index * CHUNK_SIZE)))
+                       for chunk_index in chunks)
+        finally:
+            os.close(fd)
+
+    def _wait_for_start(self) -> dict | None:
+        self.sock.settimeout(2.0)
+        deadline = time.monotonic() + self.idle_timeout
+        while time.monotonic() < deadline:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            if addr[0] != self.peer_ip:
+                logger.warning(f"Received data from unexpected IP {addr[0]} (expected {self.peer_ip}). Ignoring.")
+                continue
+            if is_transfer_frame(data):
+                continue
+            try:
+                message = json.loads(data.decode())
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                logger.warning(f"JSON decode error while waiting for transfer start from {addr[0]}")
+                continue
+            if message.get('type') == 'file_transfer_start' and message.get('file_hash') == self.file_hash:
+                self.sender_addr = addr
+                return message
+        return None
+
+    def _receive_frames(self, f) -> bool:
+        frame_count = len(self.received)
+        buffer = bytearray(HEADER.size + self.frame_size)
+        view = memoryview(buffer)
+        received = self.received
+        received_count = 0
+        since_ack = 0
+        last_activity = time.monotonic()
+        self.sock.settimeout(MIN_RTO)
+
+        while received_count < frame_count:
+            try:
+                nbytes, addr = self.sock.recvfrom_into(buffer)
+            except socket.timeout:
+                if time.monotonic() - last_activity > self.idle_timeout:
+                    logger.warning(f"Transfer {self.transfer_id} from {self.peer_ip} timed out with {received_count}/{frame_count} frames.")
+                    self._send_control(FRAME_ABORT)
+                    return False
+                if self.cancelled.is_set():
+                    self._send_control(FRAME_ABORT)
+                    return False
+                self._send_ack()
+                continue
+
+            if addr != self.sender_addr:
+                continue
+            if not is_transfer_frame(buffer[:nbytes]):
+                # A repeated transfer start means our first ack was lost.
+                self._send_ack()
+                continue
+            _, _, frame_type, transfer_id, seq, offset = HEADER.unpack_from(buffer)
+            if transfer_id != self.transfer_id:
+                continue
+            if frame_type == FRAME_ABORT:
+                logger.warning(f"Sender {self.peer_ip} aborted transfer {self.transfer_id}.")
+                return False
+            if frame_type not in (FRAME_DATA, FRAME_DATA_COMPRESSED):
+                continue
+
+            payload_length = nbytes - HEADER.size
+            # The frame must be exactly the range its sequence number stands for, or marking it received would
+            # leave that range unwritten; a compressed frame is checked once it is inflated.
+            if seq >= frame_count or offset != self.frame_offsets[seq] \
+                    or (frame_type == FRAME_DATA and payload_length != self.frame_lengths[seq]):
+                continue
+            last_activity = time.monotonic()
+            if received[seq]:
+                since_ack = ACK_EVERY
+            else:
+                payload = view[HEADER.size:nbytes]
+                if frame_type == FRAME_DATA_COMPRESSED:
+                    if self.codec is None:
+                        continue
+                    try:
+                        payload = self.codec.decompress(payload, self.frame_lengths[seq])
+                    except ValueError as e:
+                        logger.warning(f"Transfer {self.transfer_id} from {self.peer_ip}: frame {seq} does not decompress: {e}")
+                        self._send_control(FRAME_ABORT)
+                        return False
+                    if len(payload) != self.frame_lengths[seq]:
+                        continue
+                self.wire_bytes += payload_length
+                PEER_BYTES.inc((self.peer_ip, "download"), nbytes)
+                payload_length = len(payload)
+                f.seek(self.frame_offsets[seq])
+                f.write(payload)
+                received[seq] = 1
+                received_count += 1
+                self.bytes_received += payload_length
+                self.throttle.wait(nbytes)
+                since_ack += 1
+                chunk_index = self.frame_chunks[seq]
+                self.chunk_remaining[chunk_index] -= 1
+                if self.chunk_remaining[chunk_index] == 0:
+                    self.completed_chunks.add(chunk_index)
+                    if self.on_chunk is not None:
+                        f.flush()
+                        self.on_chunk(chunk_index)
+                if seq > self.highest:
+                    self.highest = seq
+                while self.cumulative < frame_count and received[self.cumulative]:
+                    self.cumulative += 1
+                if self.highest >= self.cumulative:
+                    # Out of order: report the hole quickly so the sender can retransmit it.
+                    since_ack = max(since_ack, ACK_EVERY // 4)
+
+            if since_ack >= ACK_EVERY or (self.highest >= self.cumulative and since_ack >= ACK_EVERY // 4):
+                if self.cancelled.is_set():
+                    self._send_control(FRAME_ABORT)
+                    return False
+                self._send_ack()
+                since_ack = 0
+
+        self._send_ack()
+        self._linger()
+        return True
+
+    def _linger(self):
+        # Keep acknowledging until the sender confirms with FIN so it does not retransmit into the void.
+        deadline = time.monotonic() + 2.0
+        self.sock.settimeout(0.2)
+        while time.monotonic() < deadline:
+            try:
+                data, addr = self.sock.recvfrom(HEADER.size)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if addr != self.sender_addr or not is_transfer_frame(data):
+                continue
+            frame_type = HEADER.unpack_from(data)[2]
+            if frame_type in (FRAME_FIN, FRAME_ABORT):
+                break
+            self._send_ack()
+
+    def _send_ack(self):
+        bits = 0
+        end = min(self.highest + 1, self.cumulative + ACK_BITMAP_BITS)
+        for index in range(self.cumulative, end):
+            if self.received[index]:
+                bits |= 1 << (index - self.cumulative)
+        frame = HEADER.pack(MAGIC, VERSION, FRAME_ACK, self.transfer_id, self.cumulative, 0) + bits.to_bytes(ACK_BITMAP_BYTES, "little")
+        try:
+            self.sock.sendto(frame, self.sender_addr)
+        except OSError as e:
+            TRACE.debug("ack_failed", self.sender_addr, e)
+
+    def _send_control(self, frame_type: int):
+        try:
+            self.sock.sendto(HEADER.pack(MAGIC, VERSION, frame_type, self.transfer_id, 0, 0), self.sender_addr)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,38 +1,208 @@
 import os
 import hashlib
 import json
-from typing import List, Dict
-import socket
+import logging
+import multiprocessing
+from typing import List, Dict, Iterable
 import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+CHUNK_SIZE = 1024 * 1024
+CHUNKS_PER_TASK = 16
+MANIFEST_VERSION = 2
+
+logger = logging.getLogger(__name__)
+
+_pool: Executor | None = None
+_pool_lock = threading.Lock()
+
+
+def get_hash_pool() -> Executor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            try:
+                # spawn: forking a process that already runs network threads can inherit held locks.
+                _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context("spawn"))
+            except (OSError, NotImplementedError) as e:
+                logger.warning(f"Process pool unavailable ({e}), hashing on threads instead.")
+                _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _pool
+
+
+def shutdown_hash_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def hash_chunk_range(file_path: str, first_chunk: int, count: int) -> List[str]:
+    digests = []
+    with open(file_path, "rb") as f:
+        f.seek(first_chunk * CHUNK_SIZE)
+        for _ in range(count):
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            digests.append(hashlib.sha256(data).hexdigest())
+    return digests
+
+
+def hash_whole_file(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def merkle_root(chunk_hashes: Iterable[str]) -> str:
+    level = [bytes.fromhex(h) for h in chunk_hashes]
+    if not level:
+        return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1:
+        next_level = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+def verify_chunk(manifest: Dict, chunk_index: int, data) -> bool:
+    chunks = manifest.get("chunks") or []
+    return 0 <= chunk_index < len(chunks) and hashlib.sha256(data).hexdigest() == chunks[chunk_index]
+
+
+def _signature(st: os.stat_result) -> List[int]:
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class ManifestCache:
+    # One entry per path, holding the manifest and the (size, mtime_ns, inode) it was built from. An edit
+    # replaces the entry; prune() drops the entries of files that were deleted or changed since.
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    @classmethod
+    def for_share(cls, share_directory: str) -> "ManifestCache":
+        # Next to the share like its index, wherever the node was started from.
+        parent, name = os.path.split(os.path.abspath(share_directory))
+        return cls(os.path.join(parent, f".{name}_manifests"))
+
+    def _entry_path(self, file_path: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest() + ".json")
+
+    def get(self, file_path: str, st: os.stat_result) -> Dict | None:
+        try:
+            with open(self._entry_path(file_path), "r") as f:
+                entry = json.load(f)
+            manifest = entry["manifest"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if entry.get("stat") != _signature(st) or manifest.get("version") != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def put(self, file_path: str, st: os.stat_result, manifest: Dict):
+        entry_path = self._entry_path(file_path)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(entry_path + ".tmp", "w") as f:
+                json.dump({"path": os.path.abspath(file_path), "stat": _signature(st), "manifest": manifest}, f)
+            os.replace(entry_path + ".tmp", entry_path)
+        except OSError as e:
+            logger.warning(f"Could not cache manifest for {file_path}: {e}")
+
+    def prune(self) -> int:
+        removed = 0
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return 0
+        for name in names:
+            entry_path = os.path.join(self.cache_dir, name)
+            try:
+                with open(entry_path, "r") as f:
+                    entry = json.load(f)
+                stale = entry.get("stat") != _signature(os.stat(entry["path"]))
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                # Unreadable, left over from an interrupted write, or its file is gone.
+                stale = True
+            if stale:
+                try:
+                    os.remove(entry_path)
+                    removed += 1
+                except OSError:
+                    pass
+        if removed:
+            logger.info(f"Pruned {removed} stale manifest cache entries from {self.cache_dir}")
+        return removed
 
-CHUNK_SIZE = 1024 * 1024 
 
 class ManifestManager:
     @staticmethod
-    def generate_file_manifest(file_path: str) -> Dict:
-        file_size = os.path.getsize(file_path)
-        chunk_count = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
-        
-        sha256 = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            while chunk := f.read(8192):
-                sha256.update(chunk)
-
-        return {
-            "filename": os.path.basename(file_path),
-            "size": file_size,
-            "sha256": sha256.hexdigest(),
-            "chunk_count": chunk_count
-        }
+    def generate_file_manifest(file_path: str, file_hash: str | None = None,
+                               cache: ManifestCache | None = None) -> Dict:
+        return ManifestManager.generate_manifests([file_path], {file_path: file_hash} if file_hash else None, cache)[0]
+
+    @staticmethod
+    def generate_manifests(file_paths: List[str], known_hashes: Dict[str, str] | None = None,
+                           cache: ManifestCache | None = None) -> List[Dict]:
+        # Without a cache every file is hashed.
+        known_hashes = known_hashes or {}
+        manifests: List[Dict | None] = [None] * len(file_paths)
+        pending = []
+        pool = None
+
+        # Submit every chunk range of every uncached file up front so the pool hashes across files.
+        for position, file_path in enumerate(file_paths):
+            st = os.stat(file_path)
+            cached = cache.get(file_path, st) if cache is not None else None
+            if cached is not None:
+                manifests[position] = cached
+                continue
+            pool = pool or get_hash_pool()
+            chunk_count = (st.st_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+            range_futures = [
+                pool.submit(hash_chunk_range, file_path, first, min(CHUNKS_PER_TASK, chunk_count - first))
+                for first in range(0, chunk_count, CHUNKS_PER_TASK)
+            ]
+            file_hash = known_hashes.get(file_path)
+            whole_future = None if file_hash else pool.submit(hash_whole_file, file_path)
+            pending.append((position, file_path, st, chunk_count, range_futures, file_hash, whole_future))
+
+        for position, file_path, st, chunk_count, range_futures, file_hash, whole_future in pending:
+            chunk_hashes = [digest for future in range_futures for digest in future.result()]
+            if len(chunk_hashes) != chunk_count:
+                raise OSError(f"{file_path} changed while it was being hashed")
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "filename": os.path.basename(file_path),
+                "size": st.st_size,
+                "sha256": file_hash or whole_future.result(),
+                "chunk_size": CHUNK_SIZE,
+                "chunk_count": chunk_count,
+                "chunks": chunk_hashes,
+                "merkle_root": merkle_root(chunk_hashes)
+            }
+            if cache is not None:
+                cache.put(file_path, st, manifest)
+            manifests[position] = manifest
+
+        return manifests
 
     @staticmethod
-    def generate_manifest_for_directory(directory_path: str) -> List[Dict]:
-        manifest: List[Dict] = []
-        
+    def generate_manifest_for_directory(directory_path: str, share_index=None) -> List[Dict]:
+        if share_index is not None and os.path.abspath(directory_path) == share_index.directory:
+            known_hashes = {path: entry[3] for path, entry in dict(share_index.entries).items()}
+            return ManifestManager.generate_manifests(sorted(known_hashes), known_hashes,
+                                                      ManifestCache.for_share(share_index.directory))
+
+        file_paths = []
         for root, dirs, files in os.walk(directory_path):
             for name in files:
-                file_path = os.path.join(root, name)
-                manifest_entry = ManifestManager.generate_file_manifest(file_path)
-                manifest.append(manifest_entry)
+                file_paths.append(os.path.join(root, name))
 
-        return manifest
+        return ManifestManager.generate_manifests(file_paths)
@@ -0,0 +1,141 @@
+import os
+import mmap
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+from typing import Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_MAPPED_FILES = 64
+MAX_MAPPED_BYTES = 4 * 1024 ** 3
+
+# path, size, mtime_ns, inode: a file replaced or edited in place gets a fresh map
+FileKey = Tuple[str, int, int, int]
+
+
+class MappedFile:
+    def __init__(self, key: FileKey):
+        self.key = key
+        self.size = key[1]
+        self.refs = 0
+        self.evicted = False
+        if self.size:
+            with open(key[0], "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+        else:
+            # mmap refuses empty files.
+            self.map = None
+            self.view = memoryview(b"")
+
+    def read(self, offset: int, length: int) -> memoryview:
+        return self.view[offset:offset + length]
+
+    def prefetch(self, offset: int, length: int):
+        # Lets the kernel start reading ahead so the next slice does not fault on the caller's thread.
+        if self.map is not None and hasattr(self.map, "madvise") and offset < self.size:
+            start = offset - offset % mmap.PAGESIZE
+            self.map.madvise(mmap.MADV_WILLNEED, start, min(self.size, offset + length) - start)
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # A slice handed out by a caller is still alive; the map goes when it is collected.
+                logger.debug(f"Deferred unmapping {self.key[0]}: slices still referenced")
+
+
+class MappedFileCache:
+    # Read-only maps of served files, shared by every transfer of the same file. Entries are reference
+    # counted so eviction never unmaps a file that is still being sent. Only files nobody writes to may be
+    # mapped: reading a page past the end of a file truncated under the map raises SIGBUS.
+    def __init__(self, max_files: int = MAX_MAPPED_FILES, max_bytes: int = MAX_MAPPED_BYTES):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._files: "OrderedDict[str, MappedFile]" = OrderedDict()
+        self._mapped_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(path: str) -> FileKey:
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_ino
+
+    @contextlib.contextmanager
+    def open(self, path: str) -> Iterator[MappedFile]:
+        mapped = self.acquire(path)
+        try:
+            yield mapped
+        finally:
+            self.release(mapped)
+
+    def acquire(self, path: str) -> MappedFile:
+        key = self._key(path)
+        with self._lock:
+            mapped = self._files.get(key[0])
+            if mapped is not None and mapped.key == key:
+                self._files.move_to_end(key[0])
+                mapped.refs += 1
+                self.hits += 1
+                return mapped
+            if mapped is not None:
+                self._drop(mapped)
+        fresh = MappedFile(key)
+        with self._lock:
+            self.misses += 1
+            current = self._files.get(key[0])
+            if current is not None and current.key == key:
+                # Another thread mapped it first; share that one.
+                fresh.close()
+                current.refs += 1
+                return current
+            if current is not None:
+                self._drop(current)
+            fresh.refs = 1
+            self._files[key[0]] = fresh
+            self._mapped_bytes += fresh.size
+            self._evict()
+            return fresh
+
+    def release(self, mapped: MappedFile):
+        with self._lock:
+            mapped.refs -= 1
+            if mapped.refs == 0 and mapped.evicted:
+                mapped.close()
+            else:
+                self._evict()
+
+    def invalidate(self, path: str):
+        with self._lock:
+            mapped = self._files.get(os.path.abspath(path))
+            if mapped is not None:
+                self._drop(mapped)
+
+    def clear(self):
+        with self._lock:
+            for mapped in list(self._files.values()):
+                self._drop(mapped)
+
+    def _drop(self, mapped: MappedFile):
+        del self._files[mapped.key[0]]
+        self._mapped_bytes -= mapped.size
+        mapped.evicted = True
+        if mapped.refs == 0:
+            mapped.close()
+
+    def _evict(self):
+        # Least recently used first, skipping maps in use; those are retried when released.
+        for mapped in list(self._files.values()):
+            if len(self._files) <= self.max_files and self._mapped_bytes <= self.max_bytes:
+                return
+            if mapped.refs == 0:
+                self._drop(mapped)
+
+
+file_cache = MappedFileCache()
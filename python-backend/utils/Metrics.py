@@ -0,0 +1,209 @@
+import bisect
+import math
+import threading
+import contextlib
+import weakref
+from typing import Callable, Dict, List, Tuple
+
+# Seconds; from a LAN round trip up to a lookup that waits out its whole window.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.9, 0.99)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        # Hot paths only take this lock for a dict update; label tuples are the keys, no child objects.
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, object] = {}
+
+    def _label_text(self, labels: Labels, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def collect(self) -> Dict[Labels, object]:
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self) -> List[Dict]:
+        return [{"labels": dict(zip(self.labelnames, labels)), "value": value}
+                for labels, value in sorted(self.collect().items())]
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{self._label_text(labels)} {_format_value(value)}"
+                for labels, value in sorted(self.collect().items())]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._callbacks: List[Callable[[], Callable | None]] = []
+
+    def set(self, value: float, labels: Labels = ()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels: Labels = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    @contextlib.contextmanager
+    def in_progress(self, labels: Labels = ()):
+        self.inc(labels)
+        try:
+            yield
+        finally:
+            self.dec(labels)
+
+    def track(self, callback: Callable[[], Dict[Labels, float]]):
+        # Sampled at collection time and summed over every live callback, so queue depths cost nothing until
+        # someone looks and several instances add up. Bound methods are held weakly and drop out with their object.
+        reference = weakref.WeakMethod(callback) if hasattr(callback, "__self__") else (lambda: callback)
+        with self._lock:
+            self._callbacks.append(reference)
+
+    def collect(self) -> Dict[Labels, object]:
+        with self._lock:
+            values = dict(self._values)
+            callbacks = [reference() for reference in self._callbacks]
+            self._callbacks = [reference for reference, callback in zip(self._callbacks, callbacks) if callback is not None]
+        for callback in callbacks:
+            if callback is None:
+                continue
+            for labels, value in callback().items():
+                values[labels] = values.get(labels, 0) + value
+        return values
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: Labels = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum, count; made cumulative only when rendered.
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self) -> Dict[Labels, object]:
+        with self._lock:
+            return {labels: ([*counts], total, count) for labels, (counts, total, count) in self._values.items()}
+
+    def quantile(self, counts: List[int], count: int, q: float) -> float | None:
+        # Linear interpolation inside the bucket the rank falls in, as Prometheus' histogram_quantile does.
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def samples(self) -> List[Dict]:
+        samples = []
+        for labels, (counts, total, count) in sorted(self.collect().items()):
+            sample = {"labels": dict(zip(self.labelnames, labels)), "count": count, "sum": total}
+            for q in QUANTILES:
+                sample[f"p{round(q * 100)}"] = self.quantile(counts, count, q)
+            samples.append(sample)
+        return samples
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, (counts, total, count) in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{self._label_text(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._label_text(labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def _register(self, cls, name: str, help_text: str, labelnames: Tuple[str, ...], **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered as a different {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def _sorted_metrics(self) -> List[Metric]:
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {metric.name: {"type": metric.kind, "help": metric.help, "samples": metric.samples()}
+                for metric in self._sorted_metrics()}
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self._sorted_metrics():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -2,69 +2,177 @@ import logging
 from utils.DiscoverPeers import DiscoverPeers
 import threading
 from utils.FileManager import FileServer, FileClient
+from utils.ShareIndex import ShareIndex
+from utils.ShareWatcher import ShareWatcher
+from utils.ManifestManager import ManifestManager, shutdown_hash_pool, CHUNK_SIZE
+from utils.SwarmDownloader import SwarmDownload, MAX_SOURCES
+from utils.DownloadState import DownloadState
+from utils.ChunkStore import ChunkStore
+from utils.FileTransfer import read_at
+from utils.DownloadManager import DownloadManager
 import os
-from utils.websocket import run_server as run_websocket_server
+import asyncio
+from typing import List, Tuple
+from utils.UdpEngine import start_event_loop
+from utils.websocket import start_websocket_server_main
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class P2PNode:
-    def __init__(self, port: int = 5003, web_socket_port: int = 8765):
+    def __init__(self, port: int = 5003, web_socket_port: int = 8765, file_server_port: int = 5001,
+                 file_client_port: int = 5002, share_directory: str = "publicFiles",
+                 seed_peers: List[Tuple[str, int]] | None = None, broadcast: bool = True,
+                 compression: List[str] | None = None):
         self.port = port
         self.web_socket_port = web_socket_port
         logger.info(f"Initializing P2PNode on port {port} with WebSocket port {web_socket_port}")
 
         self.peers = []
-        self.files = {}
-        logger.info(f"Indexed files: {self.files}")
+        os.makedirs(share_directory, exist_ok=True)
+        self.share_index = ShareIndex(share_directory)
+        logger.info(f"Indexed files: {len(self.share_index.entries)}")
+        self.share_watcher = ShareWatcher(self.share_index)
+        self.share_watcher.start()
+        self.chunk_store = ChunkStore.for_share(self.share_index.directory)
 
-        self.peer_discovery = DiscoverPeers(self.port)
-        self.file_server = FileServer(host="localhost", port=5001) 
-        self.file_client = FileClient(ip="localhost", port=5002)
+        self.peer_discovery = DiscoverPeers(self.port, share_index=self.share_index, chunk_store=self.chunk_store,
+                                            seed_peers=seed_peers, broadcast=broadcast, compression=compression)
+        self.file_server = FileServer(host="localhost", port=file_server_port, share_index=self.share_index) 
+        self.file_client = FileClient(ip="localhost", port=file_client_port, download_dir=share_directory)
+        self.download_manager = DownloadManager(self.receive_file_from_peer, discard=self.discard_partial_download)
 
-        self.web_socket_thread = threading.Thread(
-            target=run_websocket_server,
-            args=(self, "localhost", self.web_socket_port),
-            daemon=True
-        )
-        self.web_socket_thread.start()
-        logger.info(f"WebSocket server thread started, listening on ws://localhost:{self.web_socket_port}")
+        # UDP discovery, queries and the WebSocket server all share one event loop.
+        self.loop = start_event_loop()
+        self.web_socket_server = asyncio.run_coroutine_threadsafe(
+            start_websocket_server_main("localhost", self.web_socket_port, self), self.loop)
+        logger.info(f"WebSocket server started, listening on ws://localhost:{self.web_socket_port}")
 
-        self.peer_discovery.start_discovery()
+        self.peer_discovery.start_discovery(self.loop)
 
         self.file_server_thread = threading.Thread(target=self.file_server.start_server, daemon=True)
         self.file_server_thread.start()
 
+        threading.Thread(target=self.resume_pending_downloads, daemon=True).start()
+
         logger.info("P2P Node initialized")
 
-    def receive_file_from_peer(self, requested_filename: str):
+    def stop(self):
+        logger.info("Stopping P2P node")
+        self.download_manager.stop()
+        self.share_watcher.stop()
+        self.file_server.stop_server()
+        self.web_socket_server.cancel()
+        shutdown_hash_pool()
+
+    def _create_download_state(self, destination_path: str, file_hash: str, sources,
+                               requested_filename: str) -> DownloadState | None:
+        for peer_ip, peer_port in sources[:3]:
+            manifest = self.peer_discovery.fetch_manifest(peer_ip, peer_port, file_hash)
+            if manifest is not None:
+                return DownloadState.create(destination_path, manifest, requested_filename)
+        # Without chunk hashes the download still works, it just cannot be verified piecewise or resumed.
+        logger.warning(f"No manifest available for {file_hash}; downloading without resume support.")
+        return None
+
+    def resume_pending_downloads(self):
+        pending = list(DownloadState.pending_downloads(self.share_index.directory))
+        self.peer_discovery.manifest_cache.prune()
+        self.chunk_store.gc(set(self.share_index.files()),
+                            pinned={chunk_hash for state in pending for chunk_hash in state.manifest["chunks"]})
+        for state in pending:
+            # Peers are searched by the name originally asked for; the partial file stays where it is.
+            destination = os.path.relpath(state.destination_path, self.share_index.directory)
+            logger.info(f"Resuming interrupted download of {state.requested_filename} into {destination}")
+            self.download_manager.submit(state.requested_filename, destination=destination)
+
+    def discard_partial_download(self, destination: str):
+        destination_path = os.path.join(self.share_index.directory, destination)
+        state = DownloadState.load(destination_path)
+        if state is not None:
+            state.discard()
+        elif os.path.exists(destination_path + ".part"):
+            os.remove(destination_path + ".part")
+
+    def _salvage_chunks(self, state: DownloadState):
+        # Verified chunks of an abandoned version often reappear in the new one.
+        fd = os.open(state.part_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            for chunk_index in state.done_chunks():
+                offset = chunk_index * CHUNK_SIZE
+                self.chunk_store.put_chunk(state.manifest["chunks"][chunk_index],
+                                           read_at(fd, offset, min(CHUNK_SIZE, state.file_size - offset)))
+        finally:
+            os.close(fd)
+
+    @property
+    def files(self):
+        return self.share_index.files()
+
+    def receive_file_from_peer(self, requested_filename: str, cancelled: threading.Event | None = None,
+                               on_progress=None, destination: str | None = None) -> bool:
         logger.info(f"Attempting to download file from network: {requested_filename}")
 
-        source_info = self.peer_discovery.find_file_source(requested_filename)
-
-        if source_info and source_info[0] and source_info[1] and source_info[2]:
-            peer_ip, peer_port, file_hash_on_peer = source_info
-            logger.info(f"File source found: {requested_filename} (hash: {file_hash_on_peer}) on peer: {peer_ip}:{peer_port}")
-
-            download_directory = "publicFiles"
-            if not os.path.exists(download_directory):
-                try:
-                    logger.info(f"Created directory: {download_directory}")
-                except OSError as e:
-                    logger.error(f"Could not create directory {download_directory}: {e}")
-                    return
-
-            destination_path = os.path.join(download_directory, requested_filename)
-            logger.info(f"Requesting file {requested_filename} (hash: {file_hash_on_peer}) from {peer_ip}:{peer_port} to {destination_path}")
-
-            try:
-                success = self.peer_discovery.receive_file(peer_ip, peer_port, file_hash_on_peer, destination_path)
-                print(success)
-                if success:
-                    logger.info(f"'{requested_filename}' received successfully and saved to '{destination_path}'.")
-                else:
-                    logger.warning(f"Failed to receive '{requested_filename}' from {peer_ip}:{peer_port}.")
-            except Exception as e:
-                logger.error(f"Error during file reception for '{requested_filename}' from {peer_ip}:{peer_port}: {e}", exc_info=True)
-        else:
+        holders = self.peer_discovery.find_file_holders(requested_filename, max_sources=MAX_SOURCES)
+        if not holders:
             logger.warning(f"File '{requested_filename}' not found on the network via broadcast.")
+            return False
+        if cancelled is not None and cancelled.is_set():
+            return False
+
+        download_directory = self.share_index.directory
+        os.makedirs(download_directory, exist_ok=True)
+        destination_path = os.path.join(download_directory, destination or requested_filename)
+        state = DownloadState.load(destination_path)
+
+        # Different peers may share different contents under one name; keep resuming the version we
+        # already have chunks of, otherwise follow the most widely held one.
+        holders_by_hash = {}
+        for peer_ip, peer_port, file_hash, file_size in holders:
+            holders_by_hash.setdefault(file_hash, []).append((peer_ip, peer_port, file_size))
+        if state is not None and state.file_hash in holders_by_hash:
+            file_hash_on_peer, candidates = state.file_hash, holders_by_hash[state.file_hash]
+        else:
+            file_hash_on_peer, candidates = max(holders_by_hash.items(), key=lambda item: len(item[1]))
+            if state is not None:
+                logger.info(f"Discarding partial download of {requested_filename}: no peer holds hash {state.file_hash} anymore.")
+                self._salvage_chunks(state)
+                state.discard()
+                state = None
+        sizes = {file_size for _, _, file_size in candidates if file_size is not None}
+        logger.info(f"File source(s) found: {requested_filename} (hash: {file_hash_on_peer}) on {len(candidates)} peer(s)")
+        local_path = self.share_index.path_for_hash(file_hash_on_peer)
+        if local_path is not None and not self.chunk_store.has_file(file_hash_on_peer):
+            # Already shared here under another name: record it in the store and clone the new name from it.
+            self.chunk_store.add_file(local_path, ManifestManager.generate_file_manifest(
+                local_path, file_hash=file_hash_on_peer, cache=self.peer_discovery.manifest_cache))
+        if self.chunk_store.link_file(file_hash_on_peer, destination_path):
+            if state is not None:
+                state.discard()
+            self.share_index.add_file(destination_path, file_hash_on_peer)
+            return True
+
+        try:
+            if len(sizes) == 1:
+                sources = [(peer_ip, peer_port) for peer_ip, peer_port, _ in candidates]
+                if state is None:
+                    state = self._create_download_state(destination_path, file_hash_on_peer, sources, requested_filename)
+                success = SwarmDownload(self.peer_discovery, file_hash_on_peer, sizes.pop(), sources, destination_path,
+                                        state=state, cancelled=cancelled, on_progress=on_progress,
+                                        chunk_store=self.chunk_store).run()
+            else:
+                # Peers that do not advertise a size can still serve the whole file on their own.
+                peer_ip, peer_port, _ = candidates[0]
+                success = self.peer_discovery.receive_file(peer_ip, peer_port, file_hash_on_peer, destination_path,
+                                                           cancelled=cancelled, on_progress=on_progress)
+            if success:
+                if state is not None:
+                    self.chunk_store.add_file(destination_path, state.manifest)
+                self.share_index.add_file(destination_path, file_hash_on_peer)
+                logger.info(f"'{requested_filename}' received successfully and saved to '{destination_path}'.")
+            else:
+                logger.warning(f"Failed to receive '{requested_filename}' from {len(candidates)} source(s).")
+            return success
+        except Exception as e:
+            logger.error(f"Error during file reception for '{requested_filename}': {e}", exc_info=True)
+            return False
@@ -0,0 +1,163 @@
+import time
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+from utils.ManifestManager import CHUNK_SIZE
+
+PeerAddress = Tuple[str, int]
+
+# RFC 6298 smoothing factors.
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+THROUGHPUT_ALPHA = 0.3
+LIVE_WINDOW = 10.0
+EXPIRY = 60.0
+# Peers announce less often once the network is stable; they stay live for this many of their own intervals.
+LIVE_INTERVALS = 3
+EXPIRY_INTERVALS = 6
+
+SEARCH_MIN_WINDOW = 0.15
+SEARCH_MAX_WINDOW = 3.0
+SEARCH_DEFAULT_WINDOW = 1.0
+# Lookups on the answering peer (index refresh, hashing a new file) add to the network RTT.
+SEARCH_SLACK = 0.05
+
+# Assumed for ranking peers we have not measured yet.
+DEFAULT_RTT = 0.05
+DEFAULT_THROUGHPUT = 10 * 1024 * 1024
+
+
+class PeerRecord:
+    def __init__(self, ip: str, port: int):
+        self.ip = ip
+        self.port = port
+        self.first_seen = time.monotonic()
+        self.last_seen = self.first_seen
+        self.srtt: float | None = None
+        self.rttvar = 0.0
+        self.throughput: float | None = None
+        self.capabilities: Set[str] = set()
+        self.index_version: int | None = None
+        self.node_id: str | None = None
+        self.announce_interval = 0.0
+
+    def observe_rtt(self, sample: float):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - sample)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+
+    def observe_throughput(self, rate: float):
+        self.throughput = rate if self.throughput is None else THROUGHPUT_ALPHA * rate + (1 - THROUGHPUT_ALPHA) * self.throughput
+
+    @property
+    def rto(self) -> float | None:
+        return None if self.srtt is None else self.srtt + 4 * self.rttvar
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            "address": f"{self.ip}:{self.port}",
+            "ip": self.ip,
+            "port": self.port,
+            "last_seen": round(now - self.last_seen, 3),
+            "rtt": round(self.srtt, 6) if self.srtt is not None else None,
+            "throughput": round(self.throughput) if self.throughput is not None else None,
+            "capabilities": sorted(self.capabilities),
+            "index_version": self.index_version,
+        }
+
+    def expected_chunk_time(self) -> float:
+        rtt = self.srtt if self.srtt is not None else DEFAULT_RTT
+        return rtt + CHUNK_SIZE / (self.throughput or DEFAULT_THROUGHPUT)
+
+
+class PeerTable:
+    def __init__(self, live_window: float = LIVE_WINDOW, expiry: float = EXPIRY):
+        self.live_window = live_window
+        self.expiry = expiry
+        self._peers: Dict[PeerAddress, PeerRecord] = {}
+        self._lock = threading.Lock()
+
+    def seen(self, address: PeerAddress) -> PeerRecord:
+        with self._lock:
+            record = self._peers.get(address)
+            if record is None:
+                record = self._peers[address] = PeerRecord(*address)
+            record.last_seen = time.monotonic()
+            return record
+
+    def update(self, address: PeerAddress, advertisement: Dict) -> PeerRecord:
+        record = self.seen(address)
+        with self._lock:
+            if isinstance(advertisement.get('capabilities'), list):
+                record.capabilities = set(advertisement['capabilities'])
+            if isinstance(advertisement.get('index_version'), int):
+                record.index_version = advertisement['index_version']
+            if advertisement.get('node_id'):
+                record.node_id = advertisement['node_id']
+            if isinstance(advertisement.get('interval'), (int, float)):
+                record.announce_interval = float(advertisement['interval'])
+        return record
+
+    def get(self, address: PeerAddress) -> PeerRecord | None:
+        with self._lock:
+            return self._peers.get(address)
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    def _is_live(self, record: PeerRecord, now: float) -> bool:
+        return now - record.last_seen <= max(self.live_window, LIVE_INTERVALS * record.announce_interval)
+
+    def expire(self) -> List[PeerAddress]:
+        now = time.monotonic()
+        with self._lock:
+            expired = [address for address, record in self._peers.items()
+                       if now - record.last_seen > max(self.expiry, EXPIRY_INTERVALS * record.announce_interval)]
+            for address in expired:
+                del self._peers[address]
+        return expired
+
+    def snapshot(self, live_only: bool = True) -> List[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [record.to_dict(now) for record in self._peers.values() if not live_only or self._is_live(record, now)]
+
+    def with_capability(self, capability: str) -> Set[PeerAddress]:
+        live = self.live_peers()
+        with self._lock:
+            return {address for address in live if capability in self._peers[address].capabilities}
+
+    def observe_rtt(self, address: PeerAddress, sample: float):
+        record = self.seen(address)
+        with self._lock:
+            record.observe_rtt(sample)
+
+    def observe_throughput(self, address: PeerAddress, rate: float):
+        with self._lock:
+            record = self._peers.get(address)
+            if record is None:
+                record = self._peers[address] = PeerRecord(*address)
+            record.observe_throughput(rate)
+
+    def live_peers(self) -> Set[PeerAddress]:
+        now = time.monotonic()
+        with self._lock:
+            return {address for address, record in self._peers.items() if self._is_live(record, now)}
+
+    def search_window(self, addresses: Iterable[PeerAddress]) -> float:
+        with self._lock:
+            timeouts = [record.rto for record in (self._peers.get(a) for a in addresses) if record is not None and record.rto is not None]
+        if not timeouts:
+            return SEARCH_DEFAULT_WINDOW
+        return min(SEARCH_MAX_WINDOW, max(SEARCH_MIN_WINDOW, max(timeouts) + SEARCH_SLACK))
+
+    def rank(self, candidates: List[Tuple]) -> List[Tuple]:
+        # Candidates start with (ip, port, ...); the fastest expected chunk fetch comes first.
+        unknown_cost = DEFAULT_RTT + CHUNK_SIZE / DEFAULT_THROUGHPUT
+        with self._lock:
+            costs = {(c[0], c[1]): self._peers[(c[0], c[1])].expected_chunk_time() if (c[0], c[1]) in self._peers else unknown_cost
+                     for c in candidates}
+        return sorted(candidates, key=lambda c: costs[(c[0], c[1])])
@@ -0,0 +1,174 @@
+import time
+import socket
+import logging
+import threading
+import weakref
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Bytes per second; None (or 0 when configuring) means unlimited.
+LIMIT_KEYS = ('upload', 'download', 'peer_upload', 'peer_download', 'transfer_upload', 'transfer_download')
+# A bucket holds this much time at its rate, so short bursts pass at line speed without exceeding the average.
+BURST_SECONDS = 0.1
+MIN_BURST = 64 * 1024
+RATE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Traffic classes: control datagrams are marked for low delay and queued ahead of bulk data by the kernel
+# (SO_PRIORITY 6 lands in the interactive band); bulk is marked lower effort.
+LANE_CONTROL = "control"
+LANE_BULK = "bulk"
+TRAFFIC_CLASSES = {LANE_CONTROL: (0x10, 6), LANE_BULK: (0x20, 2)}
+
+
+def parse_rate(value) -> int | None:
+    # 1500000, "1.5M" or "800K" (bytes per second); None, 0 or "none" lift the limit.
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip().upper()
+        if value in ("", "NONE", "UNLIMITED"):
+            return None
+        if value[-1] in RATE_SUFFIXES:
+            value = float(value[:-1]) * RATE_SUFFIXES[value[-1]]
+    rate = int(float(value))
+    if rate < 0:
+        raise ValueError(f"Negative rate {value}")
+    return rate or None
+
+
+def min_rate(*rates: int | None) -> int | None:
+    limited = [rate for rate in rates if rate]
+    return min(limited) if limited else None
+
+
+def set_traffic_class(sock: socket.socket, lane: str):
+    tos, priority = TRAFFIC_CLASSES[lane]
+    for level, option, value in ((socket.IPPROTO_IP, getattr(socket, "IP_TOS", None), tos),
+                                 (socket.SOL_SOCKET, getattr(socket, "SO_PRIORITY", None), priority)):
+        if option is None:
+            continue
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError as e:
+            logger.debug(f"Could not mark socket as {lane} traffic: {e}")
+
+
+class TokenBucket:
+    def __init__(self, rate: int | None = None):
+        self._lock = threading.Lock()
+        self.rate: int | None = None
+        self.capacity = 0.0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: int | None):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate or None
+            self.capacity = max(self.rate * BURST_SECONDS, MIN_BURST) if self.rate else 0.0
+            self.tokens = min(self.tokens, self.capacity) if self.rate else 0.0
+
+    def _refill(self, now: float):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, amount: int) -> float:
+        # Takes the tokens now, going into debt if need be, and returns how long the caller must wait for
+        # the debt to be repaid. Callers queue fairly this way without the bucket tracking waiters.
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Throttle:
+    # One transfer's view of the limiter: the shared global and per-peer buckets plus its own.
+    def __init__(self, buckets: List[TokenBucket], transfer_bucket: TokenBucket, requested: int | None = None):
+        self.buckets = buckets + [transfer_bucket]
+        self.transfer_bucket = transfer_bucket
+        self.requested = requested
+
+    @property
+    def limited(self) -> bool:
+        return any(bucket.rate for bucket in self.buckets)
+
+    def delay(self, amount: int) -> float:
+        return max(bucket.reserve(amount) for bucket in self.buckets)
+
+    def wait(self, amount: int):
+        delay = self.delay(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimiter:
+    def __init__(self, **limits):
+        self._lock = threading.Lock()
+        self.limits: Dict[str, int | None] = dict.fromkeys(LIMIT_KEYS)
+        self.upload = TokenBucket()
+        self.download = TokenBucket()
+        self._peer_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        # Live transfers, so a runtime change also applies to the ones already running.
+        self._throttles: Dict[str, weakref.WeakSet] = {'upload': weakref.WeakSet(), 'download': weakref.WeakSet()}
+        self.configure(**limits)
+
+    def configure(self, **limits) -> Dict[str, int | None]:
+        unknown = set(limits) - set(LIMIT_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown rate limits: {', '.join(sorted(unknown))}")
+        parsed = {key: parse_rate(value) for key, value in limits.items()}
+        with self._lock:
+            self.limits.update(parsed)
+            self.upload.set_rate(self.limits['upload'])
+            self.download.set_rate(self.limits['download'])
+            for (direction, _), bucket in self._peer_buckets.items():
+                bucket.set_rate(self.limits[f'peer_{direction}'])
+            for direction, throttles in self._throttles.items():
+                for throttle in list(throttles):
+                    throttle.transfer_bucket.set_rate(min_rate(self.limits[f'transfer_{direction}'], throttle.requested))
+            if parsed:
+                logger.info(f"Rate limits: {self.describe()}")
+            return dict(self.limits)
+
+    def describe(self) -> str:
+        return ", ".join(f"{key}={rate}" for key, rate in self.limits.items() if rate) or "unlimited"
+
+    def _peer_bucket(self, direction: str, peer_ip: str) -> TokenBucket:
+        key = (direction, peer_ip)
+        bucket = self._peer_buckets.get(key)
+        if bucket is None:
+            bucket = self._peer_buckets[key] = TokenBucket(self.limits[f'peer_{direction}'])
+        return bucket
+
+    def _throttle(self, direction: str, peer_ip: str, requested: int | None) -> Throttle:
+        with self._lock:
+            global_bucket = self.upload if direction == 'upload' else self.download
+            throttle = Throttle([global_bucket, self._peer_bucket(direction, peer_ip)],
+                                TokenBucket(min_rate(self.limits[f'transfer_{direction}'], requested)), requested)
+            self._throttles[direction].add(throttle)
+            return throttle
+
+    def uploader(self, peer_ip: str, requested: int | None = None) -> Throttle:
+        # `requested` is the cap the downloading peer asked for, applied on top of ours.
+        return self._throttle('upload', peer_ip, requested)
+
+    def downloader(self, peer_ip: str) -> Throttle:
+        return self._throttle('download', peer_ip, None)
+
+    def requested_download_rate(self) -> int | None:
+        # What a download request asks the sender to stay under, so UDP senders shape the flow at the source
+        # instead of the receiver dropping what it cannot take.
+        return min_rate(self.limits['download'], self.limits['peer_download'], self.limits['transfer_download'])
+
+    def charge_control(self, amount: int):
+        # Priority lane: control messages never wait, but what they send comes out of the global upload budget,
+        # so bulk transfers yield to them instead of the other way round.
+        self.upload.reserve(amount)
+
+
+rate_limiter = RateLimiter()
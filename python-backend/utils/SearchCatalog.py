@@ -0,0 +1,229 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from utils.ShareIndex import ShareIndex
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION = 1
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_RESULTS = 200
+# Trigram matching needs at least three characters; shorter terms fall back to LIKE on the candidates.
+MIN_TRIGRAM_TERM = 3
+# Substring matches ranked per query; broad terms on huge shares stop there instead of sorting every match.
+CANDIDATE_LIMIT = 10000
+# Above this many changes the trigram index is rebuilt in one pass instead of row by row through triggers.
+BULK_SYNC_ROWS = 10000
+# Exact name (or name without extension), prefix, anywhere else in the name.
+RANK_EXACT, RANK_PREFIX, RANK_SUBSTRING = 0, 1, 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL COLLATE NOCASE,
+    stem TEXT NOT NULL COLLATE NOCASE,
+    ext TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_name ON files(name);
+CREATE INDEX IF NOT EXISTS files_ext_size ON files(ext, size);
+CREATE INDEX IF NOT EXISTS files_size ON files(size);
+CREATE INDEX IF NOT EXISTS files_mtime ON files(mtime);
+"""
+
+FTS_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(name, content='files', content_rowid='id', tokenize='trigram');"
+FTS_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+    INSERT INTO files_fts(rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+    INSERT INTO files_fts(files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS files_au AFTER UPDATE OF name ON files BEGIN
+    INSERT INTO files_fts(files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    INSERT INTO files_fts(rowid, name) VALUES (new.id, new.name);
+END;
+"""
+DROP_FTS_TRIGGERS = "DROP TRIGGER IF EXISTS files_ai; DROP TRIGGER IF EXISTS files_ad; DROP TRIGGER IF EXISTS files_au;"
+
+
+def search_filters(raw: Dict | None) -> Dict:
+    # Whitelists and coerces filters coming from the network or the frontend.
+    raw = raw or {}
+    filters = {}
+    extensions = raw.get('extensions')
+    if isinstance(extensions, str):
+        extensions = [extensions]
+    if extensions:
+        filters['extensions'] = sorted({str(ext).lower().lstrip('.') for ext in extensions})
+    for key in ('min_size', 'max_size', 'modified_after', 'modified_before'):
+        if raw.get(key) is not None:
+            filters[key] = int(raw[key])
+    return filters
+
+
+def _escape_like(term: str) -> str:
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _prefix_range(phrase: str) -> Tuple[str, str]:
+    return phrase, phrase[:-1] + chr(ord(phrase[-1]) + 1)
+
+
+def _row(path: str, entry: Tuple[int, int, int, str]) -> Tuple:
+    name = os.path.basename(path)
+    stem, ext = os.path.splitext(name)
+    return path, name, stem, ext.lstrip('.').lower(), entry[0], entry[1] // 1_000_000_000, entry[3]
+
+
+class SearchCatalog:
+    # SQLite catalog of the share with a trigram index over names, kept in step with the ShareIndex
+    # through its change journal.
+    def __init__(self, share_index: ShareIndex, db_path: str | None = None):
+        self.share_index = share_index
+        if db_path is None:
+            parent, name = os.path.split(share_index.directory)
+            db_path = os.path.join(parent, f".{name}_catalog.sqlite")
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA cache_size=-65536")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+            self.db.executescript("DROP TABLE IF EXISTS files_fts; DROP TABLE IF EXISTS files;")
+            self.db.execute(f"PRAGMA user_version={CATALOG_VERSION}")
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.execute(FTS_TABLE)
+            self.db.executescript(FTS_TRIGGERS)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            # SQLite without FTS5 or its trigram tokenizer (before 3.34): names are scanned with LIKE instead.
+            logger.warning(f"Trigram index unavailable, search falls back to scanning names: {e}")
+            self.fts = False
+        self.db.commit()
+        self.synced_seq: int | None = None
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def sync(self) -> int:
+        self.share_index.refresh()
+        with self._lock:
+            seq, changes = self.share_index.changes_since(self.synced_seq)
+            if changes is not None and not changes:
+                return 0
+            started = time.monotonic()
+            if changes is None:
+                changed = self._resync()
+            else:
+                changed = self._apply(changes)
+            self.db.commit()
+            self.synced_seq = seq
+        if changed:
+            logger.info(f"Search catalog synced {changed} change(s) in {time.monotonic() - started:.3f}s")
+        return changed
+
+    def _apply(self, changes: Dict) -> int:
+        removed = [(path,) for path, entry in changes.items() if entry is None]
+        # Path order keeps the B-tree inserts local.
+        upserts = sorted(_row(path, entry) for path, entry in changes.items() if entry is not None)
+        bulk = self.fts and len(changes) > BULK_SYNC_ROWS
+        if bulk:
+            self.db.executescript(DROP_FTS_TRIGGERS)
+        self.db.executemany("DELETE FROM files WHERE path = ?", removed)
+        self.db.executemany(
+            "INSERT INTO files(path, name, stem, ext, size, mtime, hash) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET name = excluded.name, stem = excluded.stem, ext = excluded.ext, "
+            "size = excluded.size, mtime = excluded.mtime, hash = excluded.hash", upserts)
+        if bulk:
+            self.db.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+            self.db.executescript(FTS_TRIGGERS)
+        return len(removed) + len(upserts)
+
+    def _resync(self) -> int:
+        # Diffs the whole share against the stored rows, so a restart only writes what changed meanwhile.
+        _, entries = self.share_index.snapshot()
+        stored = {path: (size, mtime, file_hash) for path, size, mtime, file_hash in
+                  self.db.execute("SELECT path, size, mtime, hash FROM files")}
+        changes = {path: None for path in stored.keys() - entries.keys()}
+        for path, entry in entries.items():
+            row = _row(path, entry)
+            if stored.get(path) != row[4:]:
+                changes[path] = entry
+        return self._apply(changes)
+
+    def search(self, query: str = "", extensions: Iterable[str] | None = None, min_size: int | None = None,
+               max_size: int | None = None, modified_after: int | None = None, modified_before: int | None = None,
+               limit: int = DEFAULT_SEARCH_LIMIT, offset: int = 0) -> Tuple[List[Dict], bool]:
+        self.sync()
+        limit = max(0, min(limit, MAX_SEARCH_RESULTS))
+        offset = max(0, offset)
+        terms = query.lower().split()
+
+        filters: List[str] = []
+        filter_params: List = []
+        if extensions:
+            extensions = [ext.lower().lstrip('.') for ext in extensions]
+            filters.append(f"files.ext IN ({', '.join('?' * len(extensions))})")
+            filter_params.extend(extensions)
+        for column, operator, value in (("size", ">=", min_size), ("size", "<=", max_size),
+                                        ("mtime", ">=", modified_after), ("mtime", "<=", modified_before)):
+            if value is not None:
+                filters.append(f"files.{column} {operator} ?")
+                filter_params.append(value)
+
+        columns = "files.path, files.name, files.size, files.mtime, files.hash, files.ext"
+        if not terms:
+            # Attribute-only queries list the largest files first, which the (ext, size) and size indexes
+            # return already ordered, so the page is read without sorting every match.
+            sql = (f"SELECT {columns}, {RANK_SUBSTRING} FROM files {'WHERE ' + ' AND '.join(filters) if filters else ''} "
+                   f"ORDER BY files.size DESC, files.id DESC LIMIT ? OFFSET ?")
+            params = filter_params + [limit + 1, offset]
+        else:
+            phrase = " ".join(terms)
+            low, high = _prefix_range(phrase)
+            # Exact and prefix matches come straight off the name index, so weaker matches never crowd them out.
+            prefix_sql = " AND ".join(["files.name >= ? AND files.name < ?"] + filters)
+            prefix_params = [low, high] + filter_params
+
+            trigram_terms = [t for t in terms if len(t) >= MIN_TRIGRAM_TERM] if self.fts else []
+            substring_where: List[str] = []
+            substring_params: List = []
+            if trigram_terms:
+                # CROSS JOIN keeps the trigram index as the driving table; the planner would otherwise probe it once per row.
+                source = "files_fts CROSS JOIN files ON files.id = files_fts.rowid"
+                substring_where.append("files_fts MATCH ?")
+                substring_params.append(" AND ".join('"' + t.replace('"', '""') + '"' for t in trigram_terms))
+            else:
+                source = "files"
+            for term in terms:
+                if term not in trigram_terms:
+                    substring_where.append("files.name LIKE ? ESCAPE '\\'")
+                    substring_params.append(f"%{_escape_like(term)}%")
+            substring_sql = " AND ".join(substring_where + filters)
+            substring_params += filter_params
+
+            rank = (f"CASE WHEN files.name = ? OR files.stem = ? THEN {RANK_EXACT} "
+                    f"WHEN files.name >= ? AND files.name < ? THEN {RANK_PREFIX} ELSE {RANK_SUBSTRING} END")
+            sql = (f"SELECT {columns}, {rank} AS rank FROM files WHERE files.id IN ("
+                   f"SELECT id FROM (SELECT files.id FROM files INDEXED BY files_name WHERE {prefix_sql} LIMIT {CANDIDATE_LIMIT}) UNION "
+                   f"SELECT id FROM (SELECT files.id FROM {source} WHERE {substring_sql} LIMIT {CANDIDATE_LIMIT})) "
+                   f"ORDER BY rank, length(files.name), files.name LIMIT ? OFFSET ?")
+            # One extra row tells whether another page exists without counting every match.
+            params = [phrase, phrase, low, high] + prefix_params + substring_params + [limit + 1, offset]
+        with self._lock:
+            rows = self.db.execute(sql, params).fetchall()
+        results = [{'name': name, 'path': os.path.relpath(path, self.share_index.directory), 'hash': file_hash,
+                    'size': size, 'mtime': mtime, 'ext': ext, 'rank': rank}
+                   for path, name, size, mtime, file_hash, ext, rank in rows[:limit]]
+        return results, len(rows) > limit
@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+from typing import Dict, List, Set, Tuple
+
+from utils.Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+HASH_BLOCK_SIZE = 1024 * 1024
+PARTIAL_SUFFIX = ".part"
+# Recent per-path changes kept for consumers that follow the index incrementally.
+JOURNAL_SIZE = 65536
+
+# Hashed bytes over hashing time is the hash throughput.
+HASHED_BYTES = metrics.counter("p2p_hashed_bytes_total", "Bytes read by whole-file SHA-256 hashing")
+HASH_SECONDS = metrics.counter("p2p_hash_seconds_total", "Time spent hashing whole files")
+
+
+def hash_file(filepath: str) -> str:
+    started = time.perf_counter()
+    sha256_hash = hashlib.sha256()
+    hashed = 0
+    with open(filepath, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            sha256_hash.update(block)
+            hashed += len(block)
+    HASHED_BYTES.inc((), hashed)
+    HASH_SECONDS.inc((), time.perf_counter() - started)
+    return sha256_hash.hexdigest()
+
+
+def is_shareable(filename: str) -> bool:
+    return not filename.startswith('.') and not filename.endswith(PARTIAL_SUFFIX)
+
+
+class ShareIndex:
+    def __init__(self, directory: str = "publicFiles", index_path: str | None = None, refresh_interval: float = 2.0):
+        self.directory = os.path.abspath(directory)
+        if index_path is None:
+            parent, name = os.path.split(self.directory)
+            index_path = os.path.join(parent, f".{name}_index.json")
+        self.index_path = index_path
+        self.refresh_interval = refresh_interval
+        # Set by a ShareWatcher once it streams filesystem events into the index;
+        # lookups then stop triggering directory walks.
+        self.live = False
+
+        # path -> (size, mtime_ns, inode, sha256)
+        self.entries: Dict[str, Tuple[int, int, int, str]] = {}
+        self.by_hash: Dict[str, str] = {}
+        self.by_name: Dict[str, str] = {}
+        self._hash_paths: Dict[str, Set[str]] = {}
+        self._name_paths: Dict[str, Set[str]] = {}
+        self.version = 0
+        # Every entry change, including ones that keep the hash and so leave the version alone, gets a sequence
+        # number; (sequence, path) for recent ones is kept, anything at or below the floor may be missing.
+        self.change_seq = 0
+        self._journal: deque = deque()
+        self._journal_floor = 0
+
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = 0.0
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable share index {self.index_path}: {e}")
+            return
+        if data.get('version') != INDEX_VERSION or data.get('directory') != self.directory:
+            return
+        self.entries = {path: tuple(entry) for path, entry in data.get('entries', {}).items()}
+        self._rebuild_maps()
+        logger.info(f"Loaded share index with {len(self.entries)} entries from {self.index_path}")
+
+    def _save(self):
+        with self._lock:
+            data = {
+                'version': INDEX_VERSION,
+                'directory': self.directory,
+                'entries': dict(self.entries)
+            }
+            self._dirty = False
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not persist share index to {self.index_path}: {e}")
+
+    def flush(self):
+        if self._dirty:
+            self._save()
+
+    def _rebuild_maps(self):
+        self._hash_paths = {}
+        self._name_paths = {}
+        for path, entry in self.entries.items():
+            self._hash_paths.setdefault(entry[3], set()).add(path)
+            self._name_paths.setdefault(os.path.basename(path), set()).add(path)
+        self.by_hash = {file_hash: min(paths) for file_hash, paths in self._hash_paths.items()}
+        self.by_name = {name: self.entries[min(paths)][3] for name, paths in self._name_paths.items()}
+        self.version += 1
+        # Wholesale replacement: readers of the journal have to resynchronise.
+        self.change_seq += 1
+        self._journal.clear()
+        self._journal_floor = self.change_seq
+
+    def _link(self, path: str, entry: Tuple[int, int, int, str]):
+        previous = self.entries.get(path)
+        if previous is not None:
+            if previous[3] == entry[3]:
+                self.entries[path] = entry
+                self._record(path)
+                self._dirty = True
+                return
+            self._unlink(path)
+        self.entries[path] = entry
+        name = os.path.basename(path)
+        hash_paths = self._hash_paths.setdefault(entry[3], set())
+        hash_paths.add(path)
+        name_paths = self._name_paths.setdefault(name, set())
+        name_paths.add(path)
+        self.by_hash[entry[3]] = min(hash_paths)
+        self.by_name[name] = self.entries[min(name_paths)][3]
+        self.version += 1
+        self._record(path)
+        self._dirty = True
+
+    def _unlink(self, path: str):
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return
+        name = os.path.basename(path)
+        for key, paths, lookup in ((entry[3], self._hash_paths, self.by_hash), (name, self._name_paths, self.by_name)):
+            remaining = paths.get(key)
+            if remaining is None:
+                continue
+            remaining.discard(path)
+            if not remaining:
+                del paths[key]
+                lookup.pop(key, None)
+            elif lookup is self.by_hash:
+                lookup[key] = min(remaining)
+            else:
+                lookup[key] = self.entries[min(remaining)][3]
+        self.version += 1
+        self._record(path)
+        self._dirty = True
+
+    def _record(self, path: str):
+        self.change_seq += 1
+        if len(self._journal) >= JOURNAL_SIZE:
+            self._journal_floor = self._journal.popleft()[0]
+        self._journal.append((self.change_seq, path))
+
+    def changes_since(self, seq: int | None) -> Tuple[int, Dict[str, Tuple[int, int, int, str] | None] | None]:
+        # Current sequence and the entries of paths changed after `seq` (None where removed), or None when
+        # the journal no longer reaches back that far and the caller has to resynchronise from snapshot().
+        with self._lock:
+            if seq is None or seq < self._journal_floor:
+                return self.change_seq, None
+            changes = {}
+            for changed_at, path in reversed(self._journal):
+                if changed_at <= seq:
+                    break
+                changes.setdefault(path, self.entries.get(path))
+            return self.change_seq, changes
+
+    def snapshot(self) -> Tuple[int, Dict[str, Tuple[int, int, int, str]]]:
+        with self._lock:
+            return self.change_seq, dict(self.entries)
+
+    def refresh(self, force: bool = False) -> bool:
+        if not force and (self.live or time.monotonic() - self._last_refresh < self.refresh_interval):
+            return False
+        # A refresh already in progress will publish its result; callers use the current maps meanwhile.
+        if not self._refresh_lock.acquire(blocking=force):
+            return False
+        try:
+            return self._refresh()
+        finally:
+            self._last_refresh = time.monotonic()
+            self._refresh_lock.release()
+
+    def _refresh(self) -> bool:
+        seen: Dict[str, Tuple[int, int, int, str]] = {}
+        changed = False
+        hashed = 0
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not is_shareable(filename):
+                    continue
+                file_path = os.path.join(root, filename)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                previous = self.entries.get(file_path)
+                if previous and previous[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+                    seen[file_path] = previous
+                    continue
+                try:
+                    seen[file_path] = (st.st_size, st.st_mtime_ns, st.st_ino, hash_file(file_path))
+                except OSError as e:
+                    logger.warning(f"Could not hash {file_path}: {e}")
+                    continue
+                hashed += 1
+                changed = True
+
+        if changed or len(seen) != len(self.entries):
+            with self._lock:
+                self.entries = seen
+                self._rebuild_maps()
+            self._save()
+            logger.info(f"Share index updated: {len(seen)} files, {hashed} hashed")
+            return True
+        return False
+
+    def update_path(self, file_path: str, file_hash: str | None = None, save: bool = True,
+                    reuse: Tuple[int, int, int, str] | None = None) -> bool:
+        # `reuse` is an earlier entry whose hash is taken over if the file still has its size, mtime and inode.
+        file_path = os.path.abspath(file_path)
+        if not is_shareable(os.path.basename(file_path)):
+            return False
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return self.remove_path(file_path, save=save)
+        signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+        if file_hash is None and reuse is not None and reuse[:3] == signature:
+            file_hash = reuse[3]
+        previous = self.entries.get(file_path)
+        if previous is not None and previous[:3] == signature and file_hash in (None, previous[3]):
+            return False
+        if file_hash is None:
+            file_hash = hash_file(file_path)
+            try:
+                st = os.stat(file_path)
+            except FileNotFoundError:
+                return self.remove_path(file_path, save=save)
+            if (st.st_size, st.st_mtime_ns, st.st_ino) != signature:
+                # Changed again while it was being hashed; the next event or refresh will catch up.
+                return False
+        with self._lock:
+            self._link(file_path, signature + (file_hash,))
+        if save:
+            self._save()
+        return True
+
+    def add_file(self, file_path: str, file_hash: str | None = None):
+        self.update_path(file_path, file_hash)
+
+    def remove_path(self, file_path: str, save: bool = True) -> bool:
+        file_path = os.path.abspath(file_path)
+        with self._lock:
+            if file_path not in self.entries:
+                return False
+            self._unlink(file_path)
+        if save:
+            self._save()
+        return True
+
+    def remove_tree(self, directory: str, save: bool = True) -> int:
+        prefix = os.path.abspath(directory) + os.sep
+        with self._lock:
+            doomed = [path for path in self.entries if path.startswith(prefix)]
+            for path in doomed:
+                self._unlink(path)
+        if doomed and save:
+            self._save()
+        return len(doomed)
+
+    def rename_path(self, old_path: str, new_path: str, save: bool = True) -> bool:
+        old_path = os.path.abspath(old_path)
+        new_path = os.path.abspath(new_path)
+        with self._lock:
+            entry = self.entries.get(old_path)
+            if entry is not None:
+                self._unlink(old_path)
+        if entry is None or not is_shareable(os.path.basename(new_path)):
+            return self.update_path(new_path, save=save) or entry is not None
+        # A plain rename keeps inode, size and mtime, so the old hash is still valid; a file written just before
+        # it was moved (an editor's atomic save) no longer matches and is rehashed.
+        return self.update_path(new_path, save=save, reuse=entry)
+
+    def files(self) -> Dict[str, str]:
+        self.refresh()
+        with self._lock:
+            return dict(self.by_hash)
+
+    def shared_keys(self) -> Tuple[List[str], List[str]]:
+        self.refresh()
+        with self._lock:
+            return list(self.by_name), list(self.by_hash)
+
+    def path_for_hash(self, file_hash: str) -> str | None:
+        self.refresh()
+        return self.by_hash.get(file_hash)
+
+    def size_for_hash(self, file_hash: str) -> int | None:
+        path = self.path_for_hash(file_hash)
+        entry = self.entries.get(path) if path else None
+        return entry[0] if entry else None
+
+    def hash_for_name(self, filename: str) -> str | None:
+        self.refresh()
+        return self.by_name.get(filename)
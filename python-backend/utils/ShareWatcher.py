@@ -0,0 +1,249 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import struct
+import select
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Tuple
+
+from utils.ShareIndex import ShareIndex
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 64 * 1024
+
+# Event kinds emitted by the backends.
+EVENT_CHANGED = "changed"
+EVENT_DELETED = "deleted"
+EVENT_MOVED = "moved"
+EVENT_DELETED_TREE = "deleted_tree"
+EVENT_RESCAN = "rescan"
+
+
+class InotifyBackend:
+    def __init__(self, directory: str, emit: Callable[..., None]):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        self.directory = directory
+        self.emit = emit
+        self.watches: Dict[int, str] = {}
+
+    def add_tree(self, directory: str, scan: bool = False):
+        for root, _, filenames in os.walk(directory):
+            self._add_watch(root)
+            if scan:
+                for filename in filenames:
+                    self.emit(EVENT_CHANGED, os.path.join(root, filename))
+
+    def _add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            logger.warning(f"Could not watch {path}: {os.strerror(errno)}")
+            if path == self.directory:
+                raise OSError(errno, f"inotify_add_watch failed for {path}")
+            return
+        self.watches[wd] = path
+
+    def _forget_tree(self, directory: str):
+        prefix = directory + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def run(self, stop: threading.Event):
+        try:
+            while not stop.is_set():
+                readable, _, _ = select.select([self.fd], [], [], 0.5)
+                if readable:
+                    self._dispatch(os.read(self.fd, INOTIFY_READ_SIZE))
+        except Exception as e:
+            logger.error(f"inotify watcher stopped: {e}", exc_info=True)
+        finally:
+            os.close(self.fd)
+
+    def _dispatch(self, data: bytes):
+        moved_from: Dict[int, Tuple[str, bool]] = {}
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            raw_name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+            offset += INOTIFY_EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning share directory.")
+                self.emit(EVENT_RESCAN, self.directory)
+                continue
+            parent = self.watches.get(wd)
+            if parent is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if not raw_name:
+                continue
+
+            path = os.path.join(parent, os.fsdecode(raw_name))
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & IN_MOVED_TO:
+                source = moved_from.pop(cookie, None)
+                if is_dir:
+                    if source:
+                        self._forget_tree(source[0])
+                        self.emit(EVENT_DELETED_TREE, source[0])
+                    self.add_tree(path, scan=True)
+                elif source:
+                    self.emit(EVENT_MOVED, source[0], path)
+                else:
+                    self.emit(EVENT_CHANGED, path)
+            elif is_dir:
+                if mask & IN_CREATE:
+                    # Files may already exist by the time the watch is in place, so scan the new tree.
+                    self.add_tree(path, scan=True)
+                elif mask & IN_DELETE:
+                    self.emit(EVENT_DELETED_TREE, path)
+            elif mask & IN_DELETE:
+                self.emit(EVENT_DELETED, path)
+            else:
+                self.emit(EVENT_CHANGED, path)
+
+        # Moved out of the share without a matching MOVED_TO.
+        for path, is_dir in moved_from.values():
+            if is_dir:
+                self._forget_tree(path)
+            self.emit(EVENT_DELETED_TREE if is_dir else EVENT_DELETED, path)
+
+
+class PollingBackend:
+    def __init__(self, share_index: ShareIndex, interval: float):
+        self.share_index = share_index
+        self.interval = interval
+
+    def run(self, stop: threading.Event):
+        while not stop.wait(self.interval):
+            try:
+                self.share_index.refresh(force=True)
+            except Exception as e:
+                logger.error(f"Error polling share directory: {e}", exc_info=True)
+
+
+class ShareWatcher:
+    def __init__(self, share_index: ShareIndex, debounce: float = 0.5, hash_workers: int = 2,
+                 poll_interval: float = 5.0, flush_interval: float = 5.0, use_inotify: bool = True):
+        self.share_index = share_index
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+        self.use_inotify = use_inotify
+        self.backend = None
+
+        # path -> monotonic time at which the debounced update is due
+        self.pending: Dict[str, float] = {}
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="share-hash")
+
+    def start(self):
+        directory = self.share_index.directory
+        os.makedirs(directory, exist_ok=True)
+
+        if self.use_inotify and sys.platform.startswith("linux"):
+            try:
+                backend = InotifyBackend(directory, self._on_event)
+                backend.add_tree(directory)
+                self.backend = backend
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify unavailable ({e}), falling back to polling every {self.poll_interval}s.")
+        if self.backend is None:
+            self.backend = PollingBackend(self.share_index, self.poll_interval)
+
+        # Watches are in place before the initial scan, so nothing created meanwhile is missed.
+        self.share_index.live = True
+        self._executor.submit(self.share_index.refresh, True)
+        threading.Thread(target=self.backend.run, args=(self._stop,), daemon=True).start()
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+        logger.info(f"Watching {directory} with {type(self.backend).__name__}")
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        self._executor.shutdown(wait=False)
+        self.share_index.live = False
+        self.share_index.flush()
+
+    def _on_event(self, kind: str, *paths: str):
+        if self._stop.is_set():
+            return
+        if kind == EVENT_CHANGED:
+            with self._cond:
+                self.pending[paths[0]] = time.monotonic() + self.debounce
+                self._cond.notify()
+        elif kind == EVENT_DELETED:
+            with self._cond:
+                self.pending.pop(paths[0], None)
+            self.share_index.remove_path(paths[0], save=False)
+        elif kind == EVENT_MOVED:
+            with self._cond:
+                # A write still waiting out its debounce follows the file to its new name.
+                deadline = self.pending.pop(paths[0], None)
+                if deadline is not None:
+                    self.pending[paths[1]] = deadline
+                    self._cond.notify()
+            self._executor.submit(self._apply, self.share_index.rename_path, paths[0], paths[1])
+        elif kind == EVENT_DELETED_TREE:
+            prefix = paths[0] + os.sep
+            with self._cond:
+                for path in [p for p in self.pending if p.startswith(prefix)]:
+                    del self.pending[path]
+            self.share_index.remove_tree(paths[0], save=False)
+        elif kind == EVENT_RESCAN:
+            self._executor.submit(self.share_index.refresh, True)
+
+    def _apply(self, update, *paths: str):
+        try:
+            update(*paths, save=False)
+        except OSError as e:
+            logger.debug(f"Could not index {paths}: {e}")
+        except Exception as e:
+            logger.error(f"Error indexing {paths}: {e}", exc_info=True)
+
+    def _dispatch_loop(self):
+        last_flush = time.monotonic()
+        while not self._stop.is_set():
+            with self._cond:
+                now = time.monotonic()
+                due = [path for path, deadline in self.pending.items() if deadline <= now]
+                for path in due:
+                    del self.pending[path]
+                if not due:
+                    next_deadline = min(self.pending.values(), default=now + self.flush_interval)
+                    self._cond.wait(min(max(next_deadline - now, 0.01), self.flush_interval))
+            for path in due:
+                self._executor.submit(self._apply, self.share_index.update_path, path)
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.share_index.flush()
+                last_flush = time.monotonic()
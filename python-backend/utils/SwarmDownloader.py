@@ -0,0 +1,335 @@
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Set, Tuple
+
+from utils.FileTransfer import chunk_count, read_at, write_at
+from utils.ManifestManager import CHUNK_SIZE, hash_whole_file
+from utils.DownloadState import DownloadState
+
+logger = logging.getLogger(__name__)
+
+Source = Tuple[str, int]
+
+INITIAL_BATCH_CHUNKS = 4
+MAX_BATCH_CHUNKS = 32
+TARGET_BATCH_SECONDS = 1.0
+MAX_CONSECUTIVE_FAILURES = 3
+MIN_BATCHES_BEFORE_DROP = 2
+SLOW_SOURCE_FRACTION = 0.25
+MAX_SOURCES = 8
+
+
+class ChunkScheduler:
+    def __init__(self, total_chunks: int, done: Set[int] | None = None):
+        self.total_chunks = total_chunks
+        self.done = bytearray(total_chunks)
+        for chunk_index in done or ():
+            self.done[chunk_index] = 1
+        self.remaining = total_chunks - sum(self.done)
+        self.availability = [0] * total_chunks
+        # chunk -> sources currently fetching it
+        self.in_flight: Dict[int, Set[Source]] = {}
+        # source -> chunks it can serve, None for a complete copy
+        self.source_chunks: Dict[Source, Set[int] | None] = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def add_source(self, source: Source, have: Set[int] | None = None):
+        with self._lock:
+            self.source_chunks[source] = have
+            for chunk_index in (range(self.total_chunks) if have is None else have):
+                self.availability[chunk_index] += 1
+
+    def remove_source(self, source: Source):
+        with self._lock:
+            have = self.source_chunks.pop(source, ())
+            for chunk_index in (range(self.total_chunks) if have is None else have):
+                self.availability[chunk_index] -= 1
+            for sources in self.in_flight.values():
+                sources.discard(source)
+            self._changed.notify_all()
+
+    def is_complete(self) -> bool:
+        return self.remaining == 0
+
+    def next_batch(self, source: Source, size: int) -> List[int]:
+        with self._lock:
+            have = self.source_chunks.get(source)
+            candidates = range(self.total_chunks) if have is None else have
+            missing = [c for c in candidates if not self.done[c]]
+            fresh = [c for c in missing if not self.in_flight.get(c)]
+            if fresh:
+                # Rarest first; ties go to the lowest index so batches stay contiguous on disk.
+                fresh.sort(key=lambda c: (self.availability[c], c))
+                batch = sorted(fresh[:size])
+            else:
+                # Endgame: duplicate the least-duplicated outstanding chunks from other sources.
+                duplicates = [c for c in missing if source not in self.in_flight.get(c, ())]
+                duplicates.sort(key=lambda c: (len(self.in_flight.get(c, ())), c))
+                batch = sorted(duplicates[:size])
+            for chunk_index in batch:
+                self.in_flight.setdefault(chunk_index, set()).add(source)
+            return batch
+
+    def mark_done(self, chunk_index: int) -> bool:
+        with self._lock:
+            if self.done[chunk_index]:
+                return False
+            self.done[chunk_index] = 1
+            self.remaining -= 1
+            self._changed.notify_all()
+            return True
+
+    def finish_batch(self, source: Source, batch: List[int]):
+        with self._lock:
+            for chunk_index in batch:
+                sources = self.in_flight.get(chunk_index)
+                if sources is not None:
+                    sources.discard(source)
+                    if not sources:
+                        del self.in_flight[chunk_index]
+            self._changed.notify_all()
+
+    def redundant_sources(self) -> Set[Source]:
+        with self._lock:
+            pending: Dict[Source, bool] = {}
+            for chunk_index, sources in self.in_flight.items():
+                for source in sources:
+                    pending[source] = pending.get(source, True) and bool(self.done[chunk_index])
+            return {source for source, all_done in pending.items() if all_done}
+
+    def wait_for_change(self, timeout: float):
+        with self._changed:
+            self._changed.wait(timeout)
+
+
+class SourceStats:
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+        self.batches = 0
+        self.consecutive_failures = 0
+        self.corrupt_chunks = 0
+
+    @property
+    def rate(self) -> float:
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+
+class SwarmDownload:
+    def __init__(self, discovery, file_hash: str, file_size: int, sources: List[Source], destination_path: str,
+                 max_sources: int = MAX_SOURCES, batch_timeout: float = 10.0, state: DownloadState | None = None,
+                 cancelled: threading.Event | None = None, on_progress: Callable[[int, int], None] | None = None,
+                 chunk_store=None):
+        self.discovery = discovery
+        self.batch_timeout = batch_timeout
+        self.file_hash = file_hash
+        self.file_size = file_size
+        self.sources = list(dict.fromkeys(sources))[:max_sources]
+        self.destination_path = destination_path
+        self.state = state
+        self.cancelled = cancelled or threading.Event()
+        self.on_progress = on_progress
+        self.chunk_store = chunk_store
+        self.part_path = state.part_path if state else destination_path + ".part"
+        done = state.done_chunks() if state else set()
+        # Chunks that repeat within the file are fetched once and copied when the first copy arrives.
+        self.duplicates: Dict[int, List[int]] = {}
+        if state is not None:
+            first_index: Dict[str, int] = {}
+            for chunk_index, chunk_hash in enumerate(state.manifest["chunks"]):
+                first = first_index.setdefault(chunk_hash, chunk_index)
+                if first != chunk_index:
+                    self.duplicates.setdefault(first, []).append(chunk_index)
+        self.scheduler = ChunkScheduler(chunk_count(file_size), done=done.union(*self.duplicates.values()))
+        self.stats: Dict[Source, SourceStats] = {source: SourceStats() for source in self.sources}
+        self.active: Set[Source] = set(self.sources)
+        self._lock = threading.Lock()
+        self._batch_cancels: Dict[Source, threading.Event] = {}
+        self.bytes_done = sum(self._chunk_length(c) for c in done)
+
+    def run(self) -> bool:
+        if not self.sources:
+            return False
+        if self.state is None:
+            os.makedirs(os.path.dirname(self.destination_path) or ".", exist_ok=True)
+            with open(self.part_path, "wb") as f:
+                f.truncate(self.file_size)
+        else:
+            if self.bytes_done:
+                logger.info(f"Resuming {self.destination_path}: {len(self.state.done_chunks())}/{self.scheduler.total_chunks} chunks already verified")
+            self._fill_local_chunks()
+        if self.scheduler.is_complete():
+            return self._finish(time.monotonic())
+
+        start_time = time.monotonic()
+        for source in self.sources:
+            self.scheduler.add_source(source)
+        workers = [threading.Thread(target=self._worker, args=(source,), daemon=True) for source in self.sources]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.2)
+                if self.cancelled.is_set():
+                    self._cancel_batches(self.sources)
+
+        if self.cancelled.is_set() and not self.scheduler.is_complete():
+            logger.info(f"Swarm download of {self.file_hash} cancelled with {self.scheduler.remaining} chunk(s) missing.")
+            return False
+        if not self.scheduler.is_complete():
+            logger.warning(f"Swarm download of {self.file_hash} incomplete: {self.scheduler.remaining} chunk(s) missing, no usable sources left.")
+            return False
+        return self._finish(start_time)
+
+    def _finish(self, start_time: float) -> bool:
+        if self.state is not None:
+            if not self.state.finalize():
+                return False
+        elif hash_whole_file(self.part_path) != self.file_hash:
+            logger.error(f"Hash mismatch for {self.destination_path}, discarding download.")
+            os.remove(self.part_path)
+            return False
+        else:
+            os.replace(self.part_path, self.destination_path)
+
+        peer_table = getattr(self.discovery, "peer_table", None)
+        if peer_table is not None:
+            for source, stats in self.stats.items():
+                if stats.bytes:
+                    peer_table.observe_throughput(source, stats.rate)
+
+        elapsed = max(time.monotonic() - start_time, 1e-6)
+        per_source = ", ".join(f"{ip}:{port}={stats.bytes}" for (ip, port), stats in self.stats.items())
+        logger.info(f"Swarm download of {self.destination_path} finished at {self.file_size / elapsed / 1e6:.1f} MB/s from {len(self.sources)} source(s) ({per_source})")
+        return True
+
+    def _chunk_length(self, chunk_index: int) -> int:
+        return min(CHUNK_SIZE, self.file_size - chunk_index * CHUNK_SIZE)
+
+    def _cancel_batches(self, sources):
+        with self._lock:
+            for source in sources:
+                cancel = self._batch_cancels.get(source)
+                if cancel is not None:
+                    cancel.set()
+
+    def _batch_size(self, source: Source) -> int:
+        rate = self.stats[source].rate
+        if rate <= 0:
+            return INITIAL_BATCH_CHUNKS
+        return max(1, min(MAX_BATCH_CHUNKS, int(rate * TARGET_BATCH_SECONDS / CHUNK_SIZE)))
+
+    def _worker(self, source: Source):
+        stats = self.stats[source]
+        with open(self.part_path, "r+b") as f:
+            while not self.scheduler.is_complete() and not self.cancelled.is_set():
+                batch = self.scheduler.next_batch(source, self._batch_size(source))
+                if not batch:
+                    self.scheduler.wait_for_change(0.5)
+                    continue
+
+                cancel = threading.Event()
+                with self._lock:
+                    self._batch_cancels[source] = cancel
+                started = time.monotonic()
+                completed = self.discovery.request_chunks(source[0], source[1], self.file_hash, f, batch,
+                                                          expected_size=self.file_size, cancelled=cancel,
+                                                          idle_timeout=self.batch_timeout,
+                                                          on_chunk=lambda chunk_index: self._chunk_completed(source, f, chunk_index))
+                elapsed = time.monotonic() - started
+                self.scheduler.finish_batch(source, batch)
+
+                stats.bytes += sum(self._chunk_length(c) for c in completed)
+                stats.seconds += elapsed
+                stats.batches += 1
+                if completed or cancel.is_set():
+                    stats.consecutive_failures = 0
+                else:
+                    stats.consecutive_failures += 1
+                logger.debug(f"Source {source[0]}:{source[1]} delivered {len(completed)}/{len(batch)} chunks in {elapsed:.2f}s")
+
+                if self._should_drop(source):
+                    break
+
+        with self._lock:
+            self._batch_cancels.pop(source, None)
+            self.active.discard(source)
+        self.scheduler.remove_source(source)
+
+    def _chunk_completed(self, source: Source, f, chunk_index: int):
+        if self.state is not None and not self.state.verify_and_mark(chunk_index, f.fileno()):
+            logger.warning(f"Chunk {chunk_index} from {source[0]}:{source[1]} failed verification.")
+            self.stats[source].corrupt_chunks += 1
+            return
+        self._chunk_done(f.fileno(), chunk_index)
+
+    def _chunk_done(self, fd: int, chunk_index: int):
+        # Duplicates are filled before the chunk counts as done so the download never completes without them.
+        copied = self._copy_chunk(fd, chunk_index, self.duplicates.get(chunk_index, ()))
+        if not self.scheduler.mark_done(chunk_index):
+            return
+        with self._lock:
+            self.bytes_done += self._chunk_length(chunk_index) + copied
+            bytes_done = self.bytes_done
+        if self.on_progress is not None:
+            self.on_progress(bytes_done, self.file_size)
+        # Endgame: once every chunk a source is still fetching has arrived elsewhere, stop that transfer.
+        redundant = self.scheduler.redundant_sources()
+        if redundant:
+            self._cancel_batches(redundant)
+
+    def _copy_chunk(self, fd: int, chunk_index: int, targets) -> int:
+        targets = [c for c in targets if not self.state.is_done(c)]
+        if not targets:
+            return 0
+        data = read_at(fd, chunk_index * CHUNK_SIZE, self._chunk_length(chunk_index))
+        copied = 0
+        for target in targets:
+            write_at(fd, target * CHUNK_SIZE, data)
+            if self.state.verify_and_mark(target, fd):
+                copied += len(data)
+        return copied
+
+    def _fill_local_chunks(self):
+        # Chunks this node already has, in this file or in the chunk store, never go over the network.
+        filled = 0
+        with open(self.part_path, "r+b") as f:
+            fd = f.fileno()
+            for chunk_index, duplicates in self.duplicates.items():
+                if self.state.is_done(chunk_index):
+                    copied = self._copy_chunk(fd, chunk_index, duplicates)
+                    with self._lock:
+                        self.bytes_done += copied
+            for chunk_index in range(self.scheduler.total_chunks):
+                if self.scheduler.done[chunk_index] or self.chunk_store is None:
+                    continue
+                data = self.chunk_store.read_chunk(self.state.manifest["chunks"][chunk_index])
+                if data is None:
+                    continue
+                write_at(fd, chunk_index * CHUNK_SIZE, data)
+                if self.state.verify_and_mark(chunk_index, fd):
+                    self._chunk_done(fd, chunk_index)
+                    filled += 1
+        if filled:
+            logger.info(f"{filled} chunk(s) of {self.destination_path} copied from the local chunk store")
+
+    def _should_drop(self, source: Source) -> bool:
+        stats = self.stats[source]
+        with self._lock:
+            others = [s for s in self.active if s != source]
+            if stats.corrupt_chunks:
+                logger.warning(f"Dropping source {source[0]}:{source[1]} after {stats.corrupt_chunks} corrupt chunk(s).")
+                return True
+            if stats.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                logger.warning(f"Dropping source {source[0]}:{source[1]} after {stats.consecutive_failures} failed batches.")
+                return True
+            if not others or stats.batches < MIN_BATCHES_BEFORE_DROP:
+                return False
+            best_rate = max(self.stats[s].rate for s in others)
+            if stats.rate < best_rate * SLOW_SOURCE_FRACTION:
+                logger.info(f"Dropping slow source {source[0]}:{source[1]} ({stats.rate / 1e6:.1f} MB/s vs best {best_rate / 1e6:.1f} MB/s).")
+                return True
+        return False
@@ -0,0 +1,172 @@
+import os
+import time
+import signal
+import logging
+import itertools
+import threading
+from datetime import datetime
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 65536
+# Arguments past this many are dropped, so every record stays the same small size.
+MAX_ARGS = 4
+LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'off': logging.CRITICAL + 10}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+# Per-packet events are traced at DEBUG, per-request ones at INFO; both cost a tuple, never a formatted string.
+DEFAULT_LEVEL = logging.INFO
+ALL_SUBSYSTEMS = "*"
+
+
+def parse_level(value) -> int:
+    if isinstance(value, str):
+        if value.lower() not in LEVELS:
+            raise ValueError(f"Unknown trace level {value!r}, expected one of {', '.join(LEVELS)}")
+        return LEVELS[value.lower()]
+    if not isinstance(value, int):
+        raise ValueError(f"Invalid trace level {value!r}")
+    return value
+
+
+def _plain(value):
+    # Records keep references; only a dump turns them into something printable.
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[1], int):
+        return f"{value[0]}:{value[1]}"
+    return str(value)
+
+
+class TraceChannel:
+    def __init__(self, tracer: "Tracer", subsystem: str, level: int = DEFAULT_LEVEL):
+        self.tracer = tracer
+        self.subsystem = subsystem
+        self.level = level
+        # One in this many debug and info records is kept, counted per event so rare ones still show up.
+        # Warnings are always kept.
+        self.sample_every = 1
+        self._counts: Dict[str, int] = {}
+
+    def emit(self, level: int, event: str, *args):
+        if level >= self.level:
+            self._emit(level, event, args)
+
+    def _emit(self, level: int, event: str, args: tuple):
+        if self.sample_every > 1 and level < logging.WARNING:
+            count = self._counts.get(event, 0)
+            self._counts[event] = count + 1
+            if count % self.sample_every:
+                return
+        self.tracer.record(self.subsystem, level, event, args if len(args) <= MAX_ARGS else args[:MAX_ARGS])
+
+    # The level checks are repeated here so a disabled call costs one comparison.
+    def debug(self, event: str, *args):
+        if self.level <= logging.DEBUG:
+            self._emit(logging.DEBUG, event, args)
+
+    def info(self, event: str, *args):
+        if self.level <= logging.INFO:
+            self._emit(logging.INFO, event, args)
+
+    def warning(self, event: str, *args):
+        if self.level <= logging.WARNING:
+            self._emit(logging.WARNING, event, args)
+
+
+class Tracer:
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        # Preallocated; each record overwrites the slot of the one `capacity` records older.
+        self._records: List[tuple | None] = [None] * capacity
+        # next() on a count is atomic, so writers on any thread never share a slot and never take a lock.
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._channels: Dict[str, TraceChannel] = {}
+        # Records carry monotonic time; wall-clock time is only worked out when they are dumped.
+        self._epoch = time.time() - time.monotonic()
+
+    def channel(self, subsystem: str) -> TraceChannel:
+        with self._lock:
+            channel = self._channels.get(subsystem)
+            if channel is None:
+                channel = self._channels[subsystem] = TraceChannel(self, subsystem)
+            return channel
+
+    def record(self, subsystem: str, level: int, event: str, args: tuple, _monotonic=time.monotonic):
+        seq = next(self._sequence)
+        self._records[seq % self.capacity] = (seq, _monotonic(), subsystem, level, event, args)
+
+    def configure(self, levels: Dict | None = None, sample: Dict | None = None) -> Dict[str, Dict]:
+        # {"levels": {"discovery": "debug", "*": "info"}, "sample": {"discovery": 100}}
+        with self._lock:
+            updates = []
+            for settings, parse in ((levels or {}, parse_level), (sample or {}, int)):
+                for subsystem, value in settings.items():
+                    if subsystem != ALL_SUBSYSTEMS and subsystem not in self._channels:
+                        raise ValueError(f"Unknown trace subsystem {subsystem!r}")
+                    parsed = parse(value)
+                    if parse is int and parsed < 1:
+                        raise ValueError(f"Sampling for {subsystem} must keep one in 1 or more records")
+                    updates.append((subsystem, 'level' if parse is parse_level else 'sample_every', parsed))
+            # Validated in full first, so a bad entry changes nothing.
+            for subsystem, attribute, value in updates:
+                channels = self._channels.values() if subsystem == ALL_SUBSYSTEMS else [self._channels[subsystem]]
+                for channel in channels:
+                    setattr(channel, attribute, value)
+        return self.config()
+
+    def config(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {name: {'level': LEVEL_NAMES.get(channel.level, channel.level), 'sample_every': channel.sample_every}
+                    for name, channel in sorted(self._channels.items())}
+
+    def dump(self, subsystem: str | None = None, level: int = logging.DEBUG, limit: int | None = None) -> tuple[List[Dict], int]:
+        # Returns the newest records, oldest first, and how many older ones the ring has already overwritten.
+        records = sorted(record for record in list(self._records) if record is not None)
+        overwritten = records[-1][0] + 1 - len(records) if records else 0
+        records = [record for record in records
+                   if record[3] >= level and (subsystem is None or record[2] == subsystem)]
+        if limit is not None:
+            records = records[-limit:] if limit > 0 else []
+        return [{
+            'seq': seq,
+            'time': self._epoch + stamp,
+            'subsystem': name,
+            'level': LEVEL_NAMES.get(record_level, record_level),
+            'event': event,
+            'args': [_plain(arg) for arg in args],
+        } for seq, stamp, name, record_level, event, args in records], overwritten
+
+    def format(self, records: List[Dict]) -> str:
+        return "".join(f"{datetime.fromtimestamp(record['time']).isoformat(timespec='microseconds')} "
+                       f"{record['subsystem']:<10} {record['level']:<7} {record['event']} "
+                       f"{' '.join(str(arg) for arg in record['args'])}\n" for record in records)
+
+    def dump_to_file(self, path: str) -> int:
+        records, overwritten = self.dump()
+        with open(path, "w") as f:
+            if overwritten:
+                f.write(f"# {overwritten} older records were overwritten\n")
+            f.write(self.format(records))
+        return len(records)
+
+    def install_signal_handler(self, directory: str = ".", signum: int | None = None):
+        # `kill -USR1 <pid>` writes the buffer to trace-<pid>-<time>.log; a no-op where the signal does not exist.
+        signum = signum if signum is not None else getattr(signal, "SIGUSR1", None)
+        if signum is None:
+            return
+
+        def handle(_signum, _frame):
+            path = os.path.join(directory, f"trace-{os.getpid()}-{int(time.time())}.log")
+            try:
+                count = self.dump_to_file(path)
+            except OSError as e:
+                logger.error(f"Could not write trace dump to {path}: {e}")
+                return
+            logger.warning(f"Wrote {count} trace records to {path}")
+
+        signal.signal(signum, handle)
+
+
+tracer = Tracer()
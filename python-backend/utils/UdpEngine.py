@@ -0,0 +1,168 @@
+import os
+import json
+import struct
+import asyncio
+import logging
+import threading
+import contextlib
+from typing import Any, Callable, Collection, Dict, Tuple
+
+from utils.Metrics import metrics
+from utils.RateLimiter import rate_limiter
+from utils.Tracer import tracer
+from utils.WireFormat import decode_message, encode_message, is_control_frame
+
+logger = logging.getLogger(__name__)
+
+Address = Tuple[str, int]
+
+PACKETS = metrics.counter("p2p_control_packets_total", "Control datagrams by direction and message type",
+                          ("direction", "type"))
+PACKET_BYTES = metrics.counter("p2p_control_bytes_total", "Control datagram bytes by direction", ("direction",))
+# Incoming message types come off the network; past this many distinct ones the rest are counted as "other".
+MAX_COUNTED_TYPES = 64
+TRACE = tracer.channel("udp")
+
+
+def start_event_loop(name: str = "network-loop") -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name=name, daemon=True).start()
+    return loop
+
+
+def is_response(message_type: str) -> bool:
+    return message_type.endswith('_response')
+
+
+class PendingRequest:
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_response: Callable[[Dict, Address], bool] | None,
+                 peers: Collection[Address] | None = None):
+        self.future = loop.create_future()
+        # Without a callback the first response completes the request; with one, the callback decides.
+        self.on_response = on_response
+        # Addresses the answers may come from; None for broadcasts, where any peer may answer.
+        self.peers = {tuple(peer) for peer in peers} if peers is not None else None
+
+    def accepts(self, addr: Address) -> bool:
+        return self.peers is None or tuple(addr[:2]) in self.peers
+
+    def feed(self, message: Dict, addr: Address):
+        if self.future.done():
+            return
+        if self.on_response is None:
+            self.future.set_result((message, addr))
+        elif self.on_response(message, addr):
+            self.future.set_result(True)
+
+
+class UdpEngine(asyncio.DatagramProtocol):
+    def __init__(self, dispatch: Callable[[Dict, Address], None]):
+        self.dispatch = dispatch
+        self.transport: asyncio.DatagramTransport | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._thread_id: int | None = None
+        self._pending: Dict[int, PendingRequest] = {}
+        self._counted_types: set = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+
+    def datagram_received(self, data: bytes, addr: Address):
+        PACKET_BYTES.inc(("in",), len(data))
+        try:
+            message = decode_message(data) if is_control_frame(data) else json.loads(data)
+        except (ValueError, struct.error) as e:
+            # Anyone can aim datagrams at the port; a flood of junk must not turn into a flood of log lines.
+            PACKETS.inc(("in", "invalid"))
+            TRACE.warning("undecodable", addr, len(data), e)
+            return
+        # Both are used as dict keys below; a list or object there would raise inside the protocol callback.
+        if not isinstance(message, dict) or not isinstance(message.get('type'), str) \
+                or not isinstance(message.get('request_id'), (str, int, type(None))):
+            PACKETS.inc(("in", "invalid"))
+            return
+        message_type = message['type']
+        if message_type not in self._counted_types and len(self._counted_types) >= MAX_COUNTED_TYPES:
+            message_type = "other"
+        else:
+            self._counted_types.add(message_type)
+        PACKETS.inc(("in", message_type))
+        TRACE.debug("received", message_type, addr, len(data))
+        # Request ids are only unique per node: a peer's own request may carry the id of one of ours, so only
+        # responses are matched against outstanding requests, and only when they come from a peer we asked.
+        request = self._pending.get(message.get('request_id')) if is_response(message['type']) else None
+        if request is not None and not request.accepts(addr):
+            TRACE.debug("foreign_response", message['type'], addr)
+            return
+        try:
+            if request is not None:
+                request.feed(message, addr)
+            else:
+                self.dispatch(message, addr)
+        except Exception as e:
+            logger.error(f"Error handling {message.get('type')} from {addr[0]}:{addr[1]}: {e}", exc_info=True)
+
+    def error_received(self, exc: Exception):
+        # ICMP errors such as port unreachable from a peer that just left; the request simply times out.
+        TRACE.debug("socket_error", exc)
+
+    @property
+    def outstanding(self) -> int:
+        return len(self._pending)
+
+    def in_loop_thread(self) -> bool:
+        return threading.get_ident() == self._thread_id
+
+    @staticmethod
+    def encode(message: Dict, binary: bool = False) -> bytes:
+        return (encode_message(message) if binary else None) or json.dumps(message).encode()
+
+    def send(self, message: Dict | bytes, addr: Address, binary: bool = False, message_type: str | None = None):
+        # Pre-encoded messages name their type for the packet counters.
+        if isinstance(message, bytes):
+            data = message
+        else:
+            data = self.encode(message, binary)
+            message_type = message['type']
+        PACKETS.inc(("out", message_type or "unknown"))
+        TRACE.debug("sent", message_type, addr, len(data))
+        PACKET_BYTES.inc(("out",), len(data))
+        if self.in_loop_thread():
+            self._sendto(data, addr)
+        else:
+            self.loop.call_soon_threadsafe(self._sendto, data, addr)
+
+    def _sendto(self, data: bytes, addr: Address):
+        # Control traffic is the priority lane: sent at once, only charged to the upload budget.
+        rate_limiter.charge_control(len(data))
+        try:
+            self.transport.sendto(data, addr)
+        except OSError as e:
+            logger.warning(f"Error sending to {addr[0]}:{addr[1]}: {e}")
+
+    def _new_request_id(self) -> int:
+        # Random, so ids do not line up across nodes or restarts and an off-path sender cannot guess them;
+        # 0 means "no id" in binary frames.
+        while True:
+            request_id = int.from_bytes(os.urandom(8), "big")
+            if request_id and request_id not in self._pending:
+                return request_id
+
+    @contextlib.contextmanager
+    def pending(self, on_response: Callable[[Dict, Address], bool] | None = None, peers: Collection[Address] | None = None):
+        request_id = self._new_request_id()
+        request = PendingRequest(self.loop, on_response, peers)
+        self._pending[request_id] = request
+        try:
+            yield request_id, request
+        finally:
+            del self._pending[request_id]
+
+    @staticmethod
+    async def wait(request: PendingRequest, timeout: float) -> Any:
+        try:
+            return await asyncio.wait_for(request.future, max(timeout, 0.0))
+        except asyncio.TimeoutError:
+            return None
@@ -0,0 +1,257 @@
+import math
+import struct
+from typing import Callable, Dict
+
+# Binary control frames: magic, version, message type, request id. Transfer frames use b"PT" and never
+# reach the control socket, but the magics differ anyway so a misrouted datagram is never misparsed.
+MAGIC = b"PC"
+VERSION = 1
+HEADER = struct.Struct("!2sBBQ")
+
+DISCOVER = 1
+PEER_INFO = 2
+QUERY_FILE = 3
+FILE_FOUND = 4
+FILE_NOT_FOUND = 5
+RECEIVE_FILE = 6
+QUERY_FILES = 7
+QUERY_FILES_RESPONSE = 8
+
+# Bit positions are part of the protocol; only ever append.
+CAPABILITY_BITS = ('chunks', 'manifest', 'query_files', 'nack', 'summary', 'binary')
+# Transfer compression a receive_file requester accepts, in the flag bits above FLAG_CHUNKS.
+COMPRESSION_BITS = ('zlib', 'lzma', 'zstd')
+
+# port, node id, capabilities, flags, ts (echo_ts in peer_info), index version, announce interval
+ANNOUNCE = struct.Struct("!H8sHBdQf")
+# reply port, flags, then the UTF-8 filename
+QUERY_FILE_BODY = struct.Struct("!HB")
+# port, size, digest, then the UTF-8 filename
+FILE_FOUND_BODY = struct.Struct("!HQ32s")
+PORT = struct.Struct("!H")
+# data port, digest, flags, chunk count, then the chunk indexes and, if flagged, the requested rate
+RECEIVE_FILE_BODY = struct.Struct("!H32sBI")
+CHUNK_INDEX = struct.Struct("!I")
+RATE = struct.Struct("!I")
+# reply port, flags, part, name count, hash count, then the digests and length-prefixed names
+QUERY_FILES_BODY = struct.Struct("!HBHHH")
+# port, part, flags, entry count, then the entries
+QUERY_FILES_RESPONSE_BODY = struct.Struct("!HHBH")
+# flags, size, digest, then a length-prefixed name if flagged
+FOUND_ENTRY = struct.Struct("!BQ32s")
+NAME_LENGTH = struct.Struct("!H")
+
+FLAG_HELLO = 1
+FLAG_NACK = 1
+FLAG_CHUNKS = 1
+FLAG_RATE = FLAG_CHUNKS << (len(COMPRESSION_BITS) + 1)
+FLAG_LAST = 1
+FLAG_NAME = 1
+UNKNOWN = 2 ** 64 - 1
+
+
+def is_control_frame(data) -> bool:
+    return len(data) >= HEADER.size and data[:2] == MAGIC
+
+
+def _digest(file_hash: str) -> bytes:
+    digest = bytes.fromhex(file_hash)
+    if len(digest) != 32:
+        raise ValueError(f"Not a SHA-256 digest: {file_hash}")
+    return digest
+
+
+def _name(name: str) -> bytes:
+    raw = name.encode()
+    return NAME_LENGTH.pack(len(raw)) + raw
+
+
+def _read_name(data: memoryview, offset: int) -> tuple[str, int]:
+    (length,) = NAME_LENGTH.unpack_from(data, offset)
+    offset += NAME_LENGTH.size
+    if offset + length > len(data):
+        raise ValueError("Truncated name")
+    return bytes(data[offset:offset + length]).decode(), offset + length
+
+
+def _optional(value: int | None) -> int:
+    return UNKNOWN if value is None else value
+
+
+def _capability_mask(capabilities) -> int:
+    return sum(1 << CAPABILITY_BITS.index(c) for c in set(capabilities or ()) if c in CAPABILITY_BITS)
+
+
+def _encode_announce(message: Dict) -> bytes:
+    timestamp = message.get('ts') if message['type'] == 'discover' else message.get('echo_ts')
+    return ANNOUNCE.pack(message['port'], bytes.fromhex(message['node_id']), _capability_mask(message.get('capabilities')),
+                         FLAG_HELLO if message.get('hello') else 0,
+                         math.nan if timestamp is None else timestamp,
+                         _optional(message.get('index_version')), message.get('interval', 0.0))
+
+
+def _decode_announce(message_type: str, data: memoryview) -> Dict:
+    port, node_id, mask, flags, timestamp, index_version, interval = ANNOUNCE.unpack_from(data)
+    message = {
+        'type': message_type,
+        'port': port,
+        'node_id': node_id.hex(),
+        'capabilities': [c for bit, c in enumerate(CAPABILITY_BITS) if mask >> bit & 1],
+        'ts' if message_type == 'discover' else 'echo_ts': None if math.isnan(timestamp) else timestamp,
+        'index_version': None if index_version == UNKNOWN else index_version,
+        'interval': round(interval, 3),
+    }
+    if message_type == 'discover':
+        message['hello'] = bool(flags & FLAG_HELLO)
+    return message
+
+
+def _encode_query_file(message: Dict) -> bytes:
+    return QUERY_FILE_BODY.pack(message['reply_port'], FLAG_NACK if message.get('nack') else 0) + message['filename'].encode()
+
+
+def _decode_query_file(data: memoryview) -> Dict:
+    reply_port, flags = QUERY_FILE_BODY.unpack_from(data)
+    return {'type': 'query_file', 'filename': bytes(data[QUERY_FILE_BODY.size:]).decode(), 'reply_port': reply_port,
+            'nack': bool(flags & FLAG_NACK)}
+
+
+def _encode_file_found(message: Dict) -> bytes:
+    return FILE_FOUND_BODY.pack(message['port'], _optional(message.get('size')), _digest(message['file_hash'])) + \
+        message['filename'].encode()
+
+
+def _decode_file_found(data: memoryview) -> Dict:
+    port, size, digest = FILE_FOUND_BODY.unpack_from(data)
+    return {'type': 'file_found_response', 'filename': bytes(data[FILE_FOUND_BODY.size:]).decode(), 'file_hash': digest.hex(),
+            'size': None if size == UNKNOWN else size, 'port': port}
+
+
+def _encode_file_not_found(message: Dict) -> bytes:
+    return PORT.pack(message['port']) + message['filename'].encode()
+
+
+def _decode_file_not_found(data: memoryview) -> Dict:
+    (port,) = PORT.unpack_from(data)
+    return {'type': 'file_not_found_response', 'filename': bytes(data[PORT.size:]).decode(), 'port': port}
+
+
+def _encode_receive_file(message: Dict) -> bytes:
+    chunks = message.get('chunks')
+    flags = FLAG_CHUNKS if chunks is not None else 0
+    for codec in message.get('compression', ()):
+        flags |= FLAG_CHUNKS << (COMPRESSION_BITS.index(codec) + 1)
+    rate = message.get('rate')
+    if rate:
+        flags |= FLAG_RATE
+    body = RECEIVE_FILE_BODY.pack(message['port'], _digest(message['file_hash']), flags, len(chunks or ()))
+    return body + b"".join(CHUNK_INDEX.pack(c) for c in chunks or ()) + (RATE.pack(rate) if rate else b"")
+
+
+def _decode_receive_file(data: memoryview) -> Dict:
+    port, digest, flags, count = RECEIVE_FILE_BODY.unpack_from(data)
+    message = {'type': 'receive_file', 'file_hash': digest.hex(), 'port': port}
+    compression = [codec for bit, codec in enumerate(COMPRESSION_BITS) if flags & (FLAG_CHUNKS << (bit + 1))]
+    if compression:
+        message['compression'] = compression
+    offset = RECEIVE_FILE_BODY.size
+    if flags & FLAG_CHUNKS:
+        if offset + count * CHUNK_INDEX.size > len(data):
+            raise ValueError("Truncated chunk list")
+        message['chunks'] = list(struct.unpack_from(f"!{count}I", data, offset))
+        offset += count * CHUNK_INDEX.size
+    if flags & FLAG_RATE:
+        message['rate'] = RATE.unpack_from(data, offset)[0]
+    return message
+
+
+def _encode_query_files(message: Dict) -> bytes:
+    names, hashes = message.get('names', []), message.get('hashes', [])
+    body = QUERY_FILES_BODY.pack(message['reply_port'], FLAG_NACK if message.get('nack') else 0, message.get('part') or 0,
+                                 len(names), len(hashes))
+    return body + b"".join(_digest(h) for h in hashes) + b"".join(_name(n) for n in names)
+
+
+def _decode_query_files(data: memoryview) -> Dict:
+    reply_port, flags, part, name_count, hash_count = QUERY_FILES_BODY.unpack_from(data)
+    offset = QUERY_FILES_BODY.size
+    if offset + 32 * hash_count > len(data):
+        raise ValueError("Truncated hash list")
+    hashes = [bytes(data[offset + 32 * i:offset + 32 * (i + 1)]).hex() for i in range(hash_count)]
+    offset += 32 * hash_count
+    names = []
+    for _ in range(name_count):
+        name, offset = _read_name(data, offset)
+        names.append(name)
+    return {'type': 'query_files', 'reply_port': reply_port, 'nack': bool(flags & FLAG_NACK), 'part': part,
+            'names': names, 'hashes': hashes}
+
+
+def _encode_query_files_response(message: Dict) -> bytes:
+    found = message.get('found', [])
+    body = QUERY_FILES_RESPONSE_BODY.pack(message['port'], message.get('part') or 0, FLAG_LAST if message.get('last') else 0,
+                                          len(found))
+    entries = [FOUND_ENTRY.pack(FLAG_NAME if 'name' in entry else 0, _optional(entry.get('size')), _digest(entry['hash'])) +
+               (_name(entry['name']) if 'name' in entry else b"") for entry in found]
+    return body + b"".join(entries)
+
+
+def _decode_query_files_response(data: memoryview) -> Dict:
+    port, part, flags, count = QUERY_FILES_RESPONSE_BODY.unpack_from(data)
+    offset = QUERY_FILES_RESPONSE_BODY.size
+    found = []
+    for _ in range(count):
+        entry_flags, size, digest = FOUND_ENTRY.unpack_from(data, offset)
+        offset += FOUND_ENTRY.size
+        entry = {'hash': digest.hex(), 'size': None if size == UNKNOWN else size}
+        if entry_flags & FLAG_NAME:
+            entry['name'], offset = _read_name(data, offset)
+        found.append(entry)
+    return {'type': 'query_files_response', 'port': port, 'part': part, 'last': bool(flags & FLAG_LAST), 'found': found}
+
+
+_CODECS: Dict[str, tuple[int, Callable[[Dict], bytes], Callable[[memoryview], Dict]]] = {
+    'discover': (DISCOVER, _encode_announce, lambda data: _decode_announce('discover', data)),
+    'peer_info': (PEER_INFO, _encode_announce, lambda data: _decode_announce('peer_info', data)),
+    'query_file': (QUERY_FILE, _encode_query_file, _decode_query_file),
+    'file_found_response': (FILE_FOUND, _encode_file_found, _decode_file_found),
+    'file_not_found_response': (FILE_NOT_FOUND, _encode_file_not_found, _decode_file_not_found),
+    'receive_file': (RECEIVE_FILE, _encode_receive_file, _decode_receive_file),
+    'query_files': (QUERY_FILES, _encode_query_files, _decode_query_files),
+    'query_files_response': (QUERY_FILES_RESPONSE, _encode_query_files_response, _decode_query_files_response),
+}
+_DECODERS = {code: decode for code, _, decode in _CODECS.values()}
+
+
+def encode_message(message: Dict) -> bytes | None:
+    # None when the message has no binary form (or does not fit one); the caller then sends JSON.
+    codec = _CODECS.get(message.get('type'))
+    if codec is None:
+        return None
+    code, encode, _ = codec
+    try:
+        return HEADER.pack(MAGIC, VERSION, code, message.get('request_id') or 0) + encode(message)
+    except (KeyError, ValueError, TypeError, AttributeError, struct.error):
+        return None
+
+
+def decode_message(data: bytes) -> Dict:
+    _, version, code, request_id = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"Unsupported control frame version {version}")
+    decode = _DECODERS.get(code)
+    if decode is None:
+        raise ValueError(f"Unknown control message type {code}")
+    message = decode(memoryview(data)[HEADER.size:])
+    message['request_id'] = request_id or None
+    # Lets handlers answer in kind even before the sender shows up in the peer table.
+    message['binary'] = True
+    return message
+
+
+def binary_item_size(key: str, item) -> int:
+    if key == 'hashes':
+        return 32
+    if key == 'names':
+        return NAME_LENGTH.size + len(item.encode())
+    return FOUND_ENTRY.size + (NAME_LENGTH.size + len(item['name'].encode()) if 'name' in item else 0)
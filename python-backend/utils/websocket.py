@@ -3,11 +3,20 @@ import asyncio
 import websockets
 import json
 import os
-import base64
 import logging
 import pathlib
-import threading
+from http import HTTPStatus
 from typing import Any, TYPE_CHECKING
+from urllib.parse import urlsplit
+
+from utils.FileTransfer import read_at
+from utils.ManifestManager import CHUNK_SIZE
+from utils.DownloadManager import DownloadManager
+from utils.SearchCatalog import DEFAULT_SEARCH_LIMIT, search_filters
+from utils.Compression import COMPRESSIBLE_RATIO, SAMPLE_SIZE, Codec, choose_codec
+from utils.RateLimiter import rate_limiter
+from utils.Metrics import PROMETHEUS_CONTENT_TYPE, metrics
+from utils.Tracer import parse_level, tracer
 
 if TYPE_CHECKING:
     from P2PNode import P2PNode
@@ -17,6 +26,145 @@ else:
 
 logger = logging.getLogger(__name__)
 
+# High-water mark of the per-connection write buffer; streaming sends wait whenever it is exceeded.
+STREAM_WRITE_LIMIT = 4 * CHUNK_SIZE
+# Plain HTTP GETs of this path on the websocket port get the metrics in Prometheus' text format.
+METRICS_PATH = "/metrics"
+QUEUE_DEPTH = metrics.gauge("p2p_queue_depth", "Work waiting in internal queues", ("queue",))
+# A dump of the whole ring would be tens of megabytes of JSON; ask for more explicitly.
+DEFAULT_TRACE_DUMP_LIMIT = 1000
+TRACE = tracer.channel("websocket")
+
+DOWNLOAD_CONTROL_COMMANDS = {
+    "pause_download": "pause",
+    "resume_download": "resume",
+    "cancel_download": "cancel",
+    "set_download_priority": "set_priority",
+}
+
+
+def parse_payload(payload: str, key: str) -> dict:
+    # Commands accept either a bare value or a JSON object with optional extra fields.
+    if payload.startswith('{'):
+        return json.loads(payload)
+    return {key: payload}
+
+
+def parse_file_list(payload: str) -> tuple[list, list]:
+    # A JSON list of names, {"names": [...], "hashes": [...]}, or the raw text of a list file, one name per line.
+    if payload.startswith('[') or payload.startswith('{'):
+        request = json.loads(payload)
+        if isinstance(request, list):
+            return [str(name) for name in request], []
+        return [str(name) for name in request.get("names", [])], [str(h) for h in request.get("hashes", [])]
+    return [line.strip() for line in payload.splitlines() if line.strip()], []
+
+
+class DownloadEventForwarder:
+    def __init__(self, websocket, download_manager):
+        self.websocket = websocket
+        self.download_manager = download_manager
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = self.loop.create_task(self._forward())
+        download_manager.subscribe(self.on_event)
+        QUEUE_DEPTH.track(self.queue_depth)
+
+    def queue_depth(self) -> dict:
+        return {("websocket_events",): self.queue.qsize()}
+
+    def on_event(self, event: str, job: dict):
+        # Called from download worker threads.
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, {"type": "download_event", "event": event, "job": job})
+
+    async def _forward(self):
+        try:
+            while True:
+                await self.websocket.send(json.dumps(await self.queue.get()))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def close(self):
+        self.download_manager.unsubscribe(self.on_event)
+        self.task.cancel()
+
+
+def encode_chunk(codec: Codec, data) -> bytes:
+    # One flag byte per message: 1 when the rest is compressed, 0 when a sample showed it would not shrink.
+    if codec.worth_compressing(data[:SAMPLE_SIZE]):
+        compressed = codec.compress(data)
+        if len(compressed) < len(data) * COMPRESSIBLE_RATIO:
+            return b"\x01" + compressed
+    return b"\x00" + bytes(data)
+
+
+async def stream_file(websocket, file_path: str, file_hash: str, chunk_size: int = CHUNK_SIZE,
+                      compression: list | None = None):
+    codec = choose_codec(compression)
+    loop = asyncio.get_running_loop()
+    wire_bytes = 0
+
+    def read_chunk(fd: int, offset: int):
+        # Read, and compressed when negotiated, entirely off the event loop.
+        data = read_at(fd, offset, chunk_size)
+        return len(data), encode_chunk(codec, data) if codec is not None and data else data
+
+    # Share files can be saved over mid-stream, so they are read with pread rather than mapped: a truncated
+    # file just ends the stream early instead of faulting.
+    with open(file_path, 'rb') as f:
+        fd = f.fileno()
+        file_size = os.fstat(fd).st_size
+        file_name = os.path.basename(file_path)
+        chunk_count = (file_size + chunk_size - 1) // chunk_size
+        start_message = {
+            'type': 'file_stream_start',
+            'file_hash': file_hash,
+            'file_name': file_name,
+            'file_format': file_name.split('.')[-1] if '.' in file_name else "",
+            'size': file_size,
+            'chunk_size': chunk_size,
+            'chunk_count': chunk_count
+        }
+        if codec is not None:
+            start_message['compression'] = codec.name
+        await websocket.send(json.dumps(start_message))
+
+        # Read the next chunk on a worker thread while the current one is being sent. send() only returns once
+        # the connection's write buffer drains below its limit, so a slow client throttles the reads too.
+        bytes_sent = 0
+        pending_read = loop.run_in_executor(None, read_chunk, fd, 0) if chunk_count else None
+        try:
+            for chunk_index in range(chunk_count):
+                length, message = await pending_read
+                next_offset = (chunk_index + 1) * chunk_size
+                pending_read = loop.run_in_executor(None, read_chunk, fd, next_offset) if chunk_index + 1 < chunk_count else None
+                if not length:
+                    break
+                await websocket.send(message)
+                bytes_sent += length
+                wire_bytes += len(message)
+        finally:
+            # Never close the file under a read that is still running on the executor.
+            if pending_read is not None:
+                await asyncio.gather(pending_read, return_exceptions=True)
+
+    end_message = {'type': 'file_stream_end', 'file_hash': file_hash, 'bytes_sent': bytes_sent}
+    if codec is not None:
+        end_message['wire_bytes'] = wire_bytes
+    await websocket.send(json.dumps(end_message))
+    logger.info(f"Streamed {file_name} ({bytes_sent} bytes) to {websocket.remote_address}")
+
+
+def serve_metrics(connection, request):
+    # Anything but the metrics path goes on to the websocket handshake.
+    if urlsplit(request.path).path != METRICS_PATH:
+        return None
+    response = connection.respond(HTTPStatus.OK, metrics.render_prometheus())
+    del response.headers["Content-Type"]
+    response.headers["Content-Type"] = PROMETHEUS_CONTENT_TYPE
+    return response
+
+
 async def handle_message(websocket, path=None):
     global shared_p2p_node_instance
     client_address = websocket.remote_address
@@ -28,10 +176,9 @@ async def handle_message(websocket, path=None):
         await websocket.close(code=1011, reason="Server configuration error")
         return
 
+    download_events = None
     try:
         async for message_str in websocket:
-            logger.info(f"Received message from {client_address}: {message_str}")
-            
             if not isinstance(message_str, str):
                 await websocket.send(json.dumps({"error": "Invalid message format, expected string."}))
                 continue
@@ -44,25 +191,55 @@ async def handle_message(websocket, path=None):
             command, payload = parts
             command = command.strip()
             payload = payload.strip()
+            # Payloads can be whole file lists; only their size is traced.
+            TRACE.info("command", client_address, command, len(payload))
 
             if command == "receive_file":
-                requested_filename = payload
+                download_manager = getattr(shared_p2p_node_instance, 'download_manager', None)
                 try:
-                    download_thread = threading.Thread(
-                        target=shared_p2p_node_instance.receive_file_from_peer,
-                        args=(requested_filename,)
-                    )
-                    download_thread.daemon = True
-                    download_thread.start()
-                    response_message = {"status": "download_initiated", "filename": requested_filename}
+                    request = parse_payload(payload, "filename")
+                    requested_filename = request["filename"]
+                    download_events = download_events or DownloadEventForwarder(websocket, download_manager)
+                    job = download_manager.submit(requested_filename, int(request.get("priority", 0)))
+                    response_message = {"status": "download_initiated", "filename": requested_filename, "job_id": job.job_id}
                     await websocket.send(json.dumps(response_message))
                 except Exception as e:
-                    await websocket.send(json.dumps({"error": f"Failed to initiate download for '{requested_filename}'.", "details": str(e)}))
+                    await websocket.send(json.dumps({"error": f"Failed to initiate download for '{payload}'.", "details": str(e)}))
+
+            elif command in DOWNLOAD_CONTROL_COMMANDS:
+                download_manager = getattr(shared_p2p_node_instance, 'download_manager', None)
+                try:
+                    request = parse_payload(payload, "job_id")
+                    job_id = int(request["job_id"])
+                    if command == "set_download_priority":
+                        ok = download_manager.set_priority(job_id, int(request["priority"]))
+                    else:
+                        ok = getattr(download_manager, DOWNLOAD_CONTROL_COMMANDS[command])(job_id)
+                    await websocket.send(json.dumps({"type": "download_control", "command": command, "job_id": job_id, "ok": ok}))
+                except Exception as e:
+                    await websocket.send(json.dumps({"error": f"Invalid {command} request.", "details": str(e)}))
+
+            elif command == "list_downloads":
+                download_manager = getattr(shared_p2p_node_instance, 'download_manager', None)
+                if download_manager is not None:
+                    await websocket.send(json.dumps({"type": "download_list", "jobs": download_manager.list_jobs()}))
+                else:
+                    await websocket.send(json.dumps({"error": "Download manager not available."}))
+
+            elif command == "subscribe_downloads":
+                download_manager = getattr(shared_p2p_node_instance, 'download_manager', None)
+                if download_manager is not None:
+                    download_events = download_events or DownloadEventForwarder(websocket, download_manager)
+                    await websocket.send(json.dumps({"status": "subscribed", "jobs": download_manager.list_jobs()}))
+                else:
+                    await websocket.send(json.dumps({"error": "Download manager not available."}))
 
             elif command == "get_local_files_info":
                 local_files_info = []
                 if hasattr(shared_p2p_node_instance, 'peer_discovery') and shared_p2p_node_instance.peer_discovery:
-                    for f_hash, f_path_str in shared_p2p_node_instance.peer_discovery.local_files.items():
+                    # Listing may rescan the share; keep it off the loop that also serves UDP discovery.
+                    local_files = await asyncio.to_thread(lambda: shared_p2p_node_instance.peer_discovery.local_files)
+                    for f_hash, f_path_str in local_files.items():
                         local_files_info.append({
                             "filename": os.path.basename(f_path_str),
                             "hash": f_hash,
@@ -73,12 +250,20 @@ async def handle_message(websocket, path=None):
                     await websocket.send(json.dumps({"error": "Could not retrieve local files information."}))
             
             elif command == "serve_file":
-                requested_filename_to_serve = payload
+                # A bare filename, or {"filename": ..., "compression": ["zstd", "zlib"]} to have compressible chunks
+                # sent compressed, each binary message then starting with a flag byte.
+                try:
+                    request = parse_payload(payload, "filename")
+                except ValueError as e:
+                    await websocket.send(json.dumps({"error": "Invalid serve_file payload.", "details": str(e)}))
+                    continue
+                requested_filename_to_serve = str(request.get("filename", ""))
                 found_file_path = None
                 file_hash_to_send = None
 
                 if hasattr(shared_p2p_node_instance, 'peer_discovery') and shared_p2p_node_instance.peer_discovery:
-                    for f_hash, f_path_str in shared_p2p_node_instance.peer_discovery.local_files.items():
+                    local_files = await asyncio.to_thread(lambda: shared_p2p_node_instance.peer_discovery.local_files)
+                    for f_hash, f_path_str in local_files.items():
                         if os.path.basename(f_path_str) == requested_filename_to_serve:
                             found_file_path = f_path_str
                             file_hash_to_send = f_hash
@@ -86,32 +271,113 @@ async def handle_message(websocket, path=None):
                 
                 if found_file_path and file_hash_to_send:
                     try:
-                        with open(found_file_path, 'rb') as f:
-                            file_data_bytes = f.read()
-                        
-                        file_data_encoded = base64.b64encode(file_data_bytes).decode('utf-8')
-                        file_name_to_send = os.path.basename(found_file_path)
-                        file_format = file_name_to_send.split('.')[-1] if '.' in file_name_to_send else ""
-
-                        response_message = {
-                            'type': 'file_data',
-                            'file_hash': file_hash_to_send,
-                            'file_name': file_name_to_send,
-                            'file_format': file_format,
-                            'data': file_data_encoded
-                        }
-                        await websocket.send(json.dumps(response_message))
+                        await stream_file(websocket, found_file_path, file_hash_to_send,
+                                          compression=request.get("compression"))
                     except FileNotFoundError:
                         await websocket.send(json.dumps({"error": f"File '{requested_filename_to_serve}' found in manifest but not on disk."}))
+                    except websockets.exceptions.ConnectionClosed:
+                        raise
                     except Exception as e:
+                        logger.error(f"Error streaming file '{found_file_path}': {e}", exc_info=True)
                         await websocket.send(json.dumps({"error": f"Error processing file '{requested_filename_to_serve}'."}))
                 else:
                     await websocket.send(json.dumps({"status": "file_not_found_locally", "filename": requested_filename_to_serve}))
 
+            elif command == "find_files":
+                peer_discovery = getattr(shared_p2p_node_instance, 'peer_discovery', None)
+                try:
+                    names, hashes = parse_file_list(payload)
+                except (ValueError, TypeError) as e:
+                    await websocket.send(json.dumps({"error": "Invalid find_files payload.", "details": str(e)}))
+                    continue
+                if peer_discovery is None:
+                    await websocket.send(json.dumps({"error": "Peer discovery not available."}))
+                    continue
+                sources = await peer_discovery.find_file_sources_async(names, hashes)
+                await websocket.send(json.dumps({
+                    "type": "file_sources",
+                    "sources": {
+                        key: [{"peer_ip": ip, "port": port, "hash": file_hash, "size": size} for ip, port, file_hash, size in holders]
+                        for key, holders in sources.items() if holders
+                    },
+                    "missing": [key for key, holders in sources.items() if not holders]
+                }))
+
+            elif command == "search":
+                peer_discovery = getattr(shared_p2p_node_instance, 'peer_discovery', None)
+                try:
+                    request = parse_payload(payload, "query")
+                    query = str(request.get("query", ""))
+                    filters = search_filters(request)
+                    limit = int(request.get("limit", DEFAULT_SEARCH_LIMIT))
+                    offset = int(request.get("offset", 0))
+                except (ValueError, TypeError) as e:
+                    await websocket.send(json.dumps({"error": "Invalid search payload.", "details": str(e)}))
+                    continue
+                if peer_discovery is None:
+                    await websocket.send(json.dumps({"error": "Peer discovery not available."}))
+                    continue
+                if request.get("scope") == "local":
+                    results, has_more = await asyncio.to_thread(peer_discovery.catalog.search, query, **filters,
+                                                                limit=limit, offset=offset)
+                else:
+                    results, has_more = await peer_discovery.search_async(query, filters, limit, offset)
+                    for result in results:
+                        result["sources"] = [{"peer_ip": ip, "port": port} for ip, port in result["sources"]]
+                await websocket.send(json.dumps({
+                    "type": "search_results",
+                    "query": query,
+                    "filters": filters,
+                    "offset": offset,
+                    "has_more": has_more,
+                    "results": results
+                }))
+
+            elif command in ("get_rate_limits", "set_rate_limits"):
+                # Bytes per second, e.g. {"upload": "2M", "peer_upload": 500000, "download": null}; null or 0 lifts a limit.
+                try:
+                    limits = rate_limiter.configure(**json.loads(payload)) if command == "set_rate_limits" else dict(rate_limiter.limits)
+                except (ValueError, TypeError) as e:
+                    await websocket.send(json.dumps({"error": "Invalid rate limits.", "details": str(e)}))
+                    continue
+                await websocket.send(json.dumps({"type": "rate_limits", "limits": limits}))
+
+            elif command == "get_stats":
+                # An optional payload keeps only the metrics whose names start with it, e.g. "p2p_lookup".
+                stats = {name: metric for name, metric in metrics.snapshot().items() if name.startswith(payload)}
+                await websocket.send(json.dumps({"type": "stats", "metrics": stats}))
+
+            elif command == "dump_trace":
+                # {"subsystem": "discovery", "level": "info", "limit": 5000}, all optional.
+                try:
+                    request = json.loads(payload) if payload else {}
+                    records, overwritten = tracer.dump(request.get("subsystem"), parse_level(request.get("level", "debug")),
+                                                       int(request.get("limit", DEFAULT_TRACE_DUMP_LIMIT)))
+                except (ValueError, TypeError, AttributeError) as e:
+                    await websocket.send(json.dumps({"error": "Invalid dump_trace request.", "details": str(e)}))
+                    continue
+                await websocket.send(json.dumps({"type": "trace", "records": records, "overwritten": overwritten}))
+
+            elif command in ("get_trace_config", "set_trace_config"):
+                # {"levels": {"discovery": "debug", "*": "info"}, "sample": {"udp": 100}}; levels are debug, info,
+                # warning or off, sampling keeps one in N debug and info records of each event.
+                try:
+                    request = json.loads(payload) if command == "set_trace_config" else {}
+                    channels = tracer.configure(request.get("levels"), request.get("sample"))
+                except (ValueError, TypeError, AttributeError) as e:
+                    await websocket.send(json.dumps({"error": "Invalid trace configuration.", "details": str(e)}))
+                    continue
+                await websocket.send(json.dumps({"type": "trace_config", "channels": channels}))
+
             elif command == "discover_peers":
                 if hasattr(shared_p2p_node_instance, 'peer_discovery') and shared_p2p_node_instance.peer_discovery:
-                    peers = shared_p2p_node_instance.peer_discovery.peers
-                    await websocket.send(json.dumps({"type": "peer_list", "peers": peers}))
+                    peer_discovery = shared_p2p_node_instance.peer_discovery
+                    peer_table = getattr(peer_discovery, 'peer_table', None)
+                    await websocket.send(json.dumps({
+                        "type": "peer_list",
+                        "peers": peer_discovery.peers,
+                        "peer_details": peer_table.snapshot() if peer_table is not None else []
+                    }))
                 else:
                     await websocket.send(json.dumps({"error": "Could not retrieve peer list."}))
             else:
@@ -130,6 +396,8 @@ async def handle_message(websocket, path=None):
             except websockets.exceptions.ConnectionClosed:
                 pass
     finally:
+        if download_events is not None:
+            download_events.close()
         logger.info(f"Connection with {client_address} closed.")
 
 async def start_websocket_server_main(host, port, p2p_node_instance: P2PNode | Any):
@@ -140,7 +408,10 @@ async def start_websocket_server_main(host, port, p2p_node_instance: P2PNode | A
         logger.critical("Cannot start WebSocket server: P2PNode instance is None.")
         return
 
-    async with websockets.serve(handle_message, host, port, max_size=None): 
+    # No permessage-deflate: the frontend is local, where deflating every message (media included) only burns CPU;
+    # serve_file compresses the chunks that shrink when a client asks for it.
+    async with websockets.serve(handle_message, host, port, max_size=None, write_limit=STREAM_WRITE_LIMIT,
+                                compression=None, process_request=serve_metrics):
         await asyncio.Future()
 
 def run_server(p2p_node_instance: P2PNode | Any, host='localhost', port=8765):
@@ -167,9 +438,11 @@ if __name__ == '__main__':
         def __init__(self):
             self.peer_discovery = self.MockDiscoverPeers()
             self.files = {}
+            self.download_manager = DownloadManager(self.receive_file_from_peer)
 
-        def receive_file_from_peer(self, filename):
+        def receive_file_from_peer(self, filename, cancelled=None, on_progress=None):
             logger.info(f"[MockP2PNode] Request to download file: {filename}")
+            return True
 
         class MockDiscoverPeers:
             def __init__(self):